@@ -12,6 +12,9 @@ CREATE TABLE IF NOT EXISTS orders(
   timestamp INTEGER,
   FOREIGN KEY(sportname) REFERENCES sports(sportname) ON DELETE CASCADE,
   FOREIGN KEY (nickname) REFERENCES users(nickname) ON DELETE SET NULL);
+CREATE INDEX IF NOT EXISTS orders_nickname_timestamp ON orders(nickname, timestamp);
+CREATE INDEX IF NOT EXISTS orders_timestamp ON orders(timestamp);
+CREATE INDEX IF NOT EXISTS orders_sportname ON orders(sportname);
 CREATE TABLE IF NOT EXISTS users(
   user_id INTEGER PRIMARY KEY AUTOINCREMENT,
   nickname TEXT UNIQUE,
@@ -43,5 +46,15 @@ CREATE TABLE IF NOT EXISTS friends (
   FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE,
   FOREIGN KEY(friend_id) REFERENCES users(user_id) ON DELETE CASCADE);
 
+CREATE TABLE IF NOT EXISTS table_versions(
+  table_name TEXT PRIMARY KEY,
+  version INTEGER NOT NULL DEFAULT 0);
+INSERT OR IGNORE INTO table_versions(table_name, version)
+  VALUES('epoch', abs(random() % 4294967296));
+INSERT OR IGNORE INTO table_versions(table_name) VALUES('sports');
+INSERT OR IGNORE INTO table_versions(table_name) VALUES('users');
+INSERT OR IGNORE INTO table_versions(table_name) VALUES('users_profile');
+INSERT OR IGNORE INTO table_versions(table_name) VALUES('orders');
+
 COMMIT;
 PRAGMA foreign_keys=ON;
\ No newline at end of file
@@ -1,11 +1,49 @@
+import os
+from functools import partial
 from werkzeug.serving import run_simple
 from werkzeug.wsgi import DispatcherMiddleware
 from forum.resources import app as forum
+from forum.resources import response_versions, CACHE_TAG_TABLES
+from forum.utils import ResponseCache, CompressionMiddleware
+from forum.database import Engine, DEFAULT_SNAPSHOT_PATH
 from forum_admin.application import app as forum_admin
 
-application = DispatcherMiddleware(forum, {
+#The worker processes of the host map the same snapshot of the catalog,
+#in the temporary directory unless FORUM_SNAPSHOT_PATH is set
+forum.config['Engine'] = Engine(snapshot_path=os.environ.get(
+    'FORUM_SNAPSHOT_PATH', DEFAULT_SNAPSHOT_PATH))
+
+#Cache of the GET responses of the API. The resources name the tables that
+#each response is read from and drop the responses when they modify them.
+#The responses are compressed before they are cached, so a cached body is
+#not compressed again. A cached response whose tables were changed by
+#another process is rendered again: the versions of the tables are read
+#before it is served.
+response_cache = ResponseCache(CompressionMiddleware(forum),
+                               versions=response_versions)
+#Those responses are also dropped by the next request that reaches the API
+#(check Connection.sync_caches)
+for tag, tables in CACHE_TAG_TABLES.iteritems():
+    for table in tables:
+        forum.config['Engine'].versions.listen(
+            table, partial(response_cache.invalidate, tag))
+
+application = DispatcherMiddleware(response_cache, {
     '/forum_admin': forum_admin
 })
 if __name__ == '__main__':
-    run_simple('localhost', 5000, application,
-               use_reloader=True, use_debugger=True, use_evalex=True)
\ No newline at end of file
+    engine = forum.config['Engine']
+    #Add the indexes missing in databases created with older schemas
+    engine.migrate()
+    print "Database %s, PRAGMA settings: %s" % (engine.db_path,
+                                                engine.get_pragma_settings())
+    #Remove expired orders in the background instead of when booking. With
+    #the reloader the first process only watches the files and restarts the
+    #child process that serves the requests, so only the child sweeps.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        engine.retention.start()
+    try:
+        run_simple('localhost', 5000, application,
+                   use_reloader=True, use_debugger=True, use_evalex=True)
+    finally:
+        engine.retention.stop()
\ No newline at end of file
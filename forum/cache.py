@@ -0,0 +1,300 @@
+'''
+In-memory caches of the data of the forum database, shared by the
+connections of an :py:class:`forum.database.Engine`.
+'''
+
+from collections import OrderedDict
+import time, sys, threading
+
+
+class Cache(object):
+    '''
+    Base of the caches of an Engine: a lock, a generation incremented by
+    each invalidation, so that a value loaded before an invalidation is not
+    stored, and the counters in :py:attr:`COUNTERS`, reported by
+    :py:meth:`stats`.
+
+    :param clock: function returning the current time in seconds, used for
+        the times to live.
+
+    '''
+    #Names of the counters
+    COUNTERS = ('hits', 'misses', 'invalidations')
+
+    def __init__(self, clock=time.time):
+        super(Cache, self).__init__()
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._generation = 0
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+
+    def _invalidated(self):
+        '''
+        Starts a new generation. Called holding the lock.
+        '''
+        self._generation += 1
+        self.invalidations += 1
+
+    def _state(self):
+        '''
+        :return: dictionary with the current state of the cache, reported by
+            :py:meth:`stats`. Called holding the lock.
+        '''
+        return {}
+
+    def _hit_rate(self):
+        '''
+        :return: hits per lookup, 0 if there were no lookups.
+        '''
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def stats(self):
+        '''
+        :return: a dictionary with the state of the cache and its counters.
+        '''
+        with self._lock:
+            stats = self._state()
+            for name in self.COUNTERS:
+                stats[name] = getattr(self, name)
+            return stats
+
+
+class SportsCache(Cache):
+    '''
+    Read-through cache of the sports catalog, loaded whole on a miss and
+    used for ``ttl`` seconds or until :py:meth:`invalidate` is called.
+    Accessible through :py:attr:`Engine.sports_cache`.
+
+    :param float ttl: seconds that a loaded catalog is used. If 0 the cache
+        is disabled.
+    :param clock: check :py:class:`Cache`
+
+    '''
+    def __init__(self, ttl, clock=time.time):
+        super(SportsCache, self).__init__(clock)
+        self.ttl = ttl
+        #Catalog returned by the load function
+        self._catalog = None
+        self._loaded = 0.0
+
+    def get(self, load):
+        '''
+        Returns the catalog, loading it on a miss.
+
+        :param load: function returning the catalog: a tuple ``(sports,
+            profiles)`` with the tuple of records of the sports. It is called
+            without holding any lock.
+        :return: the catalog, as returned by ``load``
+
+        '''
+        with self._lock:
+            if self._catalog is not None and \
+               self.clock() - self._loaded < self.ttl:
+                self.hits += 1
+                return self._catalog
+            self.misses += 1
+            generation = self._generation
+        started = self.clock()
+        catalog = load()
+        with self._lock:
+            if generation == self._generation:
+                self._catalog = catalog
+                self._loaded = started
+        return catalog
+
+    def invalidate(self):
+        '''
+        Drops the catalog. The next lookup loads it again.
+        '''
+        with self._lock:
+            self._invalidated()
+            self._catalog = None
+
+    def _state(self):
+        return {'ttl': self.ttl,
+                'size': len(self._catalog[0]) if self._catalog is not None
+                        else 0}
+
+
+class UserCache(Cache):
+    '''
+    LRU cache of the users by nickname, including the nicknames that do not
+    exist (cached as None). A user is loaded again ``ttl`` seconds after it
+    was cached or when :py:meth:`invalidate` is called. Accessible through
+    :py:attr:`Engine.user_cache`.
+
+    :param int capacity: maximum number of users cached. If 0 the cache is
+        disabled.
+    :param float ttl: seconds that a cached user is used.
+    :param clock: check :py:class:`Cache`
+
+    '''
+    COUNTERS = Cache.COUNTERS + ('evictions', 'expirations')
+
+    def __init__(self, capacity, ttl, clock=time.time):
+        super(UserCache, self).__init__(clock)
+        self.capacity = capacity
+        self.ttl = ttl
+        #(user, loaded) by nickname, the least recently used first
+        self._entries = OrderedDict()
+
+    def get(self, nickname, load):
+        '''
+        Returns the user with the given nickname, loading it on a miss.
+
+        :param str nickname: nickname of the user.
+        :param load: function returning the user given its nickname, or None
+            if it does not exist. It is called without holding any lock.
+        :return: the user, as returned by ``load``
+
+        '''
+        with self._lock:
+            entry = self._entries.pop(nickname, None)
+            if entry is not None:
+                if self.clock() - entry[1] < self.ttl:
+                    #Most recently used: back at the end
+                    self._entries[nickname] = entry
+                    self.hits += 1
+                    return entry[0]
+                self.expirations += 1
+            self.misses += 1
+            generation = self._generation
+        started = self.clock()
+        user = load(nickname)
+        with self._lock:
+            if generation == self._generation:
+                self._entries.pop(nickname, None)
+                self._entries[nickname] = (user, started)
+                while len(self._entries) > self.capacity:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return user
+
+    def invalidate(self, nickname=None):
+        '''
+        Drops a user from the cache.
+
+        :param str nickname: nickname of the user. If None, all the users
+            are dropped.
+
+        '''
+        with self._lock:
+            self._invalidated()
+            if nickname is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(nickname, None)
+
+    def _state(self):
+        return {'capacity': self.capacity, 'ttl': self.ttl,
+                'size': len(self._entries), 'hit_rate': self._hit_rate()}
+
+
+def _result_size(value):
+    '''
+    :return: estimation of the bytes of memory used by a result, including
+        the items of its lists, tuples and dictionaries.
+    '''
+    size = sys.getsizeof(value)
+    if isinstance(value, tuple):
+        #Records iterate over their keys, not their values
+        size += sum(_result_size(item) for item in tuple.__iter__(value))
+    elif isinstance(value, list):
+        size += sum(_result_size(item) for item in value)
+    elif isinstance(value, dict):
+        size += sum(_result_size(key) + _result_size(item)
+                    for key, item in value.iteritems())
+    return size
+
+
+class ResultCache(Cache):
+    '''
+    LRU cache of the results of the methods marked with
+    :py:func:`forum.database.cached_result`, bounded by the memory of the
+    results and dropped by table with :py:meth:`invalidate`. Accessible
+    through :py:attr:`Engine.result_cache`.
+
+    :param int budget: maximum bytes of memory of the cached results, as
+        estimated by ``sys.getsizeof``. If 0 the cache is disabled.
+
+    '''
+    COUNTERS = Cache.COUNTERS + ('evictions', 'oversized')
+
+    def __init__(self, budget):
+        super(ResultCache, self).__init__()
+        self.budget = budget
+        #(result, size, is_list, tables) by key, the least recently used
+        #first
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key, tables, load):
+        '''
+        Returns the result for ``key``, loading it on a miss. Lists are
+        stored as tuples and a new list is returned on every call, so the
+        callers can modify it.
+
+        :param key: hashable key of the result, including the versions of
+            ``tables``.
+        :param tables: names of the tables read by ``load``. The result is
+            dropped when one of them changes.
+        :param load: function returning the result. It is called without
+            holding any lock.
+        :return: the result, as returned by ``load``
+
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                #Most recently used: back at the end
+                self._entries[key] = entry
+                self.hits += 1
+                return list(entry[0]) if entry[2] else entry[0]
+            self.misses += 1
+            generation = self._generation
+        result = load()
+        is_list = isinstance(result, list)
+        stored = tuple(result) if is_list else result
+        size = _result_size(stored)
+        with self._lock:
+            if generation != self._generation:
+                return result
+            if size > self.budget:
+                self.oversized += 1
+                return result
+            #Another thread may have stored the same key meanwhile
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (stored, size, is_list, tables)
+            self._bytes += size
+            while self._bytes > self.budget:
+                self._bytes -= self._entries.popitem(last=False)[1][1]
+                self.evictions += 1
+        return result
+
+    def invalidate(self, *tables):
+        '''
+        Drops the results that read the given tables. The results being
+        loaded are not stored.
+
+        :param tables: names of the tables. If none is given, all the
+            results are dropped.
+
+        '''
+        with self._lock:
+            self._invalidated()
+            if not tables:
+                self._entries.clear()
+                self._bytes = 0
+                return
+            stale = [key for key, entry in self._entries.iteritems()
+                     if not entry[3] or set(entry[3]).intersection(tables)]
+            for key in stale:
+                self._bytes -= self._entries.pop(key)[1]
+
+    def _state(self):
+        return {'budget': self.budget, 'bytes': self._bytes,
+                'size': len(self._entries), 'hit_rate': self._hit_rate()}
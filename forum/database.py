@@ -11,11 +11,1354 @@ Provides the database API to access the forum persistent data.
 '''
 
 from datetime import datetime
-import time, sqlite3, re, os
+from collections import OrderedDict
+import time, sqlite3, re, os, threading, mmap, marshal, struct
+import functools, inspect, tempfile
+
+from cache import Cache, SportsCache, UserCache, ResultCache
 #Default paths for .db and .sql files to create and populate the database.
 DEFAULT_DB_PATH = 'db/forum.db'
 DEFAULT_SCHEMA = "db/forum_schema_dump.sql"
 DEFAULT_DATA_DUMP = "db/forum_data_dump.sql"
+#Default settings of the connection pool owned by each Engine.
+DEFAULT_POOL_SIZE = 5
+DEFAULT_POOL_TIMEOUT = 10.0
+DEFAULT_POOL_IDLE_TIMEOUT = 300.0
+#Seconds that an order is kept after it was created. Older orders are
+#removed when new orders are created.
+DEFAULT_ORDER_RETENTION = 7 * 24 * 3600
+#Default settings of the background sweeper removing expired orders.
+DEFAULT_SWEEP_INTERVAL = 60.0
+DEFAULT_SWEEP_CHUNK_SIZE = 500
+#Default seconds that the sports catalog is cached by each Engine.
+DEFAULT_SPORTS_CACHE_TTL = 30.0
+#Default capacity and seconds that users are cached by each Engine.
+DEFAULT_USER_CACHE_SIZE = 1000
+DEFAULT_USER_CACHE_TTL = 60.0
+#Default bytes of memory of the results cached by the ResultCache
+DEFAULT_RESULT_CACHE_BYTES = 4 * 1024 * 1024
+#Default path of the catalog snapshot shared by the processes of the host
+DEFAULT_SNAPSHOT_PATH = os.path.join(tempfile.gettempdir(), 'forum.snapshot')
+#PRAGMA profiles that an Engine can apply to every connection it opens. Each
+#profile is a sequence of (pragma, value) executed in the given order.
+#  * legacy: rollback journal, as created by sqlite3 by default.
+#  * wal: write-ahead log, so readers do not block on the writer. The page
+#    cache is given in KiB (negative value) and mmap_size in bytes.
+#  * wal_durable: same as wal but syncing the log on every commit.
+PRAGMA_PROFILES = {
+    'legacy': (('foreign_keys', 'ON'),),
+    'wal': (('foreign_keys', 'ON'),
+            ('journal_mode', 'WAL'),
+            ('synchronous', 'NORMAL'),
+            ('cache_size', -8192),
+            ('mmap_size', 64 * 1024 * 1024),
+            ('temp_store', 'MEMORY')),
+    'wal_durable': (('foreign_keys', 'ON'),
+                    ('journal_mode', 'WAL'),
+                    ('synchronous', 'FULL'),
+                    ('cache_size', -8192),
+                    ('mmap_size', 64 * 1024 * 1024),
+                    ('temp_store', 'MEMORY')),
+}
+DEFAULT_PROFILE = 'wal'
+#Secondary indexes of the orders table. They serve the lookups of orders by
+#user and by time range (both sorted by timestamp) and the ON DELETE CASCADE
+#from sports. Keep in sync with db/forum_schema_dump.sql
+ORDERS_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS orders_nickname_timestamp \
+        ON orders(nickname, timestamp)',
+    'CREATE INDEX IF NOT EXISTS orders_timestamp ON orders(timestamp)',
+    'CREATE INDEX IF NOT EXISTS orders_sportname ON orders(sportname)',
+)
+#Tables whose writes are counted in the table_versions table, so caches in
+#any process can tell when they change. Check TableVersions.
+VERSIONED_TABLES = ('sports', 'users', 'users_profile', 'orders')
+#Row of table_versions holding a random number chosen when the table is
+#created. The versions of two databases are only comparable if their epochs
+#are equal. Check Engine.renew_epoch
+EPOCH = 'epoch'
+#Statements creating the table_versions table, with the epoch and one row
+#per versioned table. Keep in sync with db/forum_schema_dump.sql
+TABLE_VERSIONS_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS table_versions(\
+        table_name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)',
+    "INSERT OR IGNORE INTO table_versions(table_name, version) \
+        VALUES('%s', abs(random() %% 4294967296))" % EPOCH,
+) + tuple(
+    "INSERT OR IGNORE INTO table_versions(table_name) VALUES('%s')" % table
+    for table in VERSIONED_TABLES
+)
+#Statements removing the triggers that incremented the versions on every
+#row written. The versions are now incremented once per statement by the
+#Connection methods (check _bump_versions)
+DROP_VERSION_TRIGGERS = tuple(
+    'DROP TRIGGER IF EXISTS %s_version_%s' % (table, event)
+    for table in VERSIONED_TABLES for event in ('insert', 'update', 'delete')
+)
+#Tables whose data is in the catalog snapshot
+SNAPSHOT_TABLES = ('sports', 'users', 'users_profile')
+#First bytes of a catalog snapshot file
+SNAPSHOT_MAGIC = 'FCSNAP01'
+#Number of rows fetched at once by the iter_* methods of Connection.
+DEFAULT_FETCH_BATCH = 100
+#Number of prepared statements that sqlite3 keeps per connection.
+STATEMENT_CACHE_SIZE = 128
+#Maximum number of values in the IN (...) lists of the bulk methods of
+#Connection. SQLite limits the number of parameters of a statement.
+MAX_IN_VALUES = 500
+#PRAGMAs reported by Connection.get_pragma_settings
+REPORTED_PRAGMAS = ('foreign_keys', 'journal_mode', 'synchronous',
+                    'cache_size', 'mmap_size', 'temp_store')
+
+
+class ConnectionPool(object):
+    '''
+    Bounded pool of open sqlite3 connections of an :py:class:`Engine`
+    (:py:attr:`Engine.pool`).
+
+    Connections are opened lazily using ``factory`` and are reused once they
+    are returned with :py:meth:`checkin`. Before a connection is handed out
+    again it is health checked, and connections which have been idle for
+    longer than ``idle_timeout`` seconds are closed.
+
+    :param factory: callable without arguments returning a new, already
+        configured, sqlite3 connection.
+    :param int max_size: maximum number of connections open at the same time.
+    :param float timeout: seconds that :py:meth:`checkout` waits for a free
+        connection when all of them are in use.
+    :param float idle_timeout: seconds after which an idle connection is
+        closed. If None, idle connections are never closed.
+    :param clock: function returning the current time in seconds, used for
+        the idle timeout.
+
+    '''
+    def __init__(self, factory, max_size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_POOL_TIMEOUT,
+                 idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT, clock=time.time):
+        super(ConnectionPool, self).__init__()
+        if max_size < 1:
+            raise ValueError("The pool size must be at least 1")
+        self.factory = factory
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self._lock = threading.Condition()
+        #Idle connections as (connection, last use) tuples, oldest first
+        self._idle = []
+        #Generation in which each open connection was created
+        self._generations = {}
+        self._generation = 0
+        #Number of open connections, idle or in use
+        self._open = 0
+        #Metrics
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.evictions = 0
+        self.health_failures = 0
+
+    def checkout(self):
+        '''
+        Takes a connection from the pool, opening a new one if there is no
+        idle connection and the pool is not full.
+
+        :return: a sqlite3 connection for the exclusive use of the caller. It
+            must be returned with :py:meth:`checkin`.
+        :raises sqlite3.OperationalError: if no connection gets free in
+            :py:attr:`timeout` seconds.
+
+        '''
+        con = None
+        with self._lock:
+            self._evict_idle()
+            deadline = None
+            while not self._idle and self._open >= self.max_size:
+                if deadline is None:
+                    self.waits += 1
+                    deadline = time.time() + self.timeout
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise sqlite3.OperationalError(
+                        "Timeout waiting for a database connection")
+                self._lock.wait(remaining)
+            if self._idle:
+                con = self._idle.pop()[0]
+            else:
+                #Reserve the slot before opening the connection
+                self._open += 1
+            self.checkouts += 1
+        if con is not None and not self._is_healthy(con):
+            with self._lock:
+                self.health_failures += 1
+                self._generations.pop(con, None)
+            _close_quietly(con)
+            con = None
+        if con is None:
+            try:
+                con = self.factory()
+            except Exception:
+                with self._lock:
+                    self._open -= 1
+                    self._lock.notify()
+                raise
+            with self._lock:
+                self._generations[con] = self._generation
+        return con
+
+    def checkin(self, con, discard=False):
+        '''
+        Returns a connection obtained with :py:meth:`checkout` to the pool.
+
+        :param con: the sqlite3 connection to return.
+        :param bool discard: if True the connection is closed instead of being
+            kept for reuse.
+
+        '''
+        with self._lock:
+            if self._generations.get(con) != self._generation:
+                discard = True
+            if discard:
+                self._generations.pop(con, None)
+                self._open -= 1
+            else:
+                self._idle.append((con, self.clock()))
+            self._lock.notify()
+        if discard:
+            _close_quietly(con)
+
+    def dispose(self):
+        '''
+        Closes all idle connections. Connections in use are closed when they
+        are returned to the pool.
+
+        '''
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+            for con, last_used in idle:
+                self._generations.pop(con, None)
+            self._open -= len(idle)
+            self._generation += 1
+            self._lock.notify_all()
+        for con, last_used in idle:
+            _close_quietly(con)
+
+    def stats(self):
+        '''
+        Returns the current state and the counters of the pool.
+
+        :return: a dictionary with the keys ``max_size``, ``open``, ``idle``,
+            ``in_use``, ``checkouts``, ``waits``, ``timeouts``, ``evictions``
+            and ``health_failures``.
+
+        '''
+        with self._lock:
+            return {'max_size': self.max_size,
+                    'open': self._open,
+                    'idle': len(self._idle),
+                    'in_use': self._open - len(self._idle),
+                    'checkouts': self.checkouts,
+                    'waits': self.waits,
+                    'timeouts': self.timeouts,
+                    'evictions': self.evictions,
+                    'health_failures': self.health_failures}
+
+    def _evict_idle(self):
+        '''
+        Closes the connections idle for more than :py:attr:`idle_timeout`
+        seconds. Must be called holding the lock.
+
+        '''
+        if self.idle_timeout is None:
+            return
+        limit = self.clock() - self.idle_timeout
+        while self._idle and self._idle[0][1] < limit:
+            con = self._idle.pop(0)[0]
+            self._generations.pop(con, None)
+            self._open -= 1
+            self.evictions += 1
+            _close_quietly(con)
+
+    def _is_healthy(self, con):
+        '''
+        :return: True if the connection can still execute statements.
+        '''
+        try:
+            con.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+
+class OrderRetention(object):
+    '''
+    Background sweeper removing the orders older than the retention period
+    of an :py:class:`Engine` (:py:attr:`Engine.retention`).
+
+    Once started, it sweeps the database every ``interval`` seconds in a
+    daemon thread. Expired orders are deleted in chunks of at most
+    ``chunk_size`` rows, each one in its own transaction, so the write lock
+    is never held for long. While the sweeper is running
+    :py:meth:`Connection.create_order` does not remove expired orders.
+
+    :param engine: the Engine whose orders are removed.
+    :param float interval: seconds between two sweeps.
+    :param int chunk_size: maximum number of orders deleted per transaction.
+
+    '''
+    def __init__(self, engine, interval=DEFAULT_SWEEP_INTERVAL,
+                 chunk_size=DEFAULT_SWEEP_CHUNK_SIZE):
+        super(OrderRetention, self).__init__()
+        if chunk_size < 1:
+            raise ValueError("The chunk size must be at least 1")
+        self.engine = engine
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self._thread = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        #Metrics
+        self.sweeps = 0
+        self.rows_purged = 0
+        self.time_spent = 0.0
+        self.last_sweep = None
+        self.lag = 0.0
+        self.errors = 0
+
+    def start(self):
+        '''
+        Starts sweeping in a background thread. The first sweep is done
+        immediately.
+
+        :return: True if the sweeper was started, False if it was already
+            running.
+
+        '''
+        if self.is_running():
+            return False
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='order-retention')
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def stop(self, timeout=None):
+        '''
+        Stops the background thread, waiting for the current sweep to finish.
+
+        :param float timeout: maximum number of seconds to wait.
+        :return: True if the sweeper was stopped, False if it was not
+            running or it did not stop within ``timeout`` seconds.
+
+        '''
+        if not self.is_running():
+            return False
+        self._stopping.set()
+        self._thread.join(timeout)
+        #Still sweeping: keep the thread, so start() does not run a second
+        #sweeper
+        if self._thread.is_alive():
+            return False
+        self._thread = None
+        return True
+
+    def is_running(self):
+        '''
+        :return: True if the background thread is alive.
+        '''
+        return self._thread is not None and self._thread.is_alive()
+
+    def sweep(self):
+        '''
+        Removes the expired orders now, in chunks of :py:attr:`chunk_size`
+        rows.
+
+        :return: the number of orders removed.
+        :raises sqlite3.Error: if the database could not be modified.
+
+        '''
+        retention = self.engine.order_retention
+        if retention is None:
+            return 0
+        started = time.time()
+        cutoff = started - retention
+        purged = 0
+        con = self.engine.connect()
+        try:
+            cur = con.con.cursor()
+            #The lag is how long the oldest expired order has been due
+            cur.execute('SELECT MIN(timestamp) FROM orders')
+            oldest = cur.fetchone()[0]
+            lag = max(0.0, cutoff - oldest) if oldest is not None else 0.0
+            while True:
+                cur.execute('DELETE FROM orders WHERE order_id IN \
+                             (SELECT order_id FROM orders \
+                              WHERE timestamp < ? LIMIT ?)',
+                            (cutoff, self.chunk_size))
+                deleted = cur.rowcount
+                if deleted > 0:
+                    _bump_versions(cur, ('orders',))
+                con.con.commit()
+                purged += deleted
+                #Release the lock between chunks and stop early if asked
+                if deleted < self.chunk_size or self._stopping.is_set():
+                    break
+        finally:
+            con.close()
+        if purged:
+            self.engine.result_cache.invalidate('orders')
+        with self._lock:
+            self.sweeps += 1
+            self.rows_purged += purged
+            self.time_spent += time.time() - started
+            self.last_sweep = started
+            self.lag = lag
+        return purged
+
+    def stats(self):
+        '''
+        Returns the counters of the sweeper.
+
+        :return: a dictionary with the keys ``running``, ``sweeps``,
+            ``rows_purged``, ``time_spent`` (seconds), ``last_sweep`` (UNIX
+            timestamp), ``lag`` (seconds that the oldest expired order waited
+            before the last sweep) and ``errors``.
+
+        '''
+        with self._lock:
+            return {'running': self.is_running(),
+                    'sweeps': self.sweeps,
+                    'rows_purged': self.rows_purged,
+                    'time_spent': self.time_spent,
+                    'last_sweep': self.last_sweep,
+                    'lag': self.lag,
+                    'errors': self.errors}
+
+    def _run(self):
+        '''
+        Body of the background thread.
+        '''
+        while not self._stopping.is_set():
+            try:
+                self.sweep()
+            except sqlite3.Error, excp:
+                with self._lock:
+                    self.errors += 1
+                print "Error %s:" % excp.args[0]
+            self._stopping.wait(self.interval)
+
+
+def _close_quietly(con):
+    '''
+    Closes a sqlite3 connection ignoring the errors.
+    '''
+    try:
+        con.close()
+    except sqlite3.Error:
+        pass
+
+
+class OrdersQuery(object):
+    '''
+    Builder of the SELECT statements used by :py:meth:`Connection.get_orders`.
+
+    All the values are passed as parameters, so the SQL text only depends on
+    which filters are used (its shape) and never on their values. There are
+    16 possible shapes. The text of each one is built once and shared, and
+    every sqlite3 connection keeps them prepared in its statement cache
+    (:py:data:`STATEMENT_CACHE_SIZE`), so repeated lookups do not parse and
+    plan the query again.
+
+    :Example:
+
+    >>> query, pvalue = OrdersQuery.build(nickname='chen', limit=10)
+
+    '''
+    #SQL text of each shape, keyed by the tuple of filters used
+    _shapes = {}
+
+    @classmethod
+    def build(cls, nickname=None, before=-1, after=-1, cursor=None,
+              limit=-1):
+        '''
+        Creates the statement and its parameters. The arguments have the same
+        meaning as in :py:meth:`Connection.get_orders`, with ``cursor``
+        containing the ``order_id`` column (int) instead of the order id.
+
+        :return: tuple ``(query, pvalue)`` ready for ``cursor.execute``.
+        :raises ValueError: if ``before``, ``after``, ``limit`` or the
+            timestamp of the cursor are not numbers.
+
+        '''
+        numbers = [before, after, limit]
+        if cursor is not None:
+            numbers.append(cursor[0])
+        for value in numbers:
+            if isinstance(value, bool) or \
+               not isinstance(value, (int, long, float)):
+                raise ValueError("%r is not a number" % (value,))
+        shape = (nickname is not None, before != -1, after != -1,
+                 cursor is not None)
+        query = cls._shapes.get(shape)
+        if query is None:
+            query = cls._shapes[shape] = cls._build_shape(*shape)
+        pvalue = []
+        if nickname is not None:
+            pvalue.append(nickname)
+        if before != -1:
+            pvalue.append(before)
+        if after != -1:
+            pvalue.append(after)
+        if cursor is not None:
+            timestamp, order_id = cursor
+            pvalue.extend((timestamp, timestamp, order_id))
+        #LIMIT -1 means no limit in sqlite
+        pvalue.append(limit if limit > -1 else -1)
+        return query, tuple(pvalue)
+
+    @staticmethod
+    def _build_shape(nickname, before, after, cursor):
+        '''
+        Builds the SQL text of a shape. Each argument is True if the filter is
+        used.
+        '''
+        conditions = []
+          #Nickname restriction
+        if nickname:
+            conditions.append('nickname = ?')
+          #Before restriction
+        if before:
+            conditions.append('timestamp < ?')
+          #After restriction
+        if after:
+            conditions.append('timestamp > ?')
+          #Cursor restriction. The first condition makes it an index seek.
+        if cursor:
+            conditions.append('timestamp <= ? AND '
+                              '(timestamp < ? OR order_id < ?)')
+        query = 'SELECT ' + Order.COLUMNS + ' FROM orders'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+          #Order of results and limit of the number of results returned
+        query += ' ORDER BY timestamp DESC, order_id DESC LIMIT ?'
+        return query
+
+
+class Record(tuple):
+    '''
+    Immutable record returned by the :py:class:`Connection` methods instead
+    of a dictionary.
+
+    A record is a tuple holding only the values of a row. The keys are
+    stored once in the class (:py:attr:`_keys`), so listings do not build a
+    dictionary per row. Records keep the dictionary read access of the
+    previous API: ``record['key']``, ``get``, ``in``, ``len``, ``keys``,
+    ``items``... and compare equal to a dictionary with the same items.
+    Use :py:meth:`as_dict` to obtain a mutable copy. Being tuples, records
+    are encoded as JSON arrays by :py:mod:`json`: serialize
+    :py:meth:`_asdict` instead.
+
+    Subclasses define :py:attr:`_keys` and build their :py:attr:`_index`
+    with :py:func:`_key_index`. Most of them also define ``COLUMNS``, the
+    SELECT columns whose plain tuple rows are passed directly to the class,
+    e.g. ``Order(row)``. Building the records from the tuples returned by
+    sqlite3 avoids creating a :py:class:`sqlite3.Row` and a dictionary per
+    row.
+
+    '''
+    __slots__ = ()
+    #Keys of the record, in the order of the values
+    _keys = ()
+    #Position of the value of each key
+    _index = {}
+
+    def __getitem__(self, key):
+        try:
+            return tuple.__getitem__(self, self._index[key])
+        except TypeError:
+            #Unhashable keys are not keys of the record
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def get(self, key, default=None):
+        '''
+        :return: the value of ``key`` or ``default`` if the record does not
+            contain ``key``.
+        '''
+        index = self._index.get(key)
+        if index is None:
+            return default
+        return tuple.__getitem__(self, index)
+
+    def has_key(self, key):
+        return key in self._index
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return list(tuple.__iter__(self))
+
+    def items(self):
+        return zip(self._keys, tuple.__iter__(self))
+
+    def iterkeys(self):
+        return iter(self._keys)
+
+    def itervalues(self):
+        return tuple.__iter__(self)
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def as_dict(self):
+        '''
+        :return: a new dictionary with the items of the record. Nested
+            records are converted too.
+        '''
+        return dict((key, value.as_dict() if isinstance(value, Record)
+                     else value) for key, value in self.items())
+
+    def _asdict(self):
+        '''
+        :return: a new :py:class:`collections.OrderedDict` with the items of
+            the record in the order of its keys, as the ``_asdict`` of named
+            tuples. Nested records are converted too.
+        '''
+        return OrderedDict((key, value._asdict() if isinstance(value, Record)
+                            else value) for key, value in self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return self._keys == other._keys and tuple.__eq__(self, other)
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        return tuple.__hash__(self)
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, dict(self.items()))
+
+    def __reduce__(self):
+        return (type(self), (tuple(tuple.__iter__(self)),))
+
+
+def _key_index(keys):
+    '''
+    :return: dictionary with the position of each key of a :py:class:`Record`
+    '''
+    return dict((key, index) for index, key in enumerate(keys))
+
+
+class Order(Record):
+    '''
+    Order as returned by :py:meth:`Connection.get_order` and
+    :py:meth:`Connection.get_orders`. Check
+    :py:meth:`Connection._create_order_object`
+    '''
+    __slots__ = ()
+    _keys = ('order_id', 'nickname', 'sportname', 'timestamp')
+    _index = _key_index(_keys)
+    #Columns of the record. The order id is formatted by sqlite
+    COLUMNS = "'order-' || order_id, nickname, sportname, timestamp"
+
+
+class Sport(Record):
+    '''
+    Sport as listed by :py:meth:`Connection.get_sports`. Check
+    :py:meth:`Connection._create_sport_list_object`
+    '''
+    __slots__ = ()
+    _keys = ('sport_id', 'sportname', 'time', 'hallnumber', 'note')
+    _index = _key_index(_keys)
+    #Columns of the record
+    COLUMNS = 'sport_id, sportname, time, hallnumber, note'
+
+
+class SportProfile(Record):
+    '''
+    Sport as returned by :py:meth:`Connection.get_sport`. Check
+    :py:meth:`Connection._create_sport_object`
+    '''
+    __slots__ = ()
+    _keys = ('sport id', 'sport name', 'sport time', 'sporthall number',
+             'note')
+    _index = _key_index(_keys)
+    #Columns of the record
+    COLUMNS = Sport.COLUMNS
+
+
+class UserSummary(Record):
+    '''
+    User as listed by :py:meth:`Connection.get_users`. Check
+    :py:meth:`Connection._create_user_list_object`
+    '''
+    __slots__ = ()
+    _keys = ('nickname', 'regDate', 'lastLogin', 'timesviewed')
+    _index = _key_index(_keys)
+    #Columns of the record
+    COLUMNS = 'users.nickname, users.regDate, users.lastLogin, \
+               users.timesviewed'
+
+
+class PublicProfile(Record):
+    '''
+    ``public_profile`` of a :py:class:`UserProfile`
+    '''
+    __slots__ = ()
+    _keys = ('nickname', 'password', 'regDate', 'signature', 'avatar',
+             'userType')
+    _index = _key_index(_keys)
+
+
+class RestrictedProfile(Record):
+    '''
+    ``restricted_profile`` of a :py:class:`UserProfile`
+    '''
+    __slots__ = ()
+    _keys = ('firstname', 'lastname', 'email', 'website', 'gender')
+    _index = _key_index(_keys)
+
+
+class UserProfile(Record):
+    '''
+    User as returned by :py:meth:`Connection.get_user`. Check
+    :py:meth:`Connection._create_user_object`
+    '''
+    __slots__ = ()
+    _keys = ('public_profile', 'restricted_profile')
+    _index = _key_index(_keys)
+    #Columns read by from_row: those of PublicProfile followed by those of
+    #RestrictedProfile
+    COLUMNS = 'users.nickname, users.password, users.regDate, \
+               users_profile.signature, users_profile.avatar, \
+               users.userType, users_profile.firstname, \
+               users_profile.lastname, users_profile.email, \
+               users_profile.website, users_profile.gender'
+
+    @staticmethod
+    def from_row(row):
+        '''
+        Builds a UserProfile from a tuple with the columns in
+        :py:attr:`COLUMNS`
+        '''
+        return UserProfile((PublicProfile(row[:6]),
+                            RestrictedProfile(row[6:])))
+
+
+class TableVersions(Cache):
+    '''
+    Versions of the tables in :py:data:`VERSIONED_TABLES`, incremented in the
+    ``table_versions`` table by every write (check :py:func:`_bump_versions`)
+    and read by :py:meth:`sync` to notify the listeners of the tables changed
+    by any process. A new epoch (:py:data:`EPOCH`) means that the database
+    was created again. Without the ``table_versions`` table (check
+    :py:meth:`Engine.migrate`) :py:attr:`tracked` becomes False and the
+    caches depending on the versions are not used. Accessible through
+    :py:attr:`Engine.versions`.
+
+    '''
+    COUNTERS = ('syncs', 'changes')
+
+    def __init__(self):
+        super(TableVersions, self).__init__()
+        #Version of each table in the last sync
+        self._versions = {}
+        #Functions called when a table changes, by table name
+        self._listeners = {}
+        #Whether the database tracks the versions. None until the first sync
+        self.tracked = None
+
+    def listen(self, table, listener):
+        '''
+        Registers a function called without arguments when ``table``
+        changes.
+
+        :param str table: a table in :py:data:`VERSIONED_TABLES`
+        :param listener: function to call.
+        :raises ValueError: if the table is not versioned.
+
+        '''
+        if table not in VERSIONED_TABLES:
+            raise ValueError("Table %s is not versioned" % table)
+        with self._lock:
+            self._listeners.setdefault(table, []).append(listener)
+
+    def sync(self, con):
+        '''
+        Reads the versions of the tables and notifies the listeners of the
+        tables changed since the previous call.
+
+        :param con: sqlite3 connection to the database.
+        :return: set with the names of the tables that changed. All the
+            tables are returned by the first call after the
+            ``table_versions`` table is found missing.
+        :raises sqlite3.Error: if the versions could not be read for another
+            reason than a missing table.
+
+        '''
+        cur = con.cursor()
+        cur.row_factory = None
+        try:
+            cur.execute('SELECT table_name, version FROM table_versions')
+            versions = dict(cur.fetchall())
+        except sqlite3.OperationalError, excp:
+            if not _missing_table(excp):
+                raise
+            versions = None
+        with self._lock:
+            self.syncs += 1
+            if versions is None:
+                if self.tracked is False:
+                    return set()
+                self.tracked = False
+                self._versions = {}
+                changed = set(self._listeners)
+            else:
+                self.tracked = True
+                if versions == self._versions:
+                    return set()
+                if versions.get(EPOCH) != self._versions.get(EPOCH):
+                    changed = set(VERSIONED_TABLES)
+                else:
+                    changed = set(table for table in VERSIONED_TABLES
+                                  if versions.get(table) !=
+                                  self._versions.get(table))
+                self._versions = versions
+            self.changes += len(changed)
+            listeners = [listener for table in changed
+                         for listener in self._listeners.get(table, ())]
+        if versions is None:
+            print "Warning: the database has no table_versions table. " \
+                  "Run Engine.migrate() to see the changes of other " \
+                  "processes; the caches depending on it are disabled."
+        for listener in listeners:
+            listener()
+        return changed
+
+    def current(self, tables):
+        '''
+        :param tables: names of tables in :py:data:`VERSIONED_TABLES`
+        :return: tuple with the epoch and the versions of ``tables`` in the
+            last :py:meth:`sync`, or None if they are not known: there was
+            no sync yet or the database does not track the versions.
+        '''
+        #The dictionary is replaced, never modified, by sync
+        versions = self._versions
+        if not versions:
+            return None
+        get = versions.get
+        return (get(EPOCH),) + tuple(get(table) for table in tables)
+
+    def versions(self):
+        '''
+        :return: dictionary with the version of each table, and the epoch
+            (key :py:data:`EPOCH`), in the last :py:meth:`sync`
+        '''
+        with self._lock:
+            return dict(self._versions)
+
+    def _state(self):
+        return {'tracked': self.tracked}
+
+
+def _missing_table(excp):
+    '''
+    :param excp: a :py:class:`sqlite3.OperationalError`
+    :return: True if it was raised because a table does not exist.
+    '''
+    return 'no such table' in str(excp)
+
+
+def _bump_versions(cur, tables):
+    '''
+    Increments the version of ``tables`` in the ``table_versions`` table.
+    It is called once per write statement, in the same transaction, so a
+    statement writing many rows increments the versions only once.
+
+    Nothing is done if the database has no ``table_versions`` table. Check
+    :py:class:`TableVersions`.
+
+    :param cur: sqlite3 cursor of the transaction of the write.
+    :param tables: names of the tables written, in
+        :py:data:`VERSIONED_TABLES`. Include the tables modified by ON
+        DELETE actions too.
+    :raises sqlite3.Error: if the versions could not be incremented.
+
+    '''
+    try:
+        cur.execute('UPDATE table_versions SET version = version + 1 \
+                     WHERE table_name IN (%s)' %
+                    ','.join('?' * len(tables)), tuple(tables))
+    except sqlite3.OperationalError, excp:
+        if not _missing_table(excp):
+            raise
+
+
+def _read_versions(con, tables):
+    '''
+    :param con: sqlite3 connection to the database.
+    :param tables: names of tables in :py:data:`VERSIONED_TABLES`
+    :return: tuple with the epoch of the database and the versions of the
+        tables, or None if the database has no ``table_versions`` table.
+    '''
+    cur = con.cursor()
+    cur.row_factory = None
+    try:
+        cur.execute('SELECT table_name, version FROM table_versions')
+    except sqlite3.OperationalError:
+        return None
+    versions = dict(cur.fetchall())
+    return tuple(versions.get(table) for table in (EPOCH,) + tuple(tables))
+
+
+def _pack_records(rows):
+    '''
+    Serializes rows in a section of a snapshot file: the offsets of the rows
+    followed by the rows encoded with :py:mod:`marshal`.
+
+    :return: tuple ``(data, count)``
+    '''
+    blobs = [marshal.dumps(tuple(row)) for row in rows]
+    offsets = [0]
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+    return struct.pack('<%dI' % len(offsets), *offsets) + ''.join(blobs), \
+           len(blobs)
+
+
+class SnapshotView(object):
+    '''
+    Read-only mapping of a catalog snapshot file. Check
+    :py:class:`CatalogSnapshot`.
+
+    The records are decoded from the mapped file every time they are read,
+    so they are not kept in the memory of the process.
+
+    :param str path: path of the snapshot file.
+    :raises ValueError: if the file is not a valid snapshot.
+    :raises EnvironmentError: if the file cannot be opened.
+
+    '''
+    def __init__(self, path):
+        super(SnapshotView, self).__init__()
+        with open(path, 'rb') as f:
+            #Raises ValueError if the file is empty
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        start = len(SNAPSHOT_MAGIC) + 4
+        if self._map[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError("%s is not a catalog snapshot" % path)
+        length, = struct.unpack_from('<I', self._map, len(SNAPSHOT_MAGIC))
+        header = marshal.loads(self._map[start:start + length])
+        #marshal is not compatible between different Python versions
+        if header['marshal'] != marshal.version:
+            raise ValueError("%s was written by another Python" % path)
+        self.versions = header['versions']
+        self.size = len(self._map)
+        #(offset, count) of the sections
+        self._sports = header['sports']
+        self._users = header['users']
+        #Offset of the indexes of the sports sorted by sportname
+        self._sportnames = header['sportnames']
+
+    @staticmethod
+    def write(path, versions, sports, users):
+        '''
+        Writes a snapshot file.
+
+        :param str path: path of the file, which is overwritten.
+        :param tuple versions: versions of the :py:data:`SNAPSHOT_TABLES`
+            that the data was read from.
+        :param sports: rows of the sports, with the columns of
+            :py:class:`Sport`
+        :param users: rows of the users, with the columns of
+            :py:class:`UserSummary`
+
+        '''
+        sports = list(sports)
+        names = sorted(xrange(len(sports)), key=lambda index: sports[index][1])
+        sports_data, sports_count = _pack_records(sports)
+        users_data, users_count = _pack_records(users)
+        names_data = struct.pack('<%dI' % len(names), *names)
+        #The header size depends on the offsets, which depend on the header
+        #size: the offsets are encoded with a fixed size
+        header = {'marshal': marshal.version, 'versions': versions,
+                  'sports': (0, sports_count), 'users': (0, users_count),
+                  'sportnames': 0}
+        start = len(SNAPSHOT_MAGIC) + 4 + len(marshal.dumps(header))
+        header['sports'] = (start, sports_count)
+        header['sportnames'] = start + len(sports_data)
+        header['users'] = (header['sportnames'] + len(names_data),
+                           users_count)
+        header = marshal.dumps(header)
+        with open(path, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            f.write(sports_data)
+            f.write(names_data)
+            f.write(users_data)
+
+    def _row(self, section, index):
+        '''
+        Decodes the row ``index`` of a section.
+        '''
+        offset, count = section
+        first = offset + 4 * (count + 1)
+        begin, end = struct.unpack_from('<2I', self._map, offset + 4 * index)
+        return marshal.loads(self._map[first + begin:first + end])
+
+    def _iter_records(self, section, create_record):
+        '''
+        :return: an iterator creating a record for each row of a section.
+        '''
+        for index in xrange(section[1]):
+            yield create_record(self._row(section, index))
+
+    def sports(self):
+        '''
+        :return: an iterator over the :py:class:`Sport` records.
+        '''
+        return self._iter_records(self._sports, Sport)
+
+    def sport(self, sportname):
+        '''
+        Binary search of a sport by its sportname.
+
+        :return: the :py:class:`SportProfile` record or None if the sport
+            is not in the snapshot.
+        '''
+        low, high = 0, self._sports[1]
+        while low < high:
+            middle = (low + high) // 2
+            index, = struct.unpack_from('<I', self._map,
+                                        self._sportnames + 4 * middle)
+            row = self._row(self._sports, index)
+            if row[1] < sportname:
+                low = middle + 1
+            elif row[1] > sportname:
+                high = middle
+            else:
+                return SportProfile(row)
+        return None
+
+    def users(self):
+        '''
+        :return: an iterator over the :py:class:`UserSummary` records.
+        '''
+        return self._iter_records(self._users, UserSummary)
+
+    def close(self):
+        '''
+        Unmaps the file. The view cannot be read anymore.
+        '''
+        self._map.close()
+
+
+class CatalogSnapshot(Cache):
+    '''
+    Snapshot of the sports catalog and of the users list in a file mapped
+    read-only by all the processes of the host, which share its pages
+    instead of each one loading the catalog. Each file is named after the
+    epoch and the versions of the :py:data:`SNAPSHOT_TABLES` it was read
+    from and is written aside and renamed, so a mapped file is never
+    modified; the files of older versions are removed when a new one is
+    written, or later if they are still mapped on Windows. Accessible
+    through :py:attr:`Engine.snapshot` when the Engine has a
+    ``snapshot_path``.
+
+    :param str path: path of the snapshot files, to which their versions
+        are appended.
+
+    '''
+    COUNTERS = ('builds', 'loads', 'invalidations')
+
+    def __init__(self, path):
+        super(CatalogSnapshot, self).__init__()
+        self.path = path
+        #SnapshotView in use, and whether it must be checked against the
+        #versions of the database before being used again
+        self._view = None
+        self._stale = True
+
+    def view(self, con):
+        '''
+        Returns the snapshot of the current data of the database, mapping
+        the snapshot file or writing it if needed.
+
+        :param con: sqlite3 connection to the database.
+        :return: a :py:class:`SnapshotView` or None if the database does
+            not track the versions of the tables or the file cannot be
+            written.
+
+        '''
+        with self._lock:
+            if not self._stale:
+                return self._view
+            generation = self._generation
+            view = self._view
+        versions = _read_versions(con, SNAPSHOT_TABLES)
+        if versions is None:
+            return None
+        if view is None or view.versions != versions:
+            view = self._load(versions)
+            if view is None:
+                view = self._build(con, versions)
+                if view is None:
+                    return None
+        with self._lock:
+            self._view = view
+            if generation == self._generation:
+                self._stale = False
+        return view
+
+    def _file(self, versions):
+        '''
+        :return: the path of the snapshot file of ``versions``
+        '''
+        return '%s.%s' % (self.path, '-'.join(str(version)
+                                             for version in versions))
+
+    def _files(self):
+        '''
+        :return: list with the paths of the snapshot files, of any versions,
+            without the files being written.
+        '''
+        directory = os.path.dirname(self.path) or os.curdir
+        prefix = os.path.basename(self.path) + '.'
+        try:
+            names = os.listdir(directory)
+        except EnvironmentError:
+            return []
+        return [os.path.join(directory, name) for name in names
+                if name.startswith(prefix) and not name.endswith('.tmp')]
+
+    def _remove_files(self, keep=None):
+        '''
+        Removes the snapshot files but ``keep``. The files that cannot be
+        removed, e.g. because they are mapped on Windows, are left.
+        '''
+        for path in self._files():
+            if path != keep:
+                try:
+                    os.remove(path)
+                except EnvironmentError:
+                    pass
+
+    def _load(self, versions):
+        '''
+        Maps the snapshot file of ``versions`` if it exists.
+
+        :return: the :py:class:`SnapshotView` or None.
+        '''
+        try:
+            view = SnapshotView(self._file(versions))
+        except (EnvironmentError, ValueError, EOFError, KeyError):
+            return None
+        if view.versions != versions:
+            return None
+        with self._lock:
+            self.loads += 1
+        return view
+
+    def _build(self, con, versions):
+        '''
+        Writes the snapshot file from the database and maps it.
+
+        ``versions`` are read before the data, so if the tables change while
+        they are read the snapshot is older than its data and it is built
+        again in the next check.
+
+        :return: the :py:class:`SnapshotView` or None if the file cannot be
+            written.
+        '''
+        cur = con.cursor()
+        cur.row_factory = None
+        cur.execute('SELECT ' + Sport.COLUMNS + ' FROM sports')
+        sports = cur.fetchall()
+        cur.execute('SELECT ' + UserSummary.COLUMNS + ' FROM users \
+                     JOIN users_profile \
+                     ON users.user_id = users_profile.user_id')
+        users = cur.fetchall()
+        #Written aside and renamed, so readers never see a partial file. No
+        #one maps the file of these versions before it is renamed
+        path = self._file(versions)
+        tmp_path = '%s.%d-%d.tmp' % (self.path, os.getpid(),
+                                     threading.current_thread().ident)
+        try:
+            SnapshotView.write(tmp_path, versions, sports, users)
+            try:
+                os.rename(tmp_path, path)
+            except EnvironmentError:
+                #Another process wrote it first (Windows does not replace
+                #existing files)
+                if not os.path.exists(path):
+                    raise
+                os.remove(tmp_path)
+            view = SnapshotView(path)
+        except (EnvironmentError, ValueError), excp:
+            print "Error %s:" % excp
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None
+        self._remove_files(keep=path)
+        with self._lock:
+            self.builds += 1
+        return view
+
+    def invalidate(self):
+        '''
+        Marks the snapshot to be checked against the versions of the
+        database before it is used again.
+
+        '''
+        with self._lock:
+            self._invalidated()
+            self._stale = True
+
+    def remove(self):
+        '''
+        Drops the snapshot, unmaps it and removes the snapshot files. The
+        iterators over the snapshot cannot be used anymore.
+
+        '''
+        with self._lock:
+            self._generation += 1
+            view = self._view
+            self._view = None
+            self._stale = True
+        #A mapped file cannot be removed on Windows
+        if view is not None:
+            view.close()
+        self._remove_files()
+
+    def _state(self):
+        view = self._view
+        return {'path': self.path,
+                'versions': view.versions if view is not None else None,
+                'size': view.size if view is not None else 0}
+
+
+def _call_arguments(method):
+    '''
+    Precomputes how the arguments of a call to ``method`` are bound to its
+    parameters.
+
+    :param method: function with a fixed list of parameters, the first of
+        them ``self``.
+    :return: function taking the ``args`` and ``kwargs`` of a call, without
+        ``self``, and returning the tuple with the value of every parameter
+        of the method, in order, the same values bound by
+        :py:func:`inspect.getcallargs`. Calls passing the same values get
+        the same tuple, whatever the form of the call.
+    :raises ValueError: if the method takes ``*args`` or ``**kwargs``.
+
+    '''
+    spec = inspect.getargspec(method)
+    if spec.varargs is not None or spec.keywords is not None:
+        raise ValueError("Method %s takes a variable number of arguments" %
+                         method.__name__)
+    names = tuple(spec.args[1:])
+    count = len(names)
+    required = count - len(spec.defaults or ())
+    defaults = tuple(spec.defaults or ())
+    index = dict((name, position) for position, name in enumerate(names))
+
+    def bind(args, kwargs):
+        '''
+        :raises TypeError: if the arguments do not match the parameters.
+        '''
+        if not kwargs and len(args) == count:
+            return args
+        given = len(args)
+        if given > count:
+            raise TypeError("Too many arguments")
+        values = list(args) + list(defaults[given - required:]
+                                   if given > required else
+                                   (None,) * (required - given) + defaults)
+        for key, value in kwargs.iteritems():
+            position = index.get(key)
+            if position is None or position < given:
+                raise TypeError("Unexpected argument %s" % key)
+            values[position] = value
+        for position in xrange(given, required):
+            if names[position] not in kwargs:
+                raise TypeError("Missing argument %s" % names[position])
+        return tuple(values)
+    return bind
+
+
+def cached_result(*tables):
+    '''
+    Decorator marking a method of :py:class:`Connection` whose result may
+    be kept in the :py:class:`ResultCache` of the Engine.
+
+    The method must only read the given tables, its result must not depend
+    on anything else than its arguments and the data of those tables, and
+    its arguments must be hashable. Calls with unhashable arguments are not
+    cached, nor the calls of connections that did not sync the versions of
+    the tables (check :py:meth:`Connection.sync_caches`).
+
+    The key of a result is the value of every parameter, so
+    ``get_orders('chen')`` and ``get_orders(nickname='chen')`` share it,
+    and the epoch and versions of the tables in the last sync.
+
+    :Example:
+
+    >>> @cached_result('orders')
+    ... def get_order(self, order_id):
+
+    :param tables: names of the tables read by the method, in
+        :py:data:`VERSIONED_TABLES`.
+    :raises ValueError: if a table is not versioned or the method takes a
+        variable number of arguments.
+
+    '''
+    for table in tables:
+        if table not in VERSIONED_TABLES:
+            raise ValueError("Table %s is not versioned" % table)
+
+    def decorator(method):
+        name = method.__name__
+        bind = _call_arguments(method)
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            cache = self.result_cache
+            if cache is None or not cache.budget:
+                return method(self, *args, **kwargs)
+            #Without synced versions the writes of other processes are not
+            #seen. Check TableVersions
+            versions = self.engine.versions.current(tables)
+            if versions is None:
+                return method(self, *args, **kwargs)
+            try:
+                key = (name, bind(args, kwargs), versions)
+                hash(key)
+            except TypeError:
+                #The method raises the error of a wrong call
+                return method(self, *args, **kwargs)
+            return cache.get(key, tables,
+                             lambda: method(self, *args, **kwargs))
+        wrapper.cached_tables = tables
+        return wrapper
+    return decorator
 
 
 class Engine(object):
@@ -35,10 +1378,51 @@ class Engine(object):
     :param db_path: The path of the database file (always with respect to the
         calling script. If not specified, the Engine will use the file located
         at *db/forum.db*
+    :param str profile: name of the PRAGMA profile applied to every
+        connection (check :py:data:`PRAGMA_PROFILES`). If not specified the
+        *wal* profile is used.
+    :param int pool_size: maximum number of sqlite3 connections kept open by
+        the Engine.
+    :param float pool_timeout: seconds :py:meth:`connect` waits for a free
+        connection when all of them are in use.
+    :param float pool_idle_timeout: seconds after which an unused connection
+        is closed.
+    :param order_retention: seconds that an order is kept after it was
+        created. If None, orders never expire.
+    :param float retention_interval: seconds between two sweeps of the
+        :py:class:`OrderRetention` sweeper.
+    :param int retention_chunk_size: maximum number of orders that the
+        sweeper deletes per transaction.
+    :param float sports_cache_ttl: seconds that the sports catalog is
+        cached. Check :py:class:`SportsCache`. If 0, it is not cached.
+    :param int user_cache_size: maximum number of users cached. Check
+        :py:class:`UserCache`. If 0, users are not cached.
+    :param float user_cache_ttl: seconds that a user is cached.
+    :param str snapshot_path: path of the snapshot files of the catalog
+        shared by the processes of the host. Check
+        :py:class:`CatalogSnapshot`. If None, no snapshot is used.
+    :param int result_cache_bytes: maximum bytes of memory of the results
+        cached by the :py:class:`ResultCache`. If 0, no result is cached.
+    :param clock: function returning the current time in seconds, used for
+        the idle timeout of the connections and the times to live of the
+        caches. If not specified :py:func:`time.time` is used.
 
     '''
-    def __init__(self, db_path=None):
-        '''
+    def __init__(self, db_path=None, profile=DEFAULT_PROFILE,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 pool_timeout=DEFAULT_POOL_TIMEOUT,
+                 pool_idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT,
+                 order_retention=DEFAULT_ORDER_RETENTION,
+                 retention_interval=DEFAULT_SWEEP_INTERVAL,
+                 retention_chunk_size=DEFAULT_SWEEP_CHUNK_SIZE,
+                 sports_cache_ttl=DEFAULT_SPORTS_CACHE_TTL,
+                 user_cache_size=DEFAULT_USER_CACHE_SIZE,
+                 user_cache_ttl=DEFAULT_USER_CACHE_TTL,
+                 snapshot_path=None,
+                 result_cache_bytes=DEFAULT_RESULT_CACHE_BYTES,
+                 clock=time.time):
+        '''
+        :raises ValueError: if the profile does not exist.
         '''
 
         super(Engine, self).__init__()
@@ -46,25 +1430,122 @@ class Engine(object):
             self.db_path = db_path
         else:
             self.db_path = DEFAULT_DB_PATH
+        if profile not in PRAGMA_PROFILES:
+            raise ValueError("Unknown PRAGMA profile %s" % profile)
+        self.profile = profile
+        self.order_retention = order_retention
+        self.pool = ConnectionPool(self._create_connection, pool_size,
+                                   pool_timeout, pool_idle_timeout, clock)
+        #Not started until retention.start() is called
+        self.retention = OrderRetention(self, retention_interval,
+                                        retention_chunk_size)
+        self.sports_cache = SportsCache(sports_cache_ttl, clock)
+        self.user_cache = UserCache(user_cache_size, user_cache_ttl, clock)
+        self.result_cache = ResultCache(result_cache_bytes)
+        #Drops the cached data changed by other processes
+        self.versions = TableVersions()
+        self.versions.listen('sports', self.sports_cache.invalidate)
+        self.versions.listen('users', self.user_cache.invalidate)
+        self.versions.listen('users_profile', self.user_cache.invalidate)
+        for table in VERSIONED_TABLES:
+            self.versions.listen(table, functools.partial(
+                self.result_cache.invalidate, table))
+        self.snapshot = None
+        if snapshot_path is not None:
+            self.snapshot = CatalogSnapshot(snapshot_path)
+            for table in SNAPSHOT_TABLES:
+                self.versions.listen(table, self.snapshot.invalidate)
+
+    def _create_connection(self):
+        '''
+        Opens a new sqlite3 connection to be kept in the pool.
+
+        The connection may be used from several threads, but the pool
+        guarantees that only one of them uses it at a time.
+
+        '''
+        con = sqlite3.connect(self.db_path, check_same_thread=False,
+                              cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma, value in PRAGMA_PROFILES[self.profile]:
+            con.execute('PRAGMA %s = %s' % (pragma, value))
+        #Rows are accessed by column name in every query
+        con.row_factory = sqlite3.Row
+        return con
 
     def connect(self):
         '''
-        Creates a connection to the database.
+        Creates a connection to the database. The underlying sqlite3
+        connection is taken from the pool and returned to it by
+        :py:meth:`Connection.close`.
 
         :return: A Connection instance
         :rtype: Connection
+        :raises sqlite3.OperationalError: if no pooled connection gets free.
+
+        '''
+        return Connection(self.db_path, self)
+
+    def pool_stats(self):
+        '''
+        :return: the metrics of the connection pool. Check
+            :py:meth:`ConnectionPool.stats`
+        '''
+        return self.pool.stats()
+
+    def get_pragma_settings(self):
+        '''
+        :return: the PRAGMA values in effect in the connections of this
+            Engine, check :py:meth:`Connection.get_pragma_settings`, and the
+            name of its profile with the key ``profile``.
+        '''
+        con = self.connect()
+        try:
+            settings = con.get_pragma_settings()
+        finally:
+            con.close()
+        settings['profile'] = self.profile
+        return settings
+
+    def read_versions(self, tables=VERSIONED_TABLES):
+        '''
+        Reads the current versions of the tables with one query, without
+        notifying the caches as :py:meth:`TableVersions.sync` does.
+
+        :param tables: names of tables in :py:data:`VERSIONED_TABLES`
+        :return: tuple with the epoch of the database and the versions of
+            ``tables``, or None if the database does not track them.
+        '''
+        con = self.connect()
+        try:
+            return _read_versions(con.con, tables)
+        finally:
+            con.close()
+
+    def dispose(self):
+        '''
+        Closes the pooled connections. New connections are opened on demand.
 
         '''
-        return Connection(self.db_path)
+        self.pool.dispose()
 
     def remove_database(self):
         '''
         Removes the database file from the filesystem.
 
         '''
+        self.dispose()
+        self.sports_cache.invalidate()
+        self.user_cache.invalidate()
+        if self.snapshot is not None:
+            self.snapshot.remove()
+        self.result_cache.invalidate()
         if os.path.exists(self.db_path):
             #THIS REMOVES THE DATABASE STRUCTURE
             os.remove(self.db_path)
+        #Remove also the write-ahead log files of the wal profiles
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(self.db_path + suffix):
+                os.remove(self.db_path + suffix)
 
     def clear(self):
         '''
@@ -87,6 +1568,12 @@ class Engine(object):
             cur.execute("DELETE FROM friends")
             #NOTE since we have ON DELETE CASCADE BOTH IN users_profile AND
             #friends, WE DO NOT HAVE TO WORRY TO CLEAR THOSE TABLES.
+            _bump_versions(cur, VERSIONED_TABLES)
+        self.sports_cache.invalidate()
+        self.user_cache.invalidate()
+        self.result_cache.invalidate()
+        if self.snapshot is not None:
+            self.snapshot.invalidate()
 
     #METHODS TO CREATE AND POPULATE A DATABASE USING DIFFERENT SCRIPTS
     def create_tables(self, schema=None):
@@ -128,6 +1615,73 @@ class Engine(object):
             sql = f.read()
             cur = con.cursor()
             cur.executescript(sql)
+        with con:
+            _bump_versions(con.cursor(), VERSIONED_TABLES)
+        con.close()
+        self.sports_cache.invalidate()
+        self.user_cache.invalidate()
+        self.result_cache.invalidate()
+        if self.snapshot is not None:
+            self.snapshot.invalidate()
+
+    def migrate(self):
+        '''
+        Upgrade programmatically an existing database to the current schema.
+        It creates the indexes in :py:data:`ORDERS_INDEXES` and the
+        ``table_versions`` table (:py:data:`TABLE_VERSIONS_SCHEMA`) which
+        are missing, and drops the triggers of previous versions of the
+        schema (:py:data:`DROP_VERSION_TRIGGERS`). Existing data is not
+        modified.
+
+        Print an error message in the console if it could not be upgraded.
+
+        :return: ``True`` if the database was successfully upgraded or
+            ``False`` otherwise.
+
+        '''
+        con = sqlite3.connect(self.db_path)
+        try:
+            with con:
+                cur = con.cursor()
+                for stmnt in ORDERS_INDEXES + TABLE_VERSIONS_SCHEMA + \
+                             DROP_VERSION_TRIGGERS:
+                    cur.execute(stmnt)
+        except sqlite3.Error, excp:
+            print "Error %s:" % excp.args[0]
+            return False
+        finally:
+            con.close()
+        return True
+
+    def renew_epoch(self):
+        '''
+        Sets a new random epoch in the ``table_versions`` table (check
+        :py:data:`EPOCH`), so the caches and the ETags built from the
+        previous versions are not used. Call it after the database file is
+        restored from a backup, whose versions may have been reached before
+        with other data.
+
+        Print an error message in the console if it could not be changed.
+
+        :return: ``True`` if the epoch was changed or ``False`` otherwise.
+
+        '''
+        con = sqlite3.connect(self.db_path)
+        try:
+            with con:
+                cur = con.cursor()
+                cur.execute('UPDATE table_versions \
+                             SET version = abs(random() % 4294967296) \
+                             WHERE table_name = ?', (EPOCH,))
+                if cur.rowcount < 1:
+                    print "Error: the database has no epoch"
+                    return False
+        except sqlite3.Error, excp:
+            print "Error %s:" % excp.args[0]
+            return False
+        finally:
+            con.close()
+        return True
 
     #METHODS TO CREATE THE TABLES PROGRAMMATICALLY WITHOUT USING SQL SCRIPT
 	#METHODS TO CREATE THE SPORT TABLE
@@ -135,6 +1689,8 @@ class Engine(object):
         '''
         Create the table ``sports`` programmatically, without using .sql file.
 
+        The ``table_versions`` table is created too, if missing.
+
         Print an error message in the console if it could not be created.
 
         :return: ``True`` if the table was successfully created or ``False``
@@ -154,6 +1710,9 @@ class Engine(object):
                 cur.execute(keys_on)
                 #execute the statement
                 cur.execute(stmnt)
+                #track the changes of the table. Check TableVersions
+                for version_stmnt in TABLE_VERSIONS_SCHEMA:
+                    cur.execute(version_stmnt)
             except sqlite3.Error, excp:
                 print "Error %s:" % excp.args[0]
                 return False
@@ -164,6 +1723,8 @@ class Engine(object):
         '''
         Create the table ``order`` programmatically, without using .sql file.
 
+        The ``table_versions`` table is created too, if missing.
+
         Print an error message in the console if it could not be created.
 
         :return: ``True`` if the table was successfully created or ``False``
@@ -186,6 +1747,12 @@ class Engine(object):
                 cur.execute(keys_on)
                 #execute the statement
                 cur.execute(stmnt)
+                #create the secondary indexes
+                for index_stmnt in ORDERS_INDEXES:
+                    cur.execute(index_stmnt)
+                #track the changes of the table. Check TableVersions
+                for version_stmnt in TABLE_VERSIONS_SCHEMA:
+                    cur.execute(version_stmnt)
             except sqlite3.Error, excp:
                 print "Error %s:" % excp.args[0]
                 return False
@@ -196,6 +1763,8 @@ class Engine(object):
         '''
         Create the table ``users`` programmatically, without using .sql file.
 
+        The ``table_versions`` table is created too, if missing.
+
         Print an error message in the console if it could not be created.
 
         :return: ``True`` if the table was successfully created or ``False``
@@ -217,6 +1786,9 @@ class Engine(object):
                 cur.execute(keys_on)
                 #execute the statement
                 cur.execute(stmnt)
+                #track the changes of the table. Check TableVersions
+                for version_stmnt in TABLE_VERSIONS_SCHEMA:
+                    cur.execute(version_stmnt)
             except sqlite3.Error, excp:
                 print "Error %s:" % excp.args[0]
                 return False
@@ -228,6 +1800,8 @@ class Engine(object):
         Create the table ``users_profile`` programmatically, without using
         .sql file.
 
+        The ``table_versions`` table is created too, if missing.
+
         Print an error message in the console if it could not be created.
 
         :return: ``True`` if the table was successfully created or ``False``
@@ -254,6 +1828,9 @@ class Engine(object):
                 cur.execute(keys_on)
                 #execute the statement
                 cur.execute(stmnt)
+                #track the changes of the table. Check TableVersions
+                for version_stmnt in TABLE_VERSIONS_SCHEMA:
+                    cur.execute(version_stmnt)
             except sqlite3.Error, excp:
                 print "Error %s:" % excp.args[0]
                 return False
@@ -309,20 +1886,64 @@ class Connection(object):
 
     :param db_path: Location of the database file.
     :type dbpath: str
+    :param engine: Engine that created this connection. The sqlite3
+        connection is taken from its pool. If None, a new sqlite3 connection
+        is opened and the default settings are used.
+    :type engine: Engine
 
     '''
-    def __init__(self, db_path):
+    def __init__(self, db_path, engine=None):
         super(Connection, self).__init__()
-        self.con = sqlite3.connect(db_path)
+        self.engine = engine
+        self.pool = engine.pool if engine is not None else None
+        self.sports_cache = engine.sports_cache if engine is not None else None
+        self.user_cache = engine.user_cache if engine is not None else None
+        self.snapshot = engine.snapshot if engine is not None else None
+        self.result_cache = engine.result_cache if engine is not None \
+            else None
+        #True if the sqlite3 connection state was modified and it must not be
+        #reused
+        self._dirty = False
+        if self.pool is None:
+            self.con = sqlite3.connect(db_path)
+            self.con.execute('PRAGMA foreign_keys = ON')
+            self.con.row_factory = sqlite3.Row
+        else:
+            self.con = self.pool.checkout()
 
     def close(self):
         '''
-        Closes the database connection, commiting all changes.
+        Closes the database connection, commiting all changes. Pooled
+        connections are returned to the pool instead of being closed.
 
         '''
         if self.con:
-            self.con.commit()
-            self.con.close()
+            con = self.con
+            self.con = None
+            try:
+                con.commit()
+            except sqlite3.Error:
+                self._dirty = True
+                raise
+            finally:
+                if self.pool is not None:
+                    self.pool.checkin(con, discard=self._dirty)
+                else:
+                    con.close()
+
+    def sync_caches(self):
+        '''
+        Drops the data cached by the Engine that was changed by other
+        connections, including those of other processes. Check
+        :py:meth:`TableVersions.sync`. Call it once per request, before
+        reading.
+
+        :return: set with the names of the tables that changed.
+
+        '''
+        if self.engine is None:
+            return set()
+        return self.engine.versions.sync(self.con)
 
     #FOREIGN KEY STATUS
     def check_foreign_keys_status(self):
@@ -341,7 +1962,7 @@ class Connection(object):
             cur.execute('PRAGMA foreign_keys')
             #We know we retrieve just one record: use fetchone()
             data = cur.fetchone()
-            is_activated = data == (1,)
+            is_activated = data[0] == 1
             print "Foreign Keys status: %s" % 'ON' if is_activated else 'OFF'
         except sqlite3.Error, excp:
             print "Error %s:" % excp.args[0]
@@ -382,23 +2003,43 @@ class Connection(object):
             cur = self.con.cursor()
             #execute the pragma command, OFF
             cur.execute(keys_on)
+            #Do not give this connection to other users of the pool
+            self._dirty = True
             return True
         except sqlite3.Error, excp:
             print "Error %s:" % excp.args[0]
             return False
 
+    def get_pragma_settings(self):
+        '''
+        Reads the value of the PRAGMAs configured by the Engine profiles.
+
+        :return: a dictionary with the keys in :py:data:`REPORTED_PRAGMAS` and
+            the current values of those PRAGMAs in this connection.
+        :raises sqlite3.Error: when a sqlite3 error happen.
+
+        '''
+        cur = self.con.cursor()
+        settings = {}
+        for pragma in REPORTED_PRAGMAS:
+            cur.execute('PRAGMA %s' % pragma)
+            settings[pragma] = cur.fetchone()[0]
+        return settings
+
     #HELPERS
-    #Here the helpers that transform database rows into dictionary. They work
-    #similarly to ORM
+    #Here the helpers that transform database rows into records (read-only
+    #dictionaries, check Record). They work similarly to ORM. The queries of
+    #the API select the COLUMNS of the records and build them from the plain
+    #tuples instead.
 
     #Helpers for sports
     def _create_sport_object(self, row):
         '''
-        It takes a database Row and transform it into a python dictionary.
+        It takes a database Row and transform it into a :py:class:`SportProfile`.
 
         :param row: The row obtained from the database.
         :type row: sqlite3.Row
-        :return: a dictionary with the following format:
+        :return: a read-only dictionary with the following format:
 
 
             * ``sport_id``: spoort selection id
@@ -410,13 +2051,8 @@ class Connection(object):
             Note that all values are string if they are not otherwise indicated.
 
         '''
-        sport_id = row['sport_id']
-        return {'sport id': sport_id,
-		'sport name': row['sportname'],
-		'sport time': row['time'],
-		'sporthall number': row['hallnumber'],
-		'note': row['note']
-		}
+        return SportProfile((row['sport_id'], row['sportname'], row['time'],
+                             row['hallnumber'], row['note']))
 
     def _create_sport_list_object(self, row):
         '''
@@ -425,22 +2061,24 @@ class Connection(object):
 
         :param row: The row obtained from the database.
         :type row: sqlite3.Row
-        :return: a dictionary with the keys ``sportname`` and
-            ``time``
+        :return: a :py:class:`Sport` with the keys ``sport_id``,
+            ``sportname``, ``time``, ``hallnumber`` and ``note``
 
         '''
-        return {'sport_id': row['sport_id'], 'sportname': row['sportname'], 'time': row['time'], 'hallnumber': row['hallnumber'], 'note': row['note']}
+        return Sport((row['sport_id'], row['sportname'], row['time'],
+                      row['hallnumber'], row['note']))
 
 		
     #Helpers for orders
 
     def _create_order_object(self, row):
         '''
-        It takes a :py:class:`sqlite3.Row` and transform it into a dictionary.
+        It takes a :py:class:`sqlite3.Row` and transform it into an
+        :py:class:`Order`.
 
         :param row: The row obtained from the database.
         :type row: sqlite3.Row
-        :return: a dictionary containing the following keys:
+        :return: a read-only dictionary containing the following keys:
 
             * ``order_id``: id of the order (int)
             * ``sport_id``: sport to order
@@ -456,9 +2094,7 @@ class Connection(object):
         user = row['nickname']
         sportname = row['sportname']
         timestamp = row['timestamp']
-        order = {'order_id': order_id, 'nickname': user,
-                   'sportname': sportname, 'timestamp': timestamp}
-        return order
+        return Order((order_id, user, sportname, timestamp))
 
     def _create_order_list_object(self, row):
         '''
@@ -467,25 +2103,24 @@ class Connection(object):
 
         :param row: The row obtained from the database.
         :type row: sqlite3.Row
-        :return: a dictionary with the keys ``orderid``, ``user``,
-            ``timestamp`` and ``sport_id``.
+        :return: an :py:class:`Order` with the keys ``order_id``,
+            ``nickname``, ``sportname`` and ``timestamp``.
 
         '''
         order_id = 'order-' + str(row['order_id'])
         user = row['nickname']
         sport_name = row['sportname']
         timestamp = row['timestamp']
-        order = {'order_id': order_id, 'nickname': user,'timestamp': timestamp, 'sportname': sport_name}
-        return order
+        return Order((order_id, user, sport_name, timestamp))
 
     #Helpers for users
     def _create_user_object(self, row):
         '''
-        It takes a database Row and transform it into a python dictionary.
+        It takes a database Row and transform it into a :py:class:`UserProfile`.
 
         :param row: The row obtained from the database.
         :type row: sqlite3.Row
-        :return: a dictionary with the following format:
+        :return: a read-only dictionary with the following format:
 
             .. code-block:: javascript
 
@@ -518,18 +2153,13 @@ class Connection(object):
             Note that all values are string if they are not otherwise indicated.
 
         '''
-        return {'public_profile': {'nickname': row['nickname'],
-                                   'password': row['password'],
-                                   'regDate' : row['regDate'],
-                                   'signature': row['signature'],
-                                   'avatar': row['avatar'],
-                                   'userType': row['userType']},
-                'restricted_profile': {'firstname': row['firstname'],
-                                       'lastname': row['lastname'],
-                                       'email': row['email'],
-                                       'website': row['website'],
-                                       'gender': row['gender']}
-                }
+        return UserProfile((PublicProfile((row['nickname'], row['password'],
+                                           row['regDate'], row['signature'],
+                                           row['avatar'], row['userType'])),
+                            RestrictedProfile((row['firstname'],
+                                               row['lastname'], row['email'],
+                                               row['website'],
+                                               row['gender']))))
 
     def _create_user_list_object(self, row):
         '''
@@ -538,15 +2168,17 @@ class Connection(object):
 
         :param row: The row obtained from the database.
         :type row: sqlite3.Row
-        :return: a dictionary with the keys ``registrationdate`` and
-            ``nickname``
+        :return: a :py:class:`UserSummary` with the keys ``nickname``,
+            ``regDate``, ``lastLogin`` and ``timesviewed``
 
         '''
-        return {'nickname': row['nickname'], 'regDate': row['regDate'], 'lastLogin': row['lastLogin'], 'timesviewed': row['timesviewed']}
+        return UserSummary((row['nickname'], row['regDate'], row['lastLogin'],
+                            row['timesviewed']))
 
     #API ITSELF
 	
     #ORDER Table API.
+    @cached_result('orders')
     def get_order(self, order_id):
         '''
         Extracts a order from the database.
@@ -560,17 +2192,12 @@ class Connection(object):
 
         '''
         #Extracts the int which is the id for a order in the database
-        match = re.match(r'order-(\d{1,3})', order_id)
-        if match is None:
-            raise ValueError("The order_id is malformed")
-        order_id = int(match.group(1))
-        #Activate foreign key support
-        self.set_foreign_keys_support()
+        order_id = self._parse_order_id(order_id)
         #Create the SQL Query
-        query = 'SELECT * FROM orders WHERE order_id = ?'
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
+        query = 'SELECT ' + Order.COLUMNS + ' FROM orders WHERE order_id = ?'
+        #Cursor initialization. Plain tuples are returned
         cur = self.con.cursor()
+        cur.row_factory = None
         #Execute main SQL Statement
         pvalue = (order_id,)
         cur.execute(query, pvalue)
@@ -579,11 +2206,11 @@ class Connection(object):
         row = cur.fetchone()
         if row is None:
             return None
-        #Build the return object
-        return self._create_order_object(row)
+        return Order(row)
 
+    @cached_result('orders')
     def get_orders(self, nickname=None, number_of_orders=-1,
-                     before=-1, after=-1):
+                     before=-1, after=-1, cursor=None):
         '''
         Return a list of all the orders in the database filtered by the
         conditions provided in the parameters.
@@ -601,8 +2228,14 @@ class Connection(object):
         :param after: All timestamps < ``after`` (UNIX timestamp) are removed.
             If set to -1, this condition is not applied.
         :type after: long
-
-        :return: A list of orders. Each order is a dictionary containing
+        :param cursor: default None. Tuple ``(timestamp, order_id)`` of the
+            last order of the previous page. Only the orders that come after
+            it in the list are returned. If None, the list starts from the
+            newest order.
+        :type cursor: tuple
+
+        :return: A list of orders sorted by ``timestamp`` and ``order_id``,
+            newest first. Each order is a dictionary containing
             the following keys:
 
             * ``orderid``: string with the format order-\d{1,3}.Id of the
@@ -616,49 +2249,42 @@ class Connection(object):
             otherwise stated.
 
         :raises ValueError: if ``before`` or ``after`` are not valid UNIX
-            timestamps
+            timestamps or the ``order_id`` of the cursor is malformed.
 
         '''
-        #Create the SQL Statement build the string depending on the existence
-        #of nickname, numbero_of_orders, before and after arguments.
-        query = 'SELECT * FROM orders'
-          #Nickname restriction
-        if nickname is not None or before != -1 or after != -1:
-            query += ' WHERE'
-        if nickname is not None:
-            query += " nickname = '%s'" % nickname
-          #Before restriction
-        if before != -1:
-            if nickname is not None:
-                query += ' AND'
-            query += " timestamp < %s" % str(before)
-          #After restriction
-        if after != -1:
-            if nickname is not None or before != -1:
-                query += ' AND'
-            query += " timestamp > %s" % str(after)
-          #Order of results
-        query += ' ORDER BY timestamp DESC'
-          #Limit the number of resulst return
-        if number_of_orders > -1:
-            query += ' LIMIT ' + str(number_of_orders)
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
+        return list(self.iter_orders(nickname, number_of_orders, before,
+                                     after, cursor))
+
+    def iter_orders(self, nickname=None, number_of_orders=-1,
+                    before=-1, after=-1, cursor=None,
+                    batch=DEFAULT_FETCH_BATCH):
+        '''
+        Same as :py:meth:`get_orders`, but the orders are read from the
+        database ``batch`` rows at a time while they are consumed instead of
+        being loaded in a list.
+
+        The query is executed, and the arguments checked, when this method is
+        called. The returned iterator must be consumed before the connection
+        is closed.
+
+        :param int batch: number of rows fetched at once.
+        :return: an iterator over the orders.
+        :raises ValueError: check :py:meth:`get_orders`
+
+        '''
+        #Create the parameterized SQL Statement. Its text only depends on
+        #which of the arguments are used. Check OrdersQuery
+        if cursor is not None:
+            timestamp, order_id = cursor
+            cursor = (timestamp, self._parse_order_id(order_id))
+        query, pvalue = OrdersQuery.build(nickname, before, after, cursor,
+                                          number_of_orders)
+        #Cursor initialization. Plain tuples are returned
         cur = self.con.cursor()
+        cur.row_factory = None
         #Execute main SQL Statement
-        cur.execute(query)
-        #Get results
-        rows = cur.fetchall()
-        if rows is None:
-            return None
-        #Build the return object
-        orders = []
-        for row in rows:
-            order = self._create_order_list_object(row)
-            orders.append(order)
-        return orders
+        cur.execute(query, pvalue)
+        return self._iter_rows(cur, Order, batch)
 
     def delete_order(self, order_id):
         '''
@@ -671,10 +2297,7 @@ class Connection(object):
 
         '''
         #Extracts the int which is the id for a order in the database
-        match = re.match(r'order-(\d{1,3})', order_id)
-        if match is None:
-            raise ValueError("The order_id is malformed")
-        order_id = int(match.group(1))
+        order_id = self._parse_order_id(order_id)
         '''
         * HOW TO TEST: Use the database_api_tests_message. The following tests
           must pass without failure or error:
@@ -683,14 +2306,15 @@ class Connection(object):
             * test_delete_order_noexisting_id
         '''
         query = 'DELETE FROM orders WHERE order_id = ?'
-        self.set_foreign_keys_support()
-        self.con.row_factory = sqlite3.Row
         cur = self.con.cursor()
         pvalue = (order_id,)
         cur.execute(query,pvalue)
-        self.con.commit()
         if cur.rowcount < 1:
+            self.con.commit()
             return False
+        _bump_versions(cur, ('orders',))
+        self.con.commit()
+        self._orders_changed()
         return True
 
     def create_order(self, nickname,
@@ -703,10 +2327,14 @@ class Connection(object):
 
         :param str sport_id:which sport is ordered
 
-        :return: the id of the created order or None if the order was
-            not found. Note that it is a string with the format order-\d{1,3}.
+        :return: the id of the created order or False if the sport does
+            not exist. Note that it is a string with the format order-\d{1,3}.
 
-        :raises ForumDatabaseError: if the database could not be modified.
+        :raises sqlite3.Error: if the database could not be modified.
+
+        The orders older than the retention period of the Engine are removed
+        in the same transaction, unless the :py:class:`OrderRetention`
+        sweeper of the Engine is running.
 
         * HOW TO TEST: Use the database_api_tests_order. The following tests
                        must pass without failure or error:
@@ -718,21 +2346,8 @@ class Connection(object):
         _nickname = nickname
         _sportname = sportname
         
-        self.set_foreign_keys_support()
-        self.con.row_factory = sqlite3.Row
         cur = self.con.cursor()
-        query3 ='SELECT * FROM orders'
-        cur.execute(query3)
-        rows = cur.fetchall()
-        row = cur.fetchone()
-        for row in rows:
-            if int(_timestamp)-int(row["timestamp"]) > 1000*3600*24*7:
-				order_id=row["order_id"]
-				query4 = 'DELETE FROM orders WHERE order_id = ?'
-				pvalue4 = (order_id,)
-				cur.execute(query4,pvalue4)
-				self.con.commit()
-        query2 = 'SELECT * from sports WHERE sportname = ?'
+        query2 = 'SELECT sportname from sports WHERE sportname = ?'
         pvalue2 = (sportname,)
         cur.execute(query2,pvalue2)
         row = cur.fetchone()
@@ -741,12 +2356,26 @@ class Connection(object):
         else:
             _sportname = row["sportname"]
 
-        query1 = 'INSERT INTO orders(nickname,sportname,timestamp) VALUES(?,?,?)'
-        pvalue1 = (_nickname,_sportname,_timestamp)
-        # cur = self.con.cursor()
-        cur.execute(query1,pvalue1)
+        #Remove the expired orders. It is an index range scan on timestamp,
+        #executed in the same transaction as the insert.
+        retention = self._order_retention()
+        #Nothing is left pending if a statement fails
+        try:
+            if retention is not None:
+                query3 = 'DELETE FROM orders WHERE timestamp < ?'
+                pvalue3 = (_timestamp - retention,)
+                cur.execute(query3, pvalue3)
+            query1 = 'INSERT INTO orders(nickname,sportname,timestamp) \
+                      VALUES(?,?,?)'
+            pvalue1 = (_nickname,_sportname,_timestamp)
+            cur.execute(query1,pvalue1)
+            order_id = cur.lastrowid
+            _bump_versions(cur, ('orders',))
+        except sqlite3.Error:
+            self.con.rollback()
+            raise
         self.con.commit()
-        order_id = cur.lastrowid
+        self._orders_changed()
         
         if order_id is None:
             ordernumber = None
@@ -754,19 +2383,152 @@ class Connection(object):
             ordernumber = 'order-'+str(order_id)
         return ordernumber
 
+    def create_orders_bulk(self, orders):
+        '''
+        Create several orders in one transaction. It is equivalent to call
+        :py:meth:`create_order` for each order, but all the orders are
+        inserted with a single statement and committed once.
+
+        :param orders: sequence of ``(nickname, sportname)``
+        :return: list with the result of each order, in the same order:
+            the id of the created order (string with the format
+            order-\d{1,3}) or False if the sport or the user does not exist.
+        :raises ValueError: if an order is not a ``(nickname, sportname)``
+            pair. Nothing is inserted.
+        :raises sqlite3.Error: if the database could not be modified. The
+            transaction is rolled back.
+
+        '''
+        orders = list(orders)
+        for order in orders:
+            if not isinstance(order, (tuple, list)) or len(order) != 2:
+                raise ValueError("Orders must be (nickname, sportname) pairs")
+        timestamp = time.mktime(datetime.now().timetuple())
+        #Check which sports and users exist. A nickname may be None
+        sports = self._find_existing('sports', 'sportname',
+                                     [order[1] for order in orders])
+        users = self._find_existing('users', 'nickname',
+                                    [order[0] for order in orders])
+        valid = [(nickname, sportname, timestamp)
+                 for nickname, sportname in orders
+                 if sportname in sports and
+                 (nickname is None or nickname in users)]
+        cur = self.con.cursor()
+        try:
+            #Remove the expired orders, as create_order does
+            retention = self._order_retention()
+            expired = 0
+            if retention is not None:
+                cur.execute('DELETE FROM orders WHERE timestamp < ?',
+                            (timestamp - retention,))
+                expired = cur.rowcount
+            cur.executemany('INSERT INTO orders(nickname,sportname,timestamp) \
+                             VALUES(?,?,?)', valid)
+            #The transaction holds the write lock, so the new ids are
+            #consecutive and end at the last value of the sequence
+            last_id = 0
+            if valid:
+                cur.execute("SELECT seq FROM sqlite_sequence \
+                             WHERE name = 'orders'")
+                last_id = cur.fetchone()[0]
+            if valid or expired > 0:
+                _bump_versions(cur, ('orders',))
+        except sqlite3.Error:
+            self.con.rollback()
+            raise
+        self.con.commit()
+        self._orders_changed()
+        order_id = last_id - len(valid)
+        results = []
+        for nickname, sportname in orders:
+            if sportname in sports and (nickname is None or nickname in users):
+                order_id += 1
+                results.append('order-' + str(order_id))
+            else:
+                results.append(False)
+        return results
+
     #MESSAGE UTILS
-	
-    def get_orderuser(self, order_id):
-        match = re.match(r'order-(\d{1,3})', order_id)
+
+    def _iter_rows(self, cur, create_record, batch):
+        '''
+        Generator transforming the rows of an executed cursor, fetching
+        ``batch`` rows at a time.
+
+        :param cur: cursor with the statement already executed. Its rows must
+            be plain tuples.
+        :param create_record: record class, or function, building a record
+            from a tuple, e.g. :py:class:`Order`
+        :param int batch: number of rows fetched at once.
+
+        '''
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                break
+            for record in map(create_record, rows):
+                yield record
+
+    def _find_existing(self, table, column, values):
+        '''
+        Finds which of the ``values`` are in ``column`` of ``table``.
+
+        :param str table: name of the table. It must not come from the user.
+        :param str column: name of the column. It must not come from the user.
+        :param values: values to search. None values are ignored.
+        :return: set with the values found.
+
+        '''
+        values = list(set(value for value in values if value is not None))
+        found = set()
+        cur = self.con.cursor()
+        for start in xrange(0, len(values), MAX_IN_VALUES):
+            chunk = values[start:start + MAX_IN_VALUES]
+            query = 'SELECT %s FROM %s WHERE %s IN (%s)' % \
+                (column, table, column, ', '.join('?' * len(chunk)))
+            cur.execute(query, chunk)
+            found.update(row[0] for row in cur.fetchall())
+        return found
+
+    def _parse_order_id(self, order_id):
+        '''
+        Extracts the database id from an order id.
+
+        :param str order_id: id with the format ``order-\d+``
+        :return: the value of the ``order_id`` column.
+        :rtype: int
+        :raises ValueError: if ``order_id`` is malformed.
+
+        '''
+        match = re.match(r'order-(\d+)$', order_id)
         if match is None:
             raise ValueError("The order_id is malformed")
-        order_id = int(match.group(1))
-        #Activate foreign key support
-        self.set_foreign_keys_support()
+        return int(match.group(1))
+
+    def _orders_changed(self):
+        '''
+        Drops the cached results that read the orders table. Called after
+        a write to the orders table is committed.
+        '''
+        if self.result_cache is not None:
+            self.result_cache.invalidate('orders')
+
+    def _order_retention(self):
+        '''
+        :return: seconds that an order is kept or None if orders must not be
+            removed by this connection. Check :py:class:`Engine`
+        '''
+        if self.engine is None:
+            return DEFAULT_ORDER_RETENTION
+        if self.engine.retention.is_running():
+            return None
+        return self.engine.order_retention
+	
+    def get_orderuser(self, order_id):
+        order_id = self._parse_order_id(order_id)
         #Create the SQL Query
         query = 'SELECT * FROM orders WHERE order_id = ?'
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
+        #Cursor initialization
         cur = self.con.cursor()
         #Execute main SQL Statement
         pvalue = (order_id,)
@@ -802,26 +2564,45 @@ class Connection(object):
            . None is returned if the database
             has no users.
 
+        '''
+        return list(self.iter_sports())
+
+    def iter_sports(self, batch=DEFAULT_FETCH_BATCH):
+        '''
+        Same as :py:meth:`get_sports`, but the sports are read from the
+        database ``batch`` rows at a time while they are consumed. The
+        returned iterator must be consumed before the connection is closed.
+
+        If the Engine has a :py:class:`CatalogSnapshot`, the sports are read
+        from it instead. Otherwise, if the catalog is cached by the Engine,
+        they are read from the :py:class:`SportsCache`.
+
+        :param int batch: number of rows fetched at once.
+        :return: an iterator over the sports.
+
+        '''
+        view = self._snapshot_view()
+        if view is not None:
+            return view.sports()
+        catalog = self._cached_sports()
+        if catalog is not None:
+            return iter(catalog[0])
+        return self._select_sports(batch)
+
+    def _select_sports(self, batch):
+        '''
+        Reads the sports from the database. Check :py:meth:`iter_sports`
         '''
         #Create the SQL Statements
-          #SQL Statement for retrieving the users
-        query = 'SELECT * FROM sports'
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Create the cursor
-        self.con.row_factory = sqlite3.Row
+          #SQL Statement for retrieving the sports
+        query = 'SELECT ' + Sport.COLUMNS + ' FROM sports'
+        #Create the cursor. Plain tuples are returned
         cur = self.con.cursor()
+        cur.row_factory = None
         #Execute main SQL Statement
         cur.execute(query)
         #Process the results
-        rows = cur.fetchall()
-        if rows is None:
-            return None
-        #Process the response.
-        sports = []
-        for row in rows:
-            sports.append(self._create_sport_list_object(row))
-        return sports
+        return self._iter_rows(cur, Sport, batch)
 
     def get_sport(self, sportname):
         '''
@@ -832,35 +2613,29 @@ class Connection(object):
             :py:meth:`_create_sport_object`
 
         '''
-        #Create the SQL Statements
-          #SQL Statement for retrieving the sport given a sportname
-        query1 = 'SELECT sport_id from sports WHERE sportname = ?'
-          #SQL Statement for retrieving the sport information
-        query2 = 'SELECT sports.* FROM sports \
-                  WHERE sports.sport_id = ?'
-          #Variable to be used in the second query.
-        sport_id = None
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
+        #Served by the CatalogSnapshot or the SportsCache of the Engine
+        view = self._snapshot_view()
+        if view is not None:
+            return view.sport(sportname)
+        catalog = self._cached_sports()
+        if catalog is not None:
+            return catalog[1].get(sportname)
+        #Create the SQL Statement
+          #SQL Statement for retrieving the sport given a sportname. It uses
+          #the UNIQUE index of sportname.
+        query = 'SELECT ' + SportProfile.COLUMNS + ' \
+                 FROM sports WHERE sportname = ?'
+        #Cursor initialization. Plain tuples are returned
         cur = self.con.cursor()
-        #Execute SQL Statement to retrieve the id given a sportname
+        cur.row_factory = None
+        #Execute SQL Statement
         pvalue = (sportname,)
-        cur.execute(query1, pvalue)
-        #Extract the sport id
+        cur.execute(query, pvalue)
+        #Process the response. Only one posible row is expected.
         row = cur.fetchone()
         if row is None:
             return None
-        sport_id = row["sport_id"]
-        # Execute the SQL Statement to retrieve the sport invformation.
-        # Create first the valuse
-        pvalue = (sport_id, )
-        #execute the statement
-        cur.execute(query2, pvalue)
-        #Process the response. Only one posible row is expected.
-        row = cur.fetchone()
-        return self._create_sport_object(row)
+        return SportProfile(row)
 
     def delete_sport(self, sportname):
         '''
@@ -875,18 +2650,19 @@ class Connection(object):
         #Create the SQL Statements
           #SQL Statement for deleting the sport information
         query = 'DELETE FROM sports WHERE sportname = ?'
-        #Activate foreign key support
-        #self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
+        #Cursor initialization
         cur = self.con.cursor()
         #Execute the statement to delete
         pvalue = (sportname,)
         cur.execute(query, pvalue)
-        self.con.commit()
         #Check that it has been deleted
         if cur.rowcount < 1:
+            self.con.commit()
             return False
+        #Its orders are deleted by ON DELETE CASCADE
+        _bump_versions(cur, ('sports', 'orders'))
+        self.con.commit()
+        self._sports_changed()
         return True
 
     def append_sport(self, sportname, sport):
@@ -932,10 +2708,7 @@ class Connection(object):
         _number = sport.get('sporthall number', None)
         _note = sport.get('note', None)
         
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
+        #Cursor initialization
         cur = self.con.cursor()
         #Execute the statement to extract the id associated to a nickname
         pvalue = (sportname,)
@@ -948,13 +2721,109 @@ class Connection(object):
             # Execute the statement
             pvalue = (sportname, _sport_time, _number, _note)
             cur.execute(query2, pvalue)
-
+            _bump_versions(cur, ('sports',))
             self.con.commit()
+            self._sports_changed()
             #We do not do any comprobation and return the sportname
             return sportname
         else:
             return False
 
+    def append_sports_bulk(self, sports):
+        '''
+        Create several sports in one transaction. It is equivalent to call
+        :py:meth:`append_sport` for each sport, but all the sports are
+        inserted with a single statement and committed once.
+
+        :param sports: sequence of ``(sportname, sport)``, where ``sport`` is
+            a dictionary with the format of :py:meth:`append_sport`
+        :return: list with the result of each sport, in the same order: the
+            sportname or False if a sport with that name already exists in
+            the database or earlier in ``sports``.
+        :raises ValueError: if a sport is not well formed. Nothing is
+            inserted.
+        :raises sqlite3.Error: if the database could not be modified. The
+            transaction is rolled back.
+
+        '''
+        sports = list(sports)
+        for sport in sports:
+            if not isinstance(sport, (tuple, list)) or len(sport) != 2 or \
+               not sport[0] or not isinstance(sport[1], dict):
+                raise ValueError("Sports must be (sportname, sport) pairs")
+        existing = self._find_existing('sports', 'sportname',
+                                       [sportname for sportname, _ in sports])
+        results = []
+        pvalues = []
+        for sportname, sport in sports:
+            if sportname in existing:
+                results.append(False)
+                continue
+            existing.add(sportname)
+            results.append(sportname)
+            pvalues.append((sportname, sport.get('sport time', None),
+                            sport.get('sporthall number', None),
+                            sport.get('note', None)))
+        cur = self.con.cursor()
+        try:
+            cur.executemany('INSERT INTO sports(sportname,time,hallnumber,note)\
+                             VALUES(?,?,?,?)', pvalues)
+            if pvalues:
+                _bump_versions(cur, ('sports',))
+        except sqlite3.Error:
+            self.con.rollback()
+            raise
+        self.con.commit()
+        if pvalues:
+            self._sports_changed()
+        return results
+
+    def _cached_sports(self):
+        '''
+        :return: the sports catalog from the :py:class:`SportsCache` of the
+            Engine, loading it if needed, or None if the catalog is not
+            cached. Check :py:meth:`SportsCache.get`
+        '''
+        if self.sports_cache is None or not self.sports_cache.ttl:
+            return None
+        return self.sports_cache.get(self._load_catalog)
+
+    def _load_catalog(self):
+        '''
+        :return: the sports catalog: a tuple with the :py:class:`Sport`
+            records and a dictionary of :py:class:`SportProfile` by
+            sportname.
+        '''
+        sports = tuple(self._select_sports(DEFAULT_FETCH_BATCH))
+        #Sport and SportProfile have the same columns
+        profiles = dict((sport['sportname'], SportProfile(sport.itervalues()))
+                        for sport in sports)
+        return sports, profiles
+
+    def _sports_changed(self):
+        '''
+        Invalidates the cached sports catalog, the catalog snapshot and the
+        cached results. Called after a write to the sports table is
+        committed.
+        '''
+        if self.sports_cache is not None:
+            self.sports_cache.invalidate()
+        if self.snapshot is not None:
+            self.snapshot.invalidate()
+        #Deleting a sport deletes its orders
+        if self.result_cache is not None:
+            self.result_cache.invalidate('sports', 'orders')
+
+    def _snapshot_view(self):
+        '''
+        :return: the current :py:class:`SnapshotView` of the
+            :py:class:`CatalogSnapshot` of the Engine, or None if there is
+            no snapshot. Check :py:meth:`CatalogSnapshot.view`
+        '''
+        if self.snapshot is None:
+            return None
+        return self.snapshot.view(self.con)
+
 
     #ACCESSING THE USER and USER_PROFILE tables
     def get_users(self):
@@ -967,26 +2836,35 @@ class Connection(object):
             has no users.
 
         '''
+        return list(self.iter_users())
+
+    def iter_users(self, batch=DEFAULT_FETCH_BATCH):
+        '''
+        Same as :py:meth:`get_users`, but the users are read from the
+        database ``batch`` rows at a time while they are consumed. The
+        returned iterator must be consumed before the connection is closed.
+
+        If the Engine has a :py:class:`CatalogSnapshot`, the users are read
+        from it instead.
+
+        :param int batch: number of rows fetched at once.
+        :return: an iterator over the users.
+
+        '''
+        view = self._snapshot_view()
+        if view is not None:
+            return view.users()
         #Create the SQL Statements
           #SQL Statement for retrieving the users
-        query = 'SELECT users.*, users_profile.* FROM users, users_profile \
-                 WHERE users.user_id = users_profile.user_id'
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Create the cursor
-        self.con.row_factory = sqlite3.Row
+        query = 'SELECT ' + UserSummary.COLUMNS + ' FROM users \
+                 JOIN users_profile ON users.user_id = users_profile.user_id'
+        #Create the cursor. Plain tuples are returned
         cur = self.con.cursor()
+        cur.row_factory = None
         #Execute main SQL Statement
         cur.execute(query)
         #Process the results
-        rows = cur.fetchall()
-        if rows is None:
-            return None
-        #Process the response.
-        users = []
-        for row in rows:
-            users.append(self._create_user_list_object(row))
-        return users
+        return self._iter_rows(cur, UserSummary, batch)
 
     def get_user(self, nickname):
         '''
@@ -997,36 +2875,34 @@ class Connection(object):
             :py:meth:`_create_user_object`
 
         '''
-        #Create the SQL Statements
-          #SQL Statement for retrieving the user given a nickname
-        query1 = 'SELECT user_id from users WHERE nickname = ?'
-          #SQL Statement for retrieving the user information
-        query2 = 'SELECT users.*, users_profile.* FROM users, users_profile \
-                  WHERE users.user_id = ? \
-                  AND users_profile.user_id = users.user_id'
-          #Variable to be used in the second query.
-        user_id = None
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
+        #Served by the UserCache of the Engine if users are cached
+        if self.user_cache is not None and self.user_cache.capacity:
+            return self.user_cache.get(nickname, self._select_user)
+        return self._select_user(nickname)
+
+    def _select_user(self, nickname):
+        '''
+        Reads a user from the database. Check :py:meth:`get_user`
+        '''
+        #Create the SQL Statement
+          #SQL Statement for retrieving the user information given a
+          #nickname. It uses the UNIQUE index of nickname and then the
+          #primary key of users_profile.
+        query = 'SELECT ' + UserProfile.COLUMNS + ' \
+                 FROM users JOIN users_profile \
+                 ON users_profile.user_id = users.user_id \
+                 WHERE users.nickname = ?'
+        #Cursor initialization. Plain tuples are returned
         cur = self.con.cursor()
-        #Execute SQL Statement to retrieve the id given a nickname
+        cur.row_factory = None
+        #Execute SQL Statement
         pvalue = (nickname,)
-        cur.execute(query1, pvalue)
-        #Extract the user id
+        cur.execute(query, pvalue)
+        #Process the response. Only one posible row is expected.
         row = cur.fetchone()
         if row is None:
             return None
-        user_id = row["user_id"]
-        # Execute the SQL Statement to retrieve the user invformation.
-        # Create first the valuse
-        pvalue = (user_id, )
-        #execute the statement
-        cur.execute(query2, pvalue)
-        #Process the response. Only one posible row is expected.
-        row = cur.fetchone()
-        return self._create_user_object(row)
+        return UserProfile.from_row(row)
 
     def delete_user(self, nickname, password):
         '''
@@ -1043,10 +2919,7 @@ class Connection(object):
         query0 = 'select * from users where nickname = ?'
         query1 = 'DELETE FROM users WHERE nickname = ? And password = ?'
         query2 = 'DELETE FROM users_profile WHERE user_id = ?'
-        #Activate foreign key support
-        #self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
+        #Cursor initialization
         cur = self.con.cursor()
         #Execute the statement to delete
         pvalue = (nickname,)
@@ -1060,12 +2933,17 @@ class Connection(object):
         print user_id
         pvalue = (nickname, password)
         cur.execute(query1, pvalue)
+        #Check that it has been deleted. The rowcount of the users table is
+        #used because the profile may already be removed by ON DELETE CASCADE
+        if cur.rowcount < 1:
+            self.con.commit()
+            return False
         pvalue = (user_id,)
         cur.execute(query2, pvalue)
+        #Its orders are modified by ON DELETE SET NULL
+        _bump_versions(cur, ('users', 'users_profile', 'orders'))
         self.con.commit()
-        #Check that it has been deleted
-        if cur.rowcount < 1:
-            return False
+        self._user_changed(nickname)
         return True
 
     def modify_user(self, nickname, user):
@@ -1150,10 +3028,7 @@ class Connection(object):
         _residence = None
         _signature = p_profile.get('signature', None)
         _avatar = p_profile.get('avatar', None)
-        #Activate foreign key support
-        self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
+        #Cursor initialization
         cur = self.con.cursor()
         #Execute the statement to extract the id associated to a nickname
         pvalue = (nickname,)
@@ -1170,10 +3045,13 @@ class Connection(object):
                       _mobile, _skype, _age, _residence, _gender,
                       _signature, _avatar, user_id)
             cur.execute(query2, pvalue)
-            self.con.commit()
             #Check that I have modified the user
             if cur.rowcount < 1:
+                self.con.commit()
                 return None
+            _bump_versions(cur, ('users_profile',))
+            self.con.commit()
+            self._user_changed(nickname)
             return nickname
 
 
@@ -1227,12 +3105,12 @@ class Connection(object):
         query2 = 'INSERT INTO users(nickname,password,regDate,lastLogin,timesviewed,userType)\
                   VALUES(?,?,?,?,?,?)'
           #SQL Statement to create the row in user_profile table
-        query3 = 'INSERT INTO users_profile (firstname,lastname, \
+        query3 = 'INSERT INTO users_profile (user_id,firstname,lastname, \
                                              email,website, \
                                              picture,mobile, \
                                              skype,age,residence, \
                                              gender,signature,avatar)\
-                  VALUES (?,?,?,?,?,?,?,?,?,?,?,?)'
+                  VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)'
         
         #temporal variables for user table
         #timestamp will be used for lastlogin and regDate.
@@ -1272,10 +3150,7 @@ class Connection(object):
         _skype = None
         _age = None
         _residence = None
-        #Activate foreign key support
-        #self.set_foreign_keys_support()
-        #Cursor and row initialization
-        self.con.row_factory = sqlite3.Row
+        #Cursor initialization
         cur = self.con.cursor()
         #Execute the statement to extract the id associated to a nickname
         pvalue = (nickname,)
@@ -1292,16 +3167,107 @@ class Connection(object):
             lid = cur.lastrowid
             #Add the row in users_profile table
             # Execute the statement
-            pvalue = (_firstname, _lastname, _email, _website,
+            pvalue = (lid, _firstname, _lastname, _email, _website,
                       _picture, _mobile, _skype, _age, _residence, _gender,
                       _signature, _avatar)
             cur.execute(query3, pvalue)
+            _bump_versions(cur, ('users', 'users_profile'))
             self.con.commit()
+            #The nickname may be cached as a missing user
+            self._user_changed(nickname)
             #We do not do any comprobation and return the nickname
             return nickname
         else:
             return None
 
+    def append_users_bulk(self, users):
+        '''
+        Create several users in one transaction. It is equivalent to call
+        :py:meth:`append_user` for each user, but the users and their
+        profiles are inserted with two statements and committed once.
+
+        :param users: sequence of ``(nickname, user)``, where ``user`` is a
+            dictionary with the format of :py:meth:`append_user`
+        :return: list with the result of each user, in the same order: the
+            nickname or None if a user with that nickname already exists in
+            the database or earlier in ``users``.
+        :raises ValueError: if a user is not well formed. Nothing is
+            inserted.
+        :raises sqlite3.Error: if the database could not be modified. The
+            transaction is rolled back.
+
+        '''
+        users = list(users)
+        for user in users:
+            if not isinstance(user, (tuple, list)) or len(user) != 2 or \
+               not user[0] or not isinstance(user[1], dict) or \
+               'public_profile' not in user[1] or \
+               'restricted_profile' not in user[1]:
+                raise ValueError("Users must be (nickname, user) pairs with "
+                                 "public and restricted profiles")
+        #timestamp will be used for lastlogin, as in append_user
+        timestamp = time.mktime(datetime.now().timetuple())
+        existing = self._find_existing('users', 'nickname',
+                                       [nickname for nickname, _ in users])
+        results = []
+        users_values = []
+        profiles_values = []
+        for nickname, user in users:
+            if nickname in existing:
+                results.append(None)
+                continue
+            existing.add(nickname)
+            results.append(nickname)
+            p_profile = user['public_profile']
+            r_profile = user['restricted_profile']
+            users_values.append((nickname, p_profile.get('password'),
+                                 p_profile.get('regDate'), timestamp, 0,
+                                 p_profile.get('userType', None)))
+            profiles_values.append((r_profile.get('firstname', None),
+                                    r_profile.get('lastname', None),
+                                    r_profile.get('email', None),
+                                    r_profile.get('website', None),
+                                    r_profile.get('gender', None),
+                                    p_profile.get('signature', None),
+                                    p_profile.get('avatar', None),
+                                    nickname))
+        cur = self.con.cursor()
+        try:
+            cur.executemany('INSERT INTO users(nickname,password,regDate,\
+                                               lastLogin,timesviewed,userType)\
+                             VALUES(?,?,?,?,?,?)', users_values)
+            #The profile takes the user_id of the user just inserted
+            cur.executemany('INSERT INTO users_profile(user_id,firstname,\
+                                                       lastname,email,website,\
+                                                       gender,signature,avatar)\
+                             SELECT user_id,?,?,?,?,?,?,? FROM users \
+                             WHERE nickname = ?', profiles_values)
+            if users_values:
+                _bump_versions(cur, ('users', 'users_profile'))
+        except sqlite3.Error:
+            self.con.rollback()
+            raise
+        self.con.commit()
+        #The nicknames may be cached as missing users
+        for nickname in results:
+            if nickname is not None:
+                self._user_changed(nickname)
+        return results
+
+    def _user_changed(self, nickname):
+        '''
+        Drops a user from the :py:class:`UserCache` of the Engine and
+        invalidates the catalog snapshot and the cached results. Called
+        after a write to the users tables is committed.
+        '''
+        if self.user_cache is not None:
+            self.user_cache.invalidate(nickname)
+        if self.snapshot is not None:
+            self.snapshot.invalidate()
+        #Deleting a user modifies its orders
+        if self.result_cache is not None:
+            self.result_cache.invalidate('users', 'users_profile', 'orders')
+
     # UTILS
 
     def get_user_id(self, nickname):
@@ -1331,8 +3297,6 @@ class Connection(object):
                 * test_get_user_id
                 * test_get_user_id_unknown_user
         '''
-        self.set_foreign_keys_support()
-        self.con.row_factory = sqlite3.Row
         cur = self.con.cursor()
         
         query = 'SELECT user_id from users WHERE nickname = ?'
@@ -1351,9 +3315,18 @@ class Connection(object):
         return self.get_user_id(nickname) is not None
 
     def login(self, nickname, password):
-        self.con.row_factory = sqlite3.Row
+        '''
+        Checks the credentials of a user.
+
+        :param str nickname: The nickname of the user.
+        :param str password: The password of the user.
+        :return: a row with the columns ``nickname`` and ``userType`` if the
+            credentials are correct, False otherwise.
+
+        '''
         cur = self.con.cursor()
-        stmnt = 'select * from users where nickname=? and password=?'
+        stmnt = 'SELECT nickname, userType FROM users \
+                 WHERE nickname = ? AND password = ?'
         pvalue = (nickname,password)
         cur.execute(stmnt, pvalue)
         row = cur.fetchone()
@@ -6,14 +6,20 @@ Modified on 09.03.2016
 @modified: chenhaoyu, zhoujunjie
 '''
 #TODO: Create another file
-import json
+import json, re, threading, uuid, itertools
+from collections import OrderedDict
+from json.encoder import encode_basestring_ascii
 
 from flask import Flask, request, Response, g, jsonify, _request_ctx_stack, redirect
+from flask import stream_with_context, after_this_request
+from flask import has_request_context
+from flask.json import JSONEncoder
 from flask.ext.restful import Resource, Api, abort
 from flask.ext.cors import CORS
 from werkzeug.exceptions import NotFound,  UnsupportedMediaType
+from werkzeug.urls import url_quote
 
-from utils import RegexConverter
+from utils import RegexConverter, CACHE_TAGS_HEADER, CACHE_INVALIDATE_HEADER
 import database
 import logging
 
@@ -24,13 +30,46 @@ FORUM_USER_PROFILE ="/profiles/user-profile"
 FORUM_ORDER_PROFILE = "/profiles/order-profile"
 ATOM_THREAD_PROFILE = "https://tools.ietf.org/html/rfc4685"
 APIARY_PROFILES_URL = "http://docs.pwpforumappcomplete.apiary.io/#reference/profiles/"
+#Minimum size in bytes of each chunk written by the streaming responses
+STREAM_CHUNK_SIZE = 8192
+#Maximum number of bookings in a request to BookSportBatch
+MAX_BATCH_BOOKINGS = 1000
+#Values used in URLs without quoting. Check URLTemplate
+_URL_SAFE = re.compile(r'^[A-Za-z0-9_.~/:-]*$')
+#Maximum number of items kept by a FragmentCache under each script root
+DEFAULT_FRAGMENT_CACHE_SIZE = 20000
+
+class RecordJSONEncoder(JSONEncoder):
+    '''
+    JSON encoder of the application (``jsonify``). It encodes the records of
+    :py:mod:`forum.database` as objects: being tuples, they would be encoded
+    as arrays.
+    '''
+    def iterencode(self, o, _one_shot=False):
+        return super(RecordJSONEncoder, self).iterencode(_plain(o), _one_shot)
+
+def _plain(value):
+    '''
+    :return: ``value`` with its records replaced by their
+        :py:meth:`forum.database.Record._asdict`
+    '''
+    if isinstance(value, database.Record):
+        return value._asdict()
+    if isinstance(value, dict):
+        return dict((key, _plain(item)) for key, item in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_plain(item) for item in value]
+    return value
 
 #Define the application and the api
 app = Flask(__name__)
 app.debug = True
+app.json_encoder = RecordJSONEncoder
 # Set the database Engine. In order to modify the database file (e.g. for
 # testing) provide the database path   app.config to modify the
 #database to be used (for instance for testing)
+#forum.py replaces it with an Engine sharing the catalog snapshot between
+#the worker processes of the host (check database.CatalogSnapshot)
 app.config.update({'Engine': database.Engine()})
 #Start the RESTful API.
 api = Api(app)
@@ -64,6 +103,528 @@ def create_error_response(status_code, title, message=None):
     response.status_code = status_code
     return response
 
+#RENDERING
+def _encode_float(value):
+    #Same output as json.dumps, which only differs from repr for nan and inf
+    if value - value == 0:
+        return repr(value)
+    return json.dumps(value)
+
+#JSON encoding of the values of the database, by type. Other types use
+#json.dumps
+_VALUE_ENCODERS = {
+    str: encode_basestring_ascii,
+    unicode: encode_basestring_ascii,
+    int: str,
+    long: str,
+    float: _encode_float,
+    bool: lambda value: 'true' if value else 'false',
+    type(None): lambda value: 'null',
+}
+
+def encode_value(value):
+    '''
+    Encodes a value as JSON text, with the same result as ``json.dumps``.
+    '''
+    encoder = _VALUE_ENCODERS.get(type(value))
+    if encoder is None:
+        return json.dumps(value)
+    return encoder(value)
+
+
+class FragmentCache(object):
+    '''
+    Cache of the JSON text of the items rendered by an
+    :py:class:`ItemEncoder`, so a collection that changed a little is
+    assembled from the items already rendered and only the new or modified
+    items are rendered again.
+
+    The fragments are kept by values of the record, apart for each script
+    root of the request, which is resolved once per collection. A record
+    holds the id of the entity and all the values that are rendered, so it
+    is also the version of the entity: once the entity is modified its new
+    values are a different key. The records must be read from the database:
+    sqlite3 returns the equal values of a column with the same type, e.g.
+    ``123`` for ``123.0`` in an INTEGER column, so equal keys render the
+    same text. The fragments are kept in two generations of at most half
+    ``capacity`` each: a hit in the older generation moves the fragment to
+    the recent one, and once the recent generation is full it becomes the
+    older one and the fragments not used since are dropped.
+
+    : param int capacity: maximum number of fragments kept by script root.
+
+    '''
+    def __init__(self, capacity=DEFAULT_FRAGMENT_CACHE_SIZE):
+        super(FragmentCache, self).__init__()
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        #[recent, older] dictionaries of fragments by values, by script root
+        self._roots = {}
+        #Metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def iterget(self, records, render):
+        '''
+        Generator returning the fragment of each record, rendering it on a
+        miss.
+
+        : param records: records, as returned by :py:mod:`forum.database`.
+            Dictionaries are rendered but not cached.
+        : param render: function returning the fragment of a record.
+        '''
+        root = request.script_root if has_request_context() else ''
+        generations = self._roots.get(root)
+        if generations is None:
+            with self._lock:
+                generations = self._roots.setdefault(root, [{}, {}])
+        half = max(self.capacity // 2, 1)
+        hits = misses = 0
+        try:
+            for record in records:
+                if isinstance(record, dict):
+                    yield render(record)
+                    continue
+                #Plain tuple of the values, hashed and compared in C
+                key = record[:]
+                recent = generations[0]
+                fragment = recent.get(key)
+                if fragment is None:
+                    fragment = generations[1].get(key)
+                    if fragment is None:
+                        misses += 1
+                        fragment = render(record)
+                    else:
+                        hits += 1
+                    recent[key] = fragment
+                    if len(recent) >= half:
+                        self._rotate(generations, recent)
+                else:
+                    hits += 1
+                yield fragment
+        finally:
+            with self._lock:
+                self.hits += hits
+                self.misses += misses
+
+    def get(self, record, render):
+        '''
+        : return: the fragment of a record. Check :py:meth:`iterget`
+        '''
+        return next(self.iterget((record,), render))
+
+    def _rotate(self, generations, recent):
+        '''
+        Makes the full ``recent`` generation the older one, dropping the
+        fragments of the older generation not used since.
+        '''
+        with self._lock:
+            if generations[0] is not recent:
+                #Rotated by another thread
+                return
+            older = generations[1]
+            self.evictions += sum(1 for key in older if key not in recent)
+            generations[:] = [{}, recent]
+
+    def clear(self):
+        '''
+        Drops all the fragments.
+        '''
+        with self._lock:
+            self._roots.clear()
+
+    def stats(self):
+        '''
+        : return: a dictionary with the keys ``capacity``, ``size``,
+            ``hits``, ``misses`` and ``evictions``.
+        '''
+        with self._lock:
+            size = 0
+            for recent, older in self._roots.values():
+                size += len(recent) + sum(1 for key in older
+                                          if key not in recent)
+            return {'capacity': self.capacity,
+                    'size': size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+class ItemEncoder(object):
+    '''
+    Renders database records straight into the JSON text of Collection+JSON
+    items, without building the ``{'name':..., 'value':...}`` dictionaries
+    of the item first.
+
+    The text of the item is precomputed as a template when the encoder is
+    created: the JSON of every member name, and of the members that are the
+    same in all the items, is encoded only once. Rendering an item only
+    encodes the values of the record and joins them with the template.
+
+    The text decodes to the same item as ``json.dumps`` of its dictionaries,
+    but it is not the same text: the members are written in a fixed order,
+    ``href``, ``data`` and then the other members sorted by name, and the
+    data members in the order of ``fields``, while ``json.dumps`` follows
+    the order of the dictionaries.
+
+    :Example:
+
+    >>> encoder = ItemEncoder([('nickname', 'nickname')],
+    ...                       members={'read-only': True})
+    >>> encoder.encode({'nickname': 'chen'})
+    '{"data": [{"name": "nickname", "value": "chen"}], "read-only": true}'
+
+    : param fields: sequence of ``(name, key)``. ``name`` is the name of the
+        data member of the item and ``key`` the key of its value in the
+        record.
+    : param href: function returning the URL of the item from the record.
+        If None, the item has no ``href``.
+    : param dict members: other members of the item, the same in all items.
+    : param cache: if not None, :py:class:`FragmentCache` keeping the items
+        rendered. The records must be hashable.
+
+    '''
+    def __init__(self, fields, href=None, members=None, cache=None):
+        self.href = href
+        self.cache = cache
+        self.keys = tuple(key for name, key in fields)
+        #Template of the item. A value goes between every two fragments
+        fragments = []
+        start = '{'
+        if href is not None:
+            fragments.append(start + '"href": ')
+            start = ', '
+        start += '"data": ['
+        for name, key in fields:
+            fragments.append(start + '{"name": ' +
+                             encode_basestring_ascii(name) + ', "value": ')
+            start = '}, '
+        end = '}]' if fields else start + ']'
+        for name, value in sorted((members or {}).items()):
+            end += ', ' + encode_basestring_ascii(name) + ': ' + \
+                json.dumps(value)
+        fragments.append(end + '}')
+        self.fragments = tuple(fragments)
+
+    def encode(self, record):
+        '''
+        :param record: record, or dictionary, with the keys of the fields.
+        :return: the JSON text of the item.
+        :rtype: str
+
+        '''
+        if self.cache is not None:
+            return self.cache.get(record, self._render)
+        return self._render(record)
+
+    def _render(self, record):
+        '''
+        Renders an item. Check :py:meth:`encode`
+        '''
+        fragments = self.fragments
+        parts = [fragments[0]]
+        index = 1
+        if self.href is not None:
+            parts.append(encode_value(self.href(record)))
+            parts.append(fragments[1])
+            index = 2
+        for key in self.keys:
+            parts.append(encode_value(record[key]))
+            parts.append(fragments[index])
+            index += 1
+        return ''.join(parts)
+
+    def iterencode(self, records):
+        '''
+        Generator encoding each of the ``records``. Check :py:meth:`encode`
+        '''
+        if self.cache is not None:
+            return self.cache.iterget(records, self._render)
+        return itertools.imap(self._render, records)
+
+
+class URLTemplate(object):
+    '''
+    URL of a resource precompiled as a format string, so the URLs of many
+    items are produced by string formatting instead of building each of
+    them with ``api.url_for``.
+
+    The template is built with ``api.url_for`` from the URL rule of the
+    resource, passing as the value of each variable a random sentinel that
+    must occur exactly once in the URL. The URL starts with the script root
+    of the request, where the application is mounted, so a template is
+    built on the first URL formatted under each script root. The values are
+    quoted as Werkzeug does.
+
+    :Example:
+
+    >>> ORDER_URL = URLTemplate(Order, 'orderid')
+    >>> ORDER_URL.format(orderid='order-12')
+    '/forum/api/orderid/order-12/'
+
+    : param resource: the resource class.
+    : param names: names of the variables of the URL rule.
+
+    '''
+    def __init__(self, resource, *names):
+        self.resource = resource
+        self.names = names
+        #Template by script root
+        self._templates = {}
+
+    def template(self):
+        '''
+        : return: the format string of the URL under the script root of the
+            current request, or of the root outside requests.
+        : raises ValueError: if a sentinel does not occur once in the URL.
+        '''
+        root = request.script_root if has_request_context() else ''
+        template = self._templates.get(root)
+        if template is None:
+            template = self._templates[root] = self._build()
+        return template
+
+    def _build(self):
+        '''
+        Builds the template of the current script root. Check
+        :py:meth:`template`
+        '''
+        sentinels = dict((name, 'var' + uuid.uuid4().hex)
+                         for name in self.names)
+        if has_request_context():
+            url = api.url_for(self.resource, **sentinels)
+        else:
+            with app.test_request_context():
+                url = api.url_for(self.resource, **sentinels)
+        url = url.replace('%', '%%')
+        for name, sentinel in sentinels.iteritems():
+            if url.count(sentinel) != 1:
+                raise ValueError("The URL of %s does not contain %s once" %
+                                 (self.resource.__name__, name))
+            url = url.replace(sentinel, '%(' + name + ')s')
+        return url
+
+    def format(self, **values):
+        '''
+        : return: the URL of the resource with the given values.
+        '''
+        for name in self.names:
+            value = values[name]
+            if not _URL_SAFE.match(value):
+                values[name] = url_quote(value)
+        return self.template() % values
+
+
+def envelope_parts(envelope):
+    '''
+    Renders a Collection+JSON document without items, split where the items
+    go. Check :py:func:`stream_collection`
+
+    : param dict envelope: the document without ``collection['items']``
+    : return: tuple ``(prefix, suffix)`` with the JSON text before and after
+        the items.
+
+    '''
+    head = json.dumps(envelope)
+    #head ends with the "}}" closing the collection and the envelope
+    prefix = head[:-2] + (', ' if envelope['collection'] else '') + \
+        '"items": ['
+    suffix = ']' + head[-2:]
+    return prefix, suffix
+
+
+def next_page_envelope(collection, title, href):
+    '''
+    Renders the envelope of a page of a collection, adding the ``next`` link
+    to the static parts of the collection.
+
+    : param dict collection: the static members of ``collection``
+    : param str title: title of the link.
+    : param str href: URL of the next page.
+    : return: the envelope, as returned by :py:func:`envelope_parts`
+
+    '''
+    collection = dict(collection)
+    collection['links'] = collection['links'] + [
+        {'title': title, 'rel': 'next', 'href': href}]
+    return envelope_parts({'collection': collection})
+
+
+def stream_collection(envelope, items, mimetype, etag=None):
+    '''
+    Creates a streamed :py:class:`flask.Response` with a Collection+JSON
+    document.
+
+    The envelope is rendered first, then each item as it is produced by
+    ``items`` and finally the end of the document, so the whole collection is
+    never held in memory. The output is sent in chunks of at least
+    :py:data:`STREAM_CHUNK_SIZE` bytes.
+
+    : param envelope: the document without ``collection['items']``, or its
+        text as returned by :py:func:`envelope_parts`. The envelopes that are
+        the same in every response are rendered only once.
+    : param items: iterable producing the JSON text of the items of the
+        collection, e.g. :py:meth:`ItemEncoder.iterencode`
+    : param str mimetype: mimetype of the response
+    : param str etag: if not None, strong ETag of the response. Check
+        :py:func:`collection_etag`
+    : rtype:: py: class:`flask.Response`
+
+    '''
+    if isinstance(envelope, dict):
+        envelope = envelope_parts(envelope)
+    prefix, suffix = envelope
+
+    def generate():
+        chunk = [prefix]
+        size = len(prefix)
+        separator = ''
+        for item in items:
+            part = separator + item
+            separator = ', '
+            chunk.append(part)
+            size += len(part)
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+        chunk.append(suffix)
+        yield ''.join(chunk)
+
+    #Keep the request context, and so the database connection, alive while
+    #the items are read
+    response = Response(stream_with_context(generate()), 200,
+                        mimetype=mimetype)
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+def collection_etag(*tables):
+    '''
+    Computes the strong ETag of a collection from the epoch of the database
+    and the versions of the tables it is read from. The versions are those
+    read by :py:meth:`forum.database.Connection.sync_caches` at the start of
+    the request, so no query is run. The epoch changes when the database is
+    created again or renewed after a restore, while the versions may start
+    again from the same values. The ETag is scoped to the URL, so it does
+    not depend on the query parameters.
+
+    : param tables: names of the tables, in
+        :py:data:`forum.database.VERSIONED_TABLES`
+    : return: the ETag, unquoted, or None if the database does not track
+        the versions of the tables.
+
+    '''
+    versions = app.config['Engine'].versions.versions()
+    epoch = versions.get(database.EPOCH)
+    if epoch is None:
+        return None
+    return '%x-' % epoch + '-'.join('%s.%d' % (table, versions[table])
+                                    for table in tables)
+
+def cache_response(*tags):
+    '''
+    Lets :py:class:`forum.utils.ResponseCache` cache the response of the
+    current request, if it succeeds.
+
+    : param tags: tags of the response: names of the tables that it is read
+        from (``orders``, ``sports`` or ``users``). Check
+        :py:func:`invalidate_responses`
+
+    '''
+    @after_this_request
+    def add_tags(response):
+        response.headers[CACHE_TAGS_HEADER] = ' '.join(tags)
+        return response
+
+#Tables that the responses cached with each tag are read from. Check
+#cache_response
+CACHE_TAG_TABLES = {'orders': ('orders',),
+                    'sports': ('sports',),
+                    'users': ('users', 'users_profile')}
+
+def response_versions():
+    '''
+    Reads the versions of the data of the cached responses, with one query.
+    Pass it as ``versions`` to :py:class:`forum.utils.ResponseCache`, so the
+    responses are rendered again when other processes change the tables.
+
+    : return: a dictionary with, for each tag in
+        :py:data:`CACHE_TAG_TABLES`, a tuple with the epoch of the database
+        and the versions of the tables of the tag, or None if the database
+        does not track the versions.
+
+    '''
+    tables = database.VERSIONED_TABLES
+    versions = app.config['Engine'].read_versions(tables)
+    if versions is None:
+        return None
+    #The epoch first, then the tables
+    current = dict(zip(tables, versions[1:]))
+    return dict((tag, versions[:1] + tuple(current[table]
+                                           for table in tag_tables))
+                for tag, tag_tables in CACHE_TAG_TABLES.iteritems())
+
+def invalidate_responses(*tags):
+    '''
+    Drops the responses cached by :py:class:`forum.utils.ResponseCache` with
+    any of the given tags once the current request succeeds. Call it from
+    the resources that modify the tables.
+
+    : param tags: tags of the responses. Check :py:func:`cache_response`
+
+    '''
+    @after_this_request
+    def add_tags(response):
+        if response.status_code < 400:
+            response.headers[CACHE_INVALIDATE_HEADER] = ' '.join(tags)
+        return response
+
+def not_modified(etag):
+    '''
+    Checks the ``If-None-Match`` header of the request.
+
+    : param str etag: current ETag of the resource, as returned by
+        :py:func:`collection_etag`
+    : return: a 304 :py:class:`flask.Response` if ``etag`` matches the
+        header, or None if the resource must be sent. The comparison is
+        strong. The ETags of the compressed responses are compared without
+        their coding, see :py:class:`forum.utils.CompressionMiddleware`
+
+    '''
+    if etag is None or not request.if_none_match.contains(etag):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+#Encoders of the Collection+JSON items of the collections
+ORDER_ITEM = ItemEncoder(
+    [('order_id', 'order_id'), ('user_nickname', 'nickname'),
+     ('sportname', 'sportname'), ('timestamp', 'timestamp')],
+    href=lambda order: ORDER_URL.format(orderid=order['order_id']),
+    members={'links': []},
+    cache=FragmentCache())
+SPORT_ITEM = ItemEncoder(
+    [('sport_id', 'sport_id'), ('sportname', 'sportname'), ('time', 'time'),
+     ('hallnumber', 'hallnumber'), ('note', 'note')],
+    members={'read-only': True})
+#lastLogin and timesviewed are not published
+USER_ITEM = ItemEncoder(
+    [('nickname', 'nickname'), ('regDate', 'regDate')],
+    members={'read-only': True})
+
+def order_items(orders_db):
+    '''
+    Transforms orders from the database into Collection+JSON items.
+
+    : param orders_db: iterable of orders as returned by
+        :py:meth:`forum.database.Connection.iter_orders`
+    : return: iterator over the JSON text of the items
+    '''
+    return ORDER_ITEM.iterencode(orders_db)
+
 @app.errorhandler(404)
 def resource_not_found(error):
     return create_error_response(404, "Resource not found",
@@ -88,6 +649,46 @@ def connect_db():
     Hence it is accessible from the request object.'''
 
     g.con = app.config['Engine'].connect()
+    #Drop the cached data changed by other processes
+    g.con.sync_caches()
+
+
+#PAGINATION
+def get_orders_page(nickname=None):
+    '''
+    Extracts from the database the page of orders requested with the query
+    parameters ``limit`` (maximum number of orders) and ``cursor`` (position
+    after which the page starts, as returned in the ``next`` link).
+
+    : param str nickname: if not None, only the orders of this user.
+    : return: tuple ``(orders, limit, next_cursor)``. ``orders`` is an
+        iterable, ``limit`` is -1 if the request is not paginated and
+        ``next_cursor`` is None in the last page
+    : raises ValueError: if ``limit`` or ``cursor`` are malformed.
+
+    '''
+    limit = request.args.get('limit')
+    limit = -1 if limit is None else int(limit)
+    if limit == 0 or limit < -1:
+        raise ValueError("The limit must be a positive integer")
+    cursor = request.args.get('cursor')
+    if cursor is not None:
+        timestamp, sep, orderid = cursor.partition(',')
+        if not sep:
+            raise ValueError("The cursor is malformed")
+        cursor = (float(timestamp), orderid)
+    if limit == -1:
+        #Not paginated: read the orders while the response is built
+        return g.con.iter_orders(nickname, cursor=cursor), limit, None
+    #Ask for one more order to know if there is a next page
+    orders_db = g.con.get_orders(nickname, limit + 1, cursor=cursor)
+    next_cursor = None
+    if len(orders_db) > limit:
+        orders_db = orders_db[:limit]
+        last = orders_db[-1]
+        next_cursor = '%s,%s' % (json.dumps(last['timestamp']),
+                                 last['order_id'])
+    return orders_db, limit, next_cursor
 
 
 #HOOKS
@@ -110,6 +711,8 @@ class Orders(Resource):
 
         INPUT parameters:
           None or user nickname
+          limit and cursor (query string, optional). Check AllOrders.get
+          If-None-Match (header, optional). Check AllOrders.get
 
         RESPONSE ENTITY BODY:
         * Media type: Collection+JSON:
@@ -118,60 +721,31 @@ class Orders(Resource):
              https://github.com/collection-json/extensions
 
         '''
+        #Nothing is read if the client has the current version
+        etag = collection_etag('orders')
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        cache_response('orders')
         #Extract Orders from database
-        orders_db = g.con.get_orders(nickname)
-
-        #Create the envelope
-        envelope = {}
-        collection = {}
-        envelope["collection"] = collection
-        collection['version'] = "1.0"
-        #collection['href'] = api.url_for(Orders)
-        collection['links'] = [
-                                {'title': 'List of all orders in the sporthall',
-                                'rel': 'orders-all', 'href': api.url_for(AllOrders)
-                                }
-            ]
-        collection['template'] = {
-            "data": [
-                {"prompt": "", "name": "order_id",
-                 "value": "", "required": True},
-                {"prompt": "", "name": "user_nickname",
-                 "value": "", "required": False},
-                {"prompt": "", "name": "sport_name",
-                 "value": "", "required": True},
-                {"prompt": "", "name": "timestamp",
-                 "value": "", "required": True} 
-            ]
-        }
-        #Create the items
-        items = []
-        for order in orders_db:
-        #get details from order
-            _orderid = order['order_id']
-            _usernickname = order['nickname']
-            _sportname = order['sportname']
-            _timestamp = order['timestamp']
-            _url = api.url_for(Order, orderid=_orderid)
-        #append order to item
-            order = {}
-            order['href'] = _url
-            order['data'] = []
-            value = {'name':'order_id', 'value': _orderid}
-            order['data'].append(value)
-            value = {'name':'user_nickname', 'value': _usernickname}
-            order['data'].append(value)
-            value = {'name':'sportname', 'value': _sportname}
-            order['data'].append(value)
-            value = {'name':'timestamp', 'value': _timestamp}
-            order['data'].append(value)
-            order['links'] = []
-            items.append(order)
-        collection['items'] = items
-        print envelope
+        try:
+            orders_db, limit, next_cursor = get_orders_page(nickname)
+        except ValueError:
+            return create_error_response(400, "Wrong query parameters",
+                                         "Use a positive limit and a cursor "
+                                         "from a next link")
+
+        #Create the envelope. The static parts are rendered only once
+        collection, envelope = collection_parts('orders')
+        if next_cursor is not None:
+            envelope = next_page_envelope(
+                collection, 'Next page of orders',
+                api.url_for(Orders, nickname=nickname, limit=limit,
+                            cursor=next_cursor))
         #RENDER
-        return Response(json.dumps(envelope), 200,
-                        mimetype=COLLECTIONJSON+";")
+        #The items are created while the response is sent
+        return stream_collection(envelope, order_items(orders_db),
+                                 COLLECTIONJSON+";", etag)
 
 
 
@@ -180,63 +754,44 @@ class AllOrders(Resource):
     Resource Orders implementation
     '''
     def get(self):
+        '''
+        Get all orders, newest first.
 
-        #Extract Orders from database
-        orders_db = g.con.get_orders(None)
+        INPUT parameters (query string, optional):
+          limit: maximum number of orders in the response.
+          cursor: start of the page. Use the value in the ``next`` link.
+        If-None-Match (header, optional): ETag of a previous response. 304
+          is returned if the orders did not change.
 
-        #Create the envelope
-        envelope = {}
-        collection = {}
-        envelope["collection"] = collection
-        collection['version'] = "1.0"
-        collection['href'] = api.url_for(AllOrders)
-        collection['links'] = [
-                                {'title': 'List of all orders in the sporthall',
-                                'rel': 'orders-all', 'href': api.url_for(AllOrders)
-                                }
-            ]
-        collection['template'] = {
-            "data": [
-                {"prompt": "", "name": "order_id",
-                 "value": "", "required": True},
-                {"prompt": "", "name": "timestamp",
-                 "value": "", "required": True},
-                {"prompt": "", "name": "user_nickname",
-                 "value": "", "required": False},
-                {"prompt": "", "name": "sport_id",
-                 "value": "", "required": False},
-                {"prompt": "", "name": "sport_name",
-                 "value": "", "required": True},
-                {"prompt": "", "name": "timestamp",
-                 "value": "", "required": True} 
-            ]
-        }
-        #Create the items
-        items = []
-        for order in orders_db:
-            _orderid = order['order_id']
-            _usernickname = order['nickname']
-            _sportname = order['sportname']
-            _timestamp = order['timestamp']
-            _url = api.url_for(Order, orderid=_orderid)
-            order = {}
-            order['href'] = _url
-            order['data'] = []
-            value = {'name':'order_id', 'value': _orderid}
-            order['data'].append(value)
-            value = {'name':'user_nickname', 'value': _usernickname}
-            order['data'].append(value)
-            value = {'name':'sportname', 'value': _sportname}
-            order['data'].append(value)
-            value = {'name':'timestamp', 'value': _timestamp}
-            order['data'].append(value)
-            order['links'] = []
-            items.append(order)
-        collection['items'] = items
-        print envelope
+        RESPONSE ENTITY BODY:
+        * Media type: Collection+JSON:
+             http://amundsen.com/media-types/collection/
+
+        '''
+        #Nothing is read if the client has the current version
+        etag = collection_etag('orders')
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        cache_response('orders')
+        #Extract Orders from database
+        try:
+            orders_db, limit, next_cursor = get_orders_page()
+        except ValueError:
+            return create_error_response(400, "Wrong query parameters",
+                                         "Use a positive limit and a cursor "
+                                         "from a next link")
+
+        #Create the envelope. The static parts are rendered only once
+        collection, envelope = collection_parts('all_orders')
+        if next_cursor is not None:
+            envelope = next_page_envelope(
+                collection, 'Next page of orders',
+                api.url_for(AllOrders, limit=limit, cursor=next_cursor))
         #RENDER
-        return Response(json.dumps(envelope), 200,
-                        mimetype=COLLECTIONJSON+";")
+        #The items are created while the response is sent
+        return stream_collection(envelope, order_items(orders_db),
+                                 COLLECTIONJSON+";", etag)
 		
 		
 		
@@ -258,17 +813,93 @@ class BookSport(Resource):
 
  
         neworderid = g.con.create_order(nickname, sportname)
+        invalidate_responses('orders')
         if not neworderid:
             return create_error_response(500, "Problem with the database",
                                          "Cannot access the database")
 
         #Create the Location header with the id of the order created
-        url = api.url_for(Order, orderid=neworderid)
+        url = ORDER_URL.format(orderid=neworderid)
 
         #RENDER
         #Return the response
         return Response(status=201, headers={'Location': url})
 
+class BookSportBatch(Resource):
+    '''
+    Books many sports in a single request. All the bookings are created in
+    one database transaction.
+    '''
+    def post(self):
+        '''
+        Creates the orders of a list of bookings.
+
+        REQUEST ENTITY BODY:
+        * Media type: Collection+JSON. Each item of the collection is a
+          booking with the data ``nickname`` and ``sportname``:
+
+          {"collection": {"items": [
+              {"data": [{"name": "nickname", "value": "chen"},
+                        {"name": "sportname", "value": "run"}]}, ...]}}
+
+        RESPONSE STATUS CODE:
+        * 200 with the result of each booking in the body, even if some of
+          them failed.
+        * 400 if the body is malformed or has more than MAX_BATCH_BOOKINGS
+          bookings.
+        * 415 if the body is not Collection+JSON.
+
+        RESPONSE ENTITY BODY:
+        * Media type: Collection+JSON. One item per booking, in the same
+          order as the request. The ``status`` of a booking is 201 and the
+          ``href`` of the item is the Location of the new order, or 404 if
+          the user or the sport does not exist.
+
+        '''
+        if COLLECTIONJSON != request.headers.get('Content-Type', ''):
+            return create_error_response(415, "UnsupportedMediaType",
+                                         "Use a JSON compatible format")
+        #PARSE THE REQUEST
+        request_body = request.get_json(force=True, silent=True)
+        try:
+            items = request_body['collection']['items']
+            bookings = []
+            for item in items:
+                data = dict((d['name'], d['value']) for d in item['data'])
+                booking = (data['nickname'], data['sportname'])
+                if not all(isinstance(value, basestring) for value in booking):
+                    raise ValueError("The nickname and sportname are strings")
+                bookings.append(booking)
+        except (KeyError, TypeError, ValueError):
+            return create_error_response(400, "Wrong request format",
+                                         "Include a collection of items with "
+                                         "the nickname and the sportname")
+        if len(bookings) > MAX_BATCH_BOOKINGS:
+            return create_error_response(400, "Too many bookings",
+                                         "Send at most %d bookings per request"
+                                         % MAX_BATCH_BOOKINGS)
+        orderids = g.con.create_orders_bulk(bookings)
+        invalidate_responses('orders')
+
+        #CREATE RESPONSE AND RENDER
+        items = []
+        for (nickname, sportname), orderid in zip(bookings, orderids):
+            item = {'data': [{'name': 'nickname', 'value': nickname},
+                             {'name': 'sportname', 'value': sportname}]}
+            if orderid:
+                item['href'] = ORDER_URL.format(orderid=orderid)
+                item['data'].append({'name': 'status', 'value': 201})
+            else:
+                item['data'].append({'name': 'status', 'value': 404})
+                item['data'].append({'name': 'message',
+                                     'value': "Unknown user or sport"})
+            items.append(item)
+        envelope = {'collection': {'version': "1.0",
+                                   'href': api.url_for(BookSportBatch),
+                                   'items': items}}
+        return Response(json.dumps(envelope), 200,
+                        mimetype=COLLECTIONJSON+";"+FORUM_ORDER_PROFILE)
+
 class Order(Resource):
     '''
     Resource that represents a single order in the API.
@@ -293,6 +924,7 @@ class Order(Resource):
         '''
 
         #PEFORM OPERATIONS INITIAL CHECKS
+        cache_response('orders')
         #Get the order from db
         order_db = g.con.get_order(orderid)
         if not order_db:
@@ -360,6 +992,7 @@ class Order(Resource):
 
         #PERFORM DELETE OPERATIONS
         if g.con.delete_order(orderid):
+            invalidate_responses('orders')
             return '', 204
         else:
             #Send error order
@@ -373,69 +1006,28 @@ class Sports(Resource):
         '''
         Gets a list of all the sports in the database.
 
-        It returns always status code 200.
+        It returns status code 200, or 304 if the If-None-Match header
+        matches the ETag of the current list.
 
         RESPONSE ENTITITY BODY:
         '''
+        #Nothing is read if the client has the current version
+        etag = collection_etag('sports')
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        cache_response('sports')
         #PERFORM OPERATIONS
         #Create the messages list
-        sports_db = g.con.get_sports()
+        sports_db = g.con.iter_sports()
 
         #FILTER AND GENERATE THE RESPONSE
-       #Create the envelope
-        envelope = {}
-        collection = {}
-        envelope["collection"] = collection
-        collection['links'] = [
-                                {'title': 'List of all sports in the sporthall',
-                                'rel': 'sports-all', 'href': api.url_for(Sports)
-                                }
-            ]
-        collection['version'] = "1.0"
-        collection['href'] = api.url_for(Sports)
-        collection['template'] = {
-            "data": [
-                {"prompt": "Insert sportname", "name": "sportname",
-                 "value": "", "required": True},
-                {"prompt": "Insert time", "name": "time",
-                 "value": "", "required": False},
-                {"prompt": "Insert hallnumber", "name": "hallnumber",
-                 "value": "", "required": True},
-                {"prompt": "Insert note", "name": "note",
-                 "value": "", "required": False}
-            ]
-        }
-        #Create the items
-        items = []
-        for sport in sports_db:
-            print sport
-            _sportid = sport['sport_id']
-            _sportname = sport['sportname']
-            #print _sportname
-            _time = sport['time']
-            #print _time
-            _hallnumber = sport['hallnumber']
-            _note = sport['note']
-            #_url = api.url_for(Sport, sportname=_sportname)
-            sport = {}
-            #sport['href'] = _url
-            sport['read-only'] = True
-            sport['data'] = []
-            value = {'name': 'sport_id', 'value': _sportid}
-            sport['data'].append(value)
-            value = {'name': 'sportname', 'value': _sportname}
-            sport['data'].append(value)
-            value = {'name': 'time', 'value': _time}
-            sport['data'].append(value)
-            value = {'name': 'hallnumber', 'value': _hallnumber}
-            sport['data'].append(value)
-            value = {'name': 'note', 'value': _note}
-            sport['data'].append(value)
-            items.append(sport)
-        collection['items'] = items
+        #The envelope is rendered only once, check collection_parts
         #RENDER
-        return Response(json.dumps(envelope), 200,
-                        mimetype=COLLECTIONJSON+";"+FORUM_USER_PROFILE)
+        #The items are created while the response is sent
+        return stream_collection(collection_parts('sports')[1],
+                                 SPORT_ITEM.iterencode(sports_db),
+                                 COLLECTIONJSON+";"+FORUM_USER_PROFILE, etag)
 
 
 
@@ -493,6 +1085,7 @@ class Sports(Resource):
 
         #CREATE RESPONSE AND RENDER
         if sportname:
+            invalidate_responses('sports')
             return Response(
                 status=201,
                 headers={"Location": api.url_for(Sport,
@@ -510,6 +1103,7 @@ class Sport(Resource):
     def get(self, sportname):
         
         #PERFORM OPERATIONS
+        cache_response('sports')
         sport_db = g.con.get_sport(sportname)
         print sport_db
         if not sport_db:
@@ -561,6 +1155,8 @@ class Sport(Resource):
         #Try to delete the sport. If it could not be deleted, the database
         #returns None.
         if g.con.delete_sport(sportname):
+            #The orders of the sport are deleted too
+            invalidate_responses('sports', 'orders')
             #RENDER RESPONSE
             return '', 204
         else:
@@ -580,7 +1176,8 @@ class Users(Resource):
         '''
         Gets a list of all the users in the database.
 
-        It returns always status code 200.
+        It returns status code 200, or 304 if the If-None-Match header
+        matches the ETag of the current list.
 
         RESPONSE ENTITITY BODY:
 
@@ -614,94 +1211,22 @@ class Users(Resource):
          * The rest of attributes match one-to-one with column names in the
            database.
         '''
+        #Nothing is read if the client has the current version
+        etag = collection_etag('users', 'users_profile')
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        cache_response('users')
         #PERFORM OPERATIONS
         #Create the messages list
-        users_db = g.con.get_users()
+        users_db = g.con.iter_users()
         #FILTER AND GENERATE THE RESPONSE
-       #Create the envelope
-        envelope = {}
-        collection = {}
-        envelope["collection"] = collection
-        collection['version'] = "1.0"
-        collection['href'] = api.url_for(Users)
-        collection['links'] = [{'prompt': 'List of all users',
-                                'rel': 'users-all',
-                                'href': api.url_for(Users)}
-                              ]
-        collection['template'] = {
-            "data": [
-                {"prompt": "Insert nickname", "name": "nickname",
-                 "value": "", "required": True},
-                {"prompt": "Insert user password", "name": "password",
-                 "value": "", "required": True},
-                {"prompt": "Insert user regDate", "name": "regDate",
-                 "value": "", "required": False},
-                {"prompt": "Insert user address", "name": "address",
-                 "value": "", "required": False},
-                {"prompt": "Insert user signature", "name": "signature",
-                 "value": "", "required": False},
-                {"prompt": "Insert user userType", "name": "userType",
-                 "value": "", "required": False},
-                {"prompt": "Insert user avatar", "name": "avatar",
-                 "value": "", "required": False},
-                {"prompt": "Insert user birthday", "name": "birthday",
-                 "value": "", "required": True},
-                {"prompt": "Insert user email", "name": "email",
-                 "value": "", "required": True},
-                {"prompt": "Insert user website", "name": "website",
-                 "value": "", "required": True},
-                {"prompt": "Insert user familyName", "name": "familyName",
-                 "value": "", "required": True},
-                {"prompt": "Insert user gender", "name": "gender",
-                 "value": "", "required": True},
-                {"prompt": "Insert user givenName", "name": "givenName",
-                 "value": "", "required": False}
-            ]
-        }
-        #Create the items
-        items = []
-        for user in users_db:
-            print user
-            _nickname = user['nickname']
-            print _nickname
-            _registrationdate = user['regDate']
-            print _registrationdate
-            _lastlogin = user['lastLogin']
-            print _lastlogin
-            _timesviewed = user['timesviewed']
-            print _timesviewed
-            '''
-            _registrationdate = user['regDate']
-            _lastlogin = user['lastLogin']
-            _timesviewed = user['timesviewed']
-            '''
-            #_url = api.url_for(User, nickname= _nickname)
-            user = {}
-            #user['href'] = _url
-            user['read-only'] = True
-            user['data'] = []
-            value = {'name': 'nickname', 'value': _nickname}
-            user['data'].append(value)
-            #value = {'name': 'lastLogin', 'value': _lastlogin}
-            #user['data'].append(value)
-            #value = {'name': 'timesviewed', 'value': _timesviewed}
-            #user['data'].append(value)
-            '''
-            value = {'name': 'regDate', 'value': _registrationdate}
-            user['data'].append(value)
-            value = {'name': 'lastLogin', 'value': _lastlogin}
-            user['data'].append(value)
-            value = {'name': 'timesviewed', 'value': _timesviewed}
-            user['data'].append(value)
-            '''
-            value = {'name': 'regDate', 'value': _registrationdate}
-            user['data'].append(value)
-            items.append(user)
-        collection['items'] = items
+        #The envelope is rendered only once, check collection_parts
         #RENDER
-
-        return Response(json.dumps(envelope), 200,
-                        mimetype=COLLECTIONJSON+";"+FORUM_USER_PROFILE)
+        #The items are created while the response is sent
+        return stream_collection(collection_parts('users')[1],
+                                 USER_ITEM.iterencode(users_db),
+                                 COLLECTIONJSON+";"+FORUM_USER_PROFILE, etag)
 
     def post(self):
         print COLLECTIONJSON
@@ -807,6 +1332,7 @@ class Users(Resource):
         print user
         #But we are not going to do this exercise
         username = g.con.append_user(_nickname, user)
+        invalidate_responses('users')
 
         #CREATE RESPONSE AND RENDER
         return  Response(status=201, 
@@ -823,6 +1349,7 @@ class User(Resource):
     def get(self, nickname):
         
         #PERFORM OPERATIONS
+        cache_response('users')
         user_db = g.con.get_user(nickname)
         if not user_db:
             return create_error_response(404, "Unknown user",
@@ -876,6 +1403,8 @@ class deleteUser(Resource):
         #Try to delete the user. If it could not be deleted, the database
         #returns None.
         if g.con.delete_user(nickname, password):
+            #The orders of the user lose their nickname
+            invalidate_responses('users', 'orders')
             #RENDER RESPONSE
             return '', 200
         else:
@@ -925,6 +1454,8 @@ api.add_resource(AllOrders, '/forum/api/orders/',
                  endpoint='allorders')
 api.add_resource(BookSport, '/forum/api/booksport/<nickname>/<sportname>/',
                  endpoint='booksport')
+api.add_resource(BookSportBatch, '/forum/api/booksport/batch/',
+                 endpoint='booksportbatch')
 api.add_resource(Order, '/forum/api/orderid/<regex("order-\d+"):orderid>/',
                  endpoint='order')
 api.add_resource(Users, '/forum/api/users/',
@@ -943,6 +1474,137 @@ api.add_resource(File, '/forum/api/files/<text>/',
                  endpoint='file') 
 
 
+#STATIC PARTS OF THE RESPONSES
+#Built on the first request under each script root. The collections are
+#rendered with envelope_parts, and the pages with next_page_envelope
+ORDER_URL = URLTemplate(Order, 'orderid')
+
+def _collections():
+    '''
+    : return: a dictionary with the static members of the collections, by
+        name, with the URLs under the script root of the current request.
+    '''
+    orders = {
+        'version': "1.0",
+        'links': [{'title': 'List of all orders in the sporthall',
+                   'rel': 'orders-all', 'href': api.url_for(AllOrders)}],
+        'template': {
+            "data": [
+                {"prompt": "", "name": "order_id",
+                 "value": "", "required": True},
+                {"prompt": "", "name": "user_nickname",
+                 "value": "", "required": False},
+                {"prompt": "", "name": "sport_name",
+                 "value": "", "required": True},
+                {"prompt": "", "name": "timestamp",
+                 "value": "", "required": True}
+            ]
+        }
+    }
+    all_orders = {
+        'version': "1.0",
+        'href': api.url_for(AllOrders),
+        'links': [{'title': 'List of all orders in the sporthall',
+                   'rel': 'orders-all', 'href': api.url_for(AllOrders)}],
+        'template': {
+            "data": [
+                {"prompt": "", "name": "order_id",
+                 "value": "", "required": True},
+                {"prompt": "", "name": "timestamp",
+                 "value": "", "required": True},
+                {"prompt": "", "name": "user_nickname",
+                 "value": "", "required": False},
+                {"prompt": "", "name": "sport_id",
+                 "value": "", "required": False},
+                {"prompt": "", "name": "sport_name",
+                 "value": "", "required": True},
+                {"prompt": "", "name": "timestamp",
+                 "value": "", "required": True}
+            ]
+        }
+    }
+    sports = {
+        'version': "1.0",
+        'href': api.url_for(Sports),
+        'links': [{'title': 'List of all sports in the sporthall',
+                   'rel': 'sports-all', 'href': api.url_for(Sports)}],
+        'template': {
+            "data": [
+                {"prompt": "Insert sportname", "name": "sportname",
+                 "value": "", "required": True},
+                {"prompt": "Insert time", "name": "time",
+                 "value": "", "required": False},
+                {"prompt": "Insert hallnumber", "name": "hallnumber",
+                 "value": "", "required": True},
+                {"prompt": "Insert note", "name": "note",
+                 "value": "", "required": False}
+            ]
+        }
+    }
+    users = {
+        'version': "1.0",
+        'href': api.url_for(Users),
+        'links': [{'prompt': 'List of all users', 'rel': 'users-all',
+                   'href': api.url_for(Users)}],
+        'template': {
+            "data": [
+                {"prompt": "Insert nickname", "name": "nickname",
+                 "value": "", "required": True},
+                {"prompt": "Insert user password", "name": "password",
+                 "value": "", "required": True},
+                {"prompt": "Insert user regDate", "name": "regDate",
+                 "value": "", "required": False},
+                {"prompt": "Insert user address", "name": "address",
+                 "value": "", "required": False},
+                {"prompt": "Insert user signature", "name": "signature",
+                 "value": "", "required": False},
+                {"prompt": "Insert user userType", "name": "userType",
+                 "value": "", "required": False},
+                {"prompt": "Insert user avatar", "name": "avatar",
+                 "value": "", "required": False},
+                {"prompt": "Insert user birthday", "name": "birthday",
+                 "value": "", "required": True},
+                {"prompt": "Insert user email", "name": "email",
+                 "value": "", "required": True},
+                {"prompt": "Insert user website", "name": "website",
+                 "value": "", "required": True},
+                {"prompt": "Insert user familyName", "name": "familyName",
+                 "value": "", "required": True},
+                {"prompt": "Insert user gender", "name": "gender",
+                 "value": "", "required": True},
+                {"prompt": "Insert user givenName", "name": "givenName",
+                 "value": "", "required": False}
+            ]
+        }
+    }
+    return {'orders': orders, 'all_orders': all_orders, 'sports': sports,
+            'users': users}
+
+#(collection, envelope) by name, by script root. Check collection_parts
+_COLLECTION_PARTS = {}
+
+def collection_parts(name):
+    '''
+    Returns the static parts of a collection under the script root of the
+    current request. They are built on the first request under each script
+    root, where the application is mounted.
+
+    : param str name: ``orders``, ``all_orders``, ``sports`` or ``users``
+    : return: tuple ``(collection, envelope)``: the static members of
+        ``collection`` and the envelope rendered with
+        :py:func:`envelope_parts`. They must not be modified.
+
+    '''
+    root = request.script_root
+    parts = _COLLECTION_PARTS.get(root)
+    if parts is None:
+        parts = dict((key, (collection,
+                            envelope_parts({'collection': collection})))
+                     for key, collection in _collections().iteritems())
+        _COLLECTION_PARTS[root] = parts
+    return parts[name]
+
+
 #Redirect profile
 @app.route('/profiles/<profile_name>')
 def redirect_to_profile(profile_name):
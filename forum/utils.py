@@ -1,4 +1,37 @@
+from collections import OrderedDict
+import threading, time, re, zlib, itertools
+
+from werkzeug.http import parse_etags, quote_etag, unquote_etag, \
+     parse_accept_header
 from werkzeug.routing import BaseConverter
+from werkzeug.wsgi import ClosingIterator
+
+#Response header with the tags of a response that may be cached by
+#ResponseCache. It is removed before the response is sent.
+CACHE_TAGS_HEADER = 'X-Cache-Tags'
+#Response header with the tags of the cached responses that a request
+#invalidates. It is removed before the response is sent.
+CACHE_INVALIDATE_HEADER = 'X-Cache-Invalidate'
+#Default bytes of memory of the bodies cached by ResponseCache
+DEFAULT_RESPONSE_CACHE_BYTES = 16 * 1024 * 1024
+#Default maximum bytes of a single cached body
+DEFAULT_RESPONSE_MAX_BYTES = 1024 * 1024
+#Default seconds that a response is cached
+DEFAULT_RESPONSE_CACHE_TTL = 10.0
+#Default minimum bytes of a body compressed by CompressionMiddleware.
+#Smaller bodies barely shrink and fit in a single packet anyway.
+DEFAULT_COMPRESSION_THRESHOLD = 1024
+#Default zlib level of CompressionMiddleware
+DEFAULT_COMPRESSION_LEVEL = 6
+#Content codings supported by CompressionMiddleware, the preferred first,
+#with the zlib window bits that produce them
+CONTENT_CODINGS = (('gzip', 16 + zlib.MAX_WBITS), ('deflate', zlib.MAX_WBITS))
+#Media types worth compressing: text, JSON (Collection+JSON, HAL...), XML
+#and JavaScript. Images and archives are already compressed.
+_COMPRESSIBLE = re.compile(
+    r'^\s*(text/|application/([\w.\-]+\+)?(json|xml|javascript)\b)', re.I)
+#Content coding negotiated for each Accept-Encoding header
+_negotiated = {}
 
 class RegexConverter(BaseConverter):
     '''
@@ -6,4 +39,547 @@ class RegexConverter(BaseConverter):
     '''
     def __init__(self, url_map, *items):
         super(RegexConverter, self).__init__(url_map)
-        self.regex = items[0]
\ No newline at end of file
+        self.regex = items[0]
+
+
+def negotiate_encoding(accept_encoding):
+    '''
+    Chooses the content coding of a response from the ``Accept-Encoding``
+    header of the request.
+
+    :param str accept_encoding: the header or None.
+    :return: ``'gzip'``, ``'deflate'`` or ``'identity'`` if the client
+        does not accept any of them.
+    '''
+    encoding = _negotiated.get(accept_encoding)
+    if encoding is None:
+        #A coding named in the header overrides the * wildcard
+        accepted = dict((value.lower(), quality) for value, quality
+                        in parse_accept_header(accept_encoding))
+        best = 0
+        encoding = 'identity'
+        for coding, wbits in CONTENT_CODINGS:
+            quality = accepted.get(coding, accepted.get('*', 0))
+            if quality > best:
+                encoding, best = coding, quality
+        #Clients send a handful of different headers
+        if len(_negotiated) > 256:
+            _negotiated.clear()
+        _negotiated[accept_encoding] = encoding
+    return encoding
+
+
+def coded_etag(etag, encoding):
+    '''
+    ETag of the representation of a response with a content coding. It is
+    strong if ``etag`` is strong.
+
+    :param str etag: ``ETag`` header of the identity response.
+    :param str encoding: the content coding.
+    :return: the ``ETag`` header with the coding appended to the tag, e.g.
+        ``"<tag>-gzip"``.
+    '''
+    tag, weak = unquote_etag(etag)
+    return quote_etag('%s-%s' % (tag, encoding), weak)
+
+
+def strong_match(if_none_match, etag):
+    '''
+    Strong comparison of an ETag with the ``If-None-Match`` header.
+
+    :param str if_none_match: the header or None.
+    :param str etag: ``ETag`` header of the response.
+    :return: True if ``etag`` is strong and it is in the header.
+    '''
+    tag, weak = unquote_etag(etag)
+    return not weak and parse_etags(if_none_match).contains(tag)
+
+
+class CachedResponse(object):
+    '''
+    Response stored by :py:class:`ResponseCache`.
+
+    :param str status: status line of the response.
+    :param list headers: ``(name, value)`` headers of the response, without
+        the ``Content-Length``.
+    :param str body: the whole body.
+    :param tags: tags of the response.
+    :param versions: versions of the data of each tag when the response was
+        rendered, or None if they are not checked.
+
+    The ``etag`` attribute is the ``ETag`` header of the response, weak or
+    strong, or None.
+    '''
+    __slots__ = ('status', 'headers', 'body', 'tags', 'versions', 'etag',
+                 'stored')
+
+    def __init__(self, status, headers, body, tags, versions=None):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.tags = tags
+        self.versions = versions
+        self.etag = None
+        for name, value in headers:
+            if name.lower() == 'etag':
+                self.etag = value
+        self.stored = time.time()
+
+
+class ResponseCache(object):
+    '''
+    WSGI middleware that caches the bodies of the GET responses of an
+    application, so a repeated request is answered with a dictionary lookup
+    without calling the application.
+
+    Responses are kept by method, path, query string, ``Accept`` header and
+    the content coding negotiated from the ``Accept-Encoding`` header. When
+    a :py:class:`CompressionMiddleware` is wrapped by the cache the
+    compressed bodies are stored, so each one is compressed once instead of
+    on every request.
+    Only the 200 responses that carry the :py:data:`CACHE_TAGS_HEADER`
+    header are cached: the application opts in each resource and names the
+    data that the response is built from. Any response carrying the
+    :py:data:`CACHE_INVALIDATE_HEADER` header, usually of a POST or DELETE
+    request, drops the cached responses with those tags. Both headers are
+    removed before the response is sent.
+
+    Changes not made through the application of this process, e.g. by
+    another process, are seen through ``versions``: the versions of the data
+    are read before a response is rendered and stored with it, and they are
+    read again before it is served from the cache. A response whose data
+    changed is dropped and rendered again. Without ``versions`` those
+    changes are seen when the cached responses expire, ``ttl`` seconds after
+    they were stored, or when :py:meth:`invalidate` is called.
+
+    Streamed responses are sent while they are stored, and they are not
+    stored if they are bigger than ``max_entry_bytes``. When the bodies
+    exceed ``budget`` bytes the least recently used are evicted. A request
+    whose ``If-None-Match`` header matches the ETag of the cached response
+    gets a 304 response.
+
+    :param app: the WSGI application.
+    :param int budget: maximum bytes of the cached bodies. If 0 nothing is
+        cached.
+    :param float ttl: seconds that a response is cached.
+    :param int max_entry_bytes: maximum bytes of a single cached body.
+    :param versions: function without arguments returning a dictionary with
+        a version of the data of each tag, which changes when the data
+        changes, e.g. read from the database with one query. If it returns
+        None, the request is not cached. It is called once per GET request.
+
+    '''
+    def __init__(self, app, budget=DEFAULT_RESPONSE_CACHE_BYTES,
+                 ttl=DEFAULT_RESPONSE_CACHE_TTL,
+                 max_entry_bytes=DEFAULT_RESPONSE_MAX_BYTES, versions=None):
+        super(ResponseCache, self).__init__()
+        self.app = app
+        self.versions = versions
+        self.budget = budget
+        self.ttl = ttl
+        self.max_entry_bytes = min(max_entry_bytes, budget)
+        self._lock = threading.Lock()
+        #CachedResponse by key, the least recently used first
+        self._entries = OrderedDict()
+        #Set of keys by tag
+        self._tags = {}
+        self._bytes = 0
+        #Incremented by each invalidation, so a response rendered before an
+        #invalidation is not stored
+        self._generation = 0
+        #Metrics
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.stale = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __call__(self, environ, start_response):
+        method = environ.get('REQUEST_METHOD')
+        if method != 'GET' or not self.budget:
+            return self.app(environ, self._intercept(start_response))
+        key = (method, environ.get('SCRIPT_NAME', ''),
+               environ.get('PATH_INFO', ''), environ.get('QUERY_STRING', ''),
+               environ.get('HTTP_ACCEPT', ''),
+               negotiate_encoding(environ.get('HTTP_ACCEPT_ENCODING')))
+        versions = None
+        if self.versions is not None:
+            #Read before rendering, so the data is not older than them
+            versions = self.versions()
+            if versions is None:
+                return self.app(environ, self._intercept(start_response))
+        entry = self._lookup(key, versions)
+        if entry is not None:
+            return self._serve(entry, environ, start_response)
+        captured = {'versions': versions}
+        with self._lock:
+            generation = self._generation
+        app_iter = self.app(environ,
+                            self._intercept(start_response, captured))
+        #Applications that call start_response lazily are not cached
+        if 'status' not in captured:
+            return app_iter
+        return _StoringIterable(self, key, captured, app_iter, generation)
+
+    def _intercept(self, start_response, captured=None):
+        '''
+        :return: a start_response function that removes the cache headers,
+            applies the invalidations and, if ``captured`` is not None,
+            stores in it the status, headers and tags of a cacheable
+            response.
+        '''
+        def intercepted(status, headers, exc_info=None):
+            tags = invalidated = None
+            kept = []
+            for name, value in headers:
+                lower = name.lower()
+                if lower == CACHE_TAGS_HEADER.lower():
+                    tags = tuple(value.split())
+                elif lower == CACHE_INVALIDATE_HEADER.lower():
+                    invalidated = value.split()
+                else:
+                    kept.append((name, value))
+            if invalidated:
+                self.invalidate(*invalidated)
+            if captured is not None and tags and status.startswith('200 '):
+                captured['status'] = status
+                captured['headers'] = [header for header in kept
+                                       if header[0].lower() !=
+                                       'content-length']
+                captured['tags'] = tags
+            return start_response(status, kept, exc_info)
+        return intercepted
+
+    def _lookup(self, key, versions):
+        '''
+        :param versions: current versions of the data, or None if they are
+            not checked.
+        :return: the :py:class:`CachedResponse` of ``key`` or None if it is
+            not cached, it expired or its data changed.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and versions is not None and \
+               entry.versions != _tag_versions(versions, entry.tags):
+                self.stale += 1
+                self._remove(key)
+                entry = None
+            if entry is not None and time.time() - entry.stored < self.ttl:
+                #Most recently used: back at the end
+                del self._entries[key]
+                self._entries[key] = entry
+                self.hits += 1
+                return entry
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def _serve(self, entry, environ, start_response):
+        '''
+        Sends a cached response, or 304 if the client has it.
+        '''
+        if entry.etag is not None and \
+           strong_match(environ.get('HTTP_IF_NONE_MATCH'), entry.etag):
+            with self._lock:
+                self.not_modified += 1
+            start_response('304 NOT MODIFIED', [('ETag', entry.etag)])
+            return []
+        start_response(entry.status, entry.headers +
+                       [('Content-Length', str(len(entry.body)))])
+        return [entry.body]
+
+    def store(self, key, captured, body, generation):
+        '''
+        Caches a response unless the cache was invalidated since
+        ``generation`` or the body is too big.
+        '''
+        if len(body) > self.max_entry_bytes:
+            return
+        versions = captured['versions']
+        if versions is not None:
+            versions = _tag_versions(versions, captured['tags'])
+        entry = CachedResponse(captured['status'], captured['headers'], body,
+                               captured['tags'], versions)
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._remove(key)
+            self._entries[key] = entry
+            self._bytes += len(body)
+            for tag in entry.tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self._bytes > self.budget:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        '''
+        Drops a response. The lock must be held.
+        '''
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= len(entry.body)
+        for tag in entry.tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate(self, *tags):
+        '''
+        Drops the cached responses with any of the given tags.
+
+        :param tags: tags of the responses. If none is given, all the
+            responses are dropped.
+
+        '''
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            if not tags:
+                keys = list(self._entries)
+            else:
+                keys = set()
+                for tag in tags:
+                    keys.update(self._tags.get(tag, ()))
+            for key in keys:
+                self._remove(key)
+
+    def stats(self):
+        '''
+        Returns the current state and the counters of the cache.
+
+        :return: a dictionary with the keys ``budget``, ``bytes`` (of the
+            cached bodies), ``size`` (number of responses), ``hits``,
+            ``misses``, ``not_modified`` (hits answered with 304),
+            ``stale`` (responses dropped because their data changed),
+            ``evictions`` and ``invalidations``.
+
+        '''
+        with self._lock:
+            return {'budget': self.budget,
+                    'bytes': self._bytes,
+                    'size': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'not_modified': self.not_modified,
+                    'stale': self.stale,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations}
+
+
+def _tag_versions(versions, tags):
+    '''
+    :param dict versions: version of the data of each tag.
+    :return: tuple with the versions of ``tags``
+    '''
+    return tuple(versions.get(tag) for tag in tags)
+
+
+class _StoringIterable(object):
+    '''
+    Body of a cacheable response. It yields the chunks of the application
+    while they are collected, and stores the body in the
+    :py:class:`ResponseCache` once it was completely sent.
+    '''
+    def __init__(self, cache, key, captured, app_iter, generation):
+        self.cache = cache
+        self.key = key
+        self.captured = captured
+        self.app_iter = app_iter
+        self.generation = generation
+
+    def __iter__(self):
+        chunks = []
+        size = 0
+        for chunk in self.app_iter:
+            if chunks is not None:
+                size += len(chunk)
+                if size > self.cache.max_entry_bytes:
+                    #Too big: sent but not stored
+                    chunks = None
+                else:
+                    chunks.append(chunk)
+            yield chunk
+        if chunks is not None:
+            self.cache.store(self.key, self.captured, ''.join(chunks),
+                             self.generation)
+
+    def close(self):
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+
+
+class CompressionMiddleware(object):
+    '''
+    WSGI middleware that compresses the responses of an application with
+    gzip or deflate, as negotiated with the ``Accept-Encoding`` header of
+    the request.
+
+    Only the 200 responses of a textual media type (see
+    :py:data:`_COMPRESSIBLE`) without a ``Content-Encoding`` and without
+    ``Cache-Control: no-transform`` are compressed, and only if their body
+    reaches ``threshold`` bytes. The head of a streamed body is collected
+    until the threshold is reached; the rest is compressed while it is
+    streamed. A body known at once, e.g. one with a ``Content-Length``, is
+    sent with the ``Content-Length`` of the compressed body.
+
+    The compressible responses carry ``Vary: Accept-Encoding``. The bytes
+    of a compressed response are not the ones of the identity response, so
+    its ETag is made specific to the coding (see :py:func:`coded_etag`) and
+    stays strong. The coding is removed from the ETags of the
+    ``If-None-Match`` header before the application compares them, and it is
+    added back to the ETag of a 304 response.
+
+    The ``write`` callable of ``start_response`` is not supported.
+
+    :param app: the WSGI application.
+    :param int threshold: minimum bytes of a compressed body.
+    :param int level: zlib compression level, from 1 (fastest) to 9
+        (smallest).
+
+    '''
+    def __init__(self, app, threshold=DEFAULT_COMPRESSION_THRESHOLD,
+                 level=DEFAULT_COMPRESSION_LEVEL):
+        super(CompressionMiddleware, self).__init__()
+        self.app = app
+        self.threshold = threshold
+        self.level = level
+        self._wbits = dict(CONTENT_CODINGS)
+
+    def __call__(self, environ, start_response):
+        encoding = negotiate_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        coded = False
+        if if_none_match and encoding != 'identity':
+            #The application knows the ETags of the identity responses
+            suffix = '-%s"' % encoding
+            if suffix in if_none_match:
+                environ = dict(environ, HTTP_IF_NONE_MATCH=
+                               if_none_match.replace(suffix, '"'))
+                coded = True
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return self._write
+        app_iter = self.app(environ, capture)
+        try:
+            return self._respond(environ, encoding, coded, captured,
+                                 app_iter, start_response)
+        except:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+            raise
+
+    def _write(self, data):
+        raise NotImplementedError('CompressionMiddleware does not support '
+                                  'the write callable')
+
+    def _respond(self, environ, encoding, coded, captured, app_iter,
+                 start_response):
+        '''
+        Collects the head of the body, calls ``start_response`` and returns
+        the body, compressed or not. ``coded`` is True if the coding was
+        removed from the ``If-None-Match`` header.
+        '''
+        iterator = iter(app_iter)
+        buffered = []
+        size = 0
+        exhausted = False
+        compressible = vary = False
+        #Until start_response is called and, if the response may be
+        #compressed, until the threshold is reached or the body ends
+        while True:
+            if captured:
+                vary, compressible = self._negotiable(environ, captured)
+                compressible = compressible and encoding != 'identity'
+                if not compressible or size >= self.threshold:
+                    break
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                exhausted = True
+                break
+            buffered.append(chunk)
+            size += len(chunk)
+        close = getattr(app_iter, 'close', None)
+        if not captured:
+            #The application did not start the response
+            return ClosingIterator(buffered, close)
+        status, headers, exc_info = captured
+        headers = list(headers)
+        if vary:
+            headers.append(('Vary', 'Accept-Encoding'))
+        elif coded and status.startswith('304 '):
+            #The client has the compressed response
+            headers = [(name, coded_etag(value, encoding)
+                        if name.lower() == 'etag' else value)
+                       for name, value in headers]
+            headers.append(('Vary', 'Accept-Encoding'))
+        if not compressible or size < self.threshold:
+            start_response(status, headers, exc_info)
+            if exhausted:
+                return ClosingIterator(buffered, close)
+            return ClosingIterator(itertools.chain(buffered, iterator), close)
+        headers = [(name, coded_etag(value, encoding)
+                    if name.lower() == 'etag' else value)
+                   for name, value in headers
+                   if name.lower() != 'content-length']
+        headers.append(('Content-Encoding', encoding))
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      self._wbits[encoding])
+        if exhausted:
+            body = compressor.compress(''.join(buffered)) + compressor.flush()
+            headers.append(('Content-Length', str(len(body))))
+            start_response(status, headers, exc_info)
+            return ClosingIterator([body], close)
+        start_response(status, headers, exc_info)
+        return ClosingIterator(self._compress(compressor, buffered, iterator),
+                               close)
+
+    def _negotiable(self, environ, captured):
+        '''
+        :return: a tuple ``(vary, compressible)``. ``vary`` is True if the
+            response depends on the ``Accept-Encoding`` header and
+            ``compressible`` is True if it may be compressed once its body
+            reaches the threshold.
+        '''
+        status, headers = captured[0], captured[1]
+        if not status.startswith('200 ') or \
+           environ.get('REQUEST_METHOD') == 'HEAD':
+            return False, False
+        content_type = None
+        for name, value in headers:
+            lower = name.lower()
+            if lower == 'content-type':
+                content_type = value
+            elif lower == 'content-encoding':
+                return False, False
+            elif lower == 'cache-control' and 'no-transform' in value:
+                return False, False
+            elif lower == 'content-length' and value.isdigit() and \
+                 int(value) < self.threshold:
+                return False, False
+        if content_type is None or not _COMPRESSIBLE.match(content_type):
+            return False, False
+        return True, True
+
+    def _compress(self, compressor, buffered, iterator):
+        '''
+        Compresses a streamed body. zlib sends its output once it filled its
+        buffers, so the chunks of the application are not flushed one by
+        one.
+        '''
+        data = compressor.compress(''.join(buffered))
+        if data:
+            yield data
+        for chunk in iterator:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
@@ -0,0 +1,214 @@
+'''
+Created on 17.10.2026
+Microbenchmarks of the hot paths of the database API. They are not unit
+tests: they print the time per call of each case.
+
+Run them from the root of the repository:
+    python -m test.database_api_benchmarks
+
+@author: chenhaoyu
+'''
+import timeit, sqlite3, sys, time
+
+from forum import database
+
+#Path to the database file, different from the deployment db
+DB_PATH = 'db/forum_bench.db'
+SNAPSHOT_PATH = 'db/forum_bench.snapshot'
+#The statements are measured without the caches of the Engine
+ENGINE = database.Engine(DB_PATH, sports_cache_ttl=0, user_cache_size=0,
+                         result_cache_bytes=0)
+
+#Number of calls of each case
+NUMBER = 5000
+#Number of orders added to the database by the listing benchmarks
+LISTING_SIZE = 10000
+
+
+def report(name, function, number=NUMBER):
+    '''
+    Runs ``function`` ``number`` times and prints the time per call.
+
+    :return: the time per call in microseconds.
+    '''
+    seconds = min(timeit.repeat(function, number=number, repeat=3))
+    per_call = seconds / number * 1e6
+    print "%-45s %9.2f us/call" % (name, per_call)
+    return per_call
+
+
+def bench_lookups(connection):
+    '''
+    Single statement lookups of get_user, get_sport and login compared with
+    the statements that they used to run.
+    '''
+    print bench_lookups.__doc__
+    con = connection.con
+
+    def get_user_two_queries():
+        connection.set_foreign_keys_support()
+        cur = con.cursor()
+        cur.execute('SELECT user_id from users WHERE nickname = ?', ('chen',))
+        user_id = cur.fetchone()['user_id']
+        cur.execute('SELECT users.*, users_profile.* FROM users, \
+                     users_profile WHERE users.user_id = ? \
+                     AND users_profile.user_id = users.user_id', (user_id,))
+        return connection._create_user_object(cur.fetchone())
+
+    def get_sport_two_queries():
+        connection.set_foreign_keys_support()
+        cur = con.cursor()
+        cur.execute('SELECT sport_id from sports WHERE sportname = ?',
+                    ('swim',))
+        sport_id = cur.fetchone()['sport_id']
+        cur.execute('SELECT sports.* FROM sports WHERE sports.sport_id = ?',
+                    (sport_id,))
+        return connection._create_sport_object(cur.fetchone())
+
+    def login_select_all():
+        cur = con.cursor()
+        cur.execute('select * from users where nickname=? and password=?',
+                    ('chen', '123'))
+        return cur.fetchone()
+
+    report('get_user (two queries)', get_user_two_queries)
+    report('get_user', lambda: connection.get_user('chen'))
+    report('get_sport (two queries)', get_sport_two_queries)
+    report('get_sport', lambda: connection.get_sport('swim'))
+    report('login (SELECT *)', login_select_all)
+    report('login', lambda: connection.login('chen', '123'))
+
+
+def bench_preamble(connection):
+    '''
+    Lookups with the per call preamble that activated the foreign keys and
+    set the row factory compared with the lookups on a connection that is
+    configured once when it is opened.
+    '''
+    print bench_preamble.__doc__
+    con = connection.con
+
+    def with_preamble(function):
+        def call():
+            connection.set_foreign_keys_support()
+            con.row_factory = sqlite3.Row
+            return function()
+        return call
+
+    get_order = lambda: connection.get_order('order-1')
+    get_user = lambda: connection.get_user('chen')
+    get_sport = lambda: connection.get_sport('swim')
+    report('get_order (preamble)', with_preamble(get_order))
+    report('get_order', get_order)
+    report('get_user (preamble)', with_preamble(get_user))
+    report('get_user', get_user)
+    report('get_sport (preamble)', with_preamble(get_sport))
+    report('get_sport', get_sport)
+
+
+def bench_records(connection):
+    '''
+    Listing of orders built as a dictionary per row compared with the Order
+    records built by the row factory. The size is the memory of the objects
+    holding each row, without the values which are shared.
+    '''
+    print bench_records.__doc__
+    con = connection.con
+    con.executemany('INSERT INTO orders(nickname, sportname, timestamp) \
+                     VALUES("chen", "swim", ?)',
+                    ((timestamp,) for timestamp in xrange(LISTING_SIZE)))
+    con.commit()
+
+    def get_orders_dicts():
+        cur = con.cursor()
+        cur.execute('SELECT * FROM orders \
+                     ORDER BY timestamp DESC, order_id DESC')
+        return [{'order_id': 'order-' + str(row['order_id']),
+                 'nickname': row['nickname'],
+                 'timestamp': row['timestamp'],
+                 'sportname': row['sportname']} for row in cur]
+
+    report('get_orders (dicts)', get_orders_dicts, 20)
+    report('get_orders', connection.get_orders, 20)
+    dicts = get_orders_dicts()
+    records = connection.get_orders()
+    print "%-45s %9d bytes/row" % ('size (dicts)', sys.getsizeof(dicts[0]))
+    print "%-45s %9d bytes/row" % ('size', sys.getsizeof(records[0]))
+    con.execute('DELETE FROM orders WHERE order_id > 2')
+    con.commit()
+
+
+def bench_bulk(connection, size=1000):
+    '''
+    Creation of sports one by one compared with append_sports_bulk. Each
+    case creates ``size`` new sports.
+    '''
+    print bench_bulk.__doc__
+    con = connection.con
+    sport = {'sport time': '10', 'sporthall number': 1, 'note': 'bench'}
+    cases = (('append_sport x %d' % size,
+              lambda names: [connection.append_sport(name, sport)
+                             for name in names]),
+             ('append_sports_bulk (%d)' % size,
+              lambda names: connection.append_sports_bulk(
+                  [(name, sport) for name in names])))
+    for name, function in cases:
+        names = ['bench-%d' % index for index in xrange(size)]
+        start = time.time()
+        function(names)
+        print "%-45s %9.2f ms" % (name, (time.time() - start) * 1e3)
+        con.execute("DELETE FROM sports WHERE note = 'bench'")
+        con.commit()
+
+
+def bench_caches(connection):
+    '''
+    Sports catalog and user lookups with and without the caches of the
+    Engine, and read from the catalog snapshot.
+    '''
+    print bench_caches.__doc__
+    cached = database.Engine(DB_PATH).connect()
+    shared = database.Engine(DB_PATH, snapshot_path=SNAPSHOT_PATH).connect()
+    #The results are cached with the versions read at the start of a request
+    cached.sync_caches()
+    try:
+        report('get_sports (no cache)', connection.get_sports)
+        report('get_sports', cached.get_sports)
+        report('get_sports (snapshot)', shared.get_sports)
+        report('get_sport (no cache)', lambda: connection.get_sport('swim'))
+        report('get_sport', lambda: cached.get_sport('swim'))
+        report('get_sport (snapshot)', lambda: shared.get_sport('swim'))
+        report('get_users (no cache)', connection.get_users)
+        report('get_users (snapshot)', shared.get_users)
+        report('get_user (no cache)', lambda: connection.get_user('chen'))
+        report('get_user', lambda: cached.get_user('chen'))
+        report('get_orders(chen) (no cache)',
+               lambda: connection.get_orders('chen'))
+        report('get_orders(chen)', lambda: cached.get_orders('chen'))
+        report('get_order (no cache)', lambda: connection.get_order('order-1'))
+        report('get_order', lambda: cached.get_order('order-1'))
+    finally:
+        cached.close()
+        cached.engine.dispose()
+        shared.close()
+        shared.engine.snapshot.remove()
+        shared.engine.dispose()
+
+
+def main():
+    ENGINE.remove_database()
+    ENGINE.create_tables()
+    ENGINE.populate_tables()
+    connection = ENGINE.connect()
+    try:
+        bench_lookups(connection)
+        bench_preamble(connection)
+        bench_records(connection)
+        bench_bulk(connection)
+        bench_caches(connection)
+    finally:
+        connection.close()
+        ENGINE.remove_database()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,494 @@
+'''
+Created on 17.10.2026
+Database interface testing for the Engine: connection pooling, PRAGMA
+profiles of the connections and the order retention sweeper.
+
+@author: chenhaoyu
+'''
+import sqlite3, unittest, time, os, threading
+
+from forum import database
+
+#Path to the database file, different from the deployment db
+DB_PATH = 'db/forum_test.db'
+#Path to the catalog snapshot file, different from the deployment one
+SNAPSHOT_PATH = 'db/forum_test.snapshot'
+ENGINE = database.Engine(DB_PATH, pool_size=2, pool_timeout=0.1)
+
+
+class EngineDBAPITestCase(unittest.TestCase):
+    '''
+    Test cases for the Engine and its connection pool.
+    '''
+    #INITIATION AND TEARDOWN METHODS
+    @classmethod
+    def setUpClass(cls):
+        ''' Creates the database structure. Removes first any preexisting
+            database file
+        '''
+        print "Testing ", cls.__name__
+        ENGINE.remove_database()
+        ENGINE.create_tables()
+
+    @classmethod
+    def tearDownClass(cls):
+        '''Remove the testing database'''
+        print "Testing ENDED for ", cls.__name__
+        ENGINE.remove_database()
+
+    def setUp(self):
+        '''
+        Populates the database
+        '''
+        #This method load the initial values from forum_data_dump.sql
+        ENGINE.populate_tables()
+
+    def tearDown(self):
+        '''
+        Close pooled connections and remove all records from database
+        '''
+        ENGINE.dispose()
+        ENGINE.clear()
+
+    def test_connection_reused(self):
+        '''
+        Check that a closed Connection returns its sqlite3 connection to the
+        pool and that the next Connection reuses it.
+        '''
+        print '('+self.test_connection_reused.__name__+')', \
+              self.test_connection_reused.__doc__
+        connection = ENGINE.connect()
+        con = connection.con
+        connection.close()
+        self.assertIsNone(connection.con)
+        connection = ENGINE.connect()
+        self.assertIs(connection.con, con)
+        self.assertEquals(connection.get_order('order-1')['nickname'], 'chen')
+        connection.close()
+        stats = ENGINE.pool_stats()
+        self.assertEquals(stats['open'], 1)
+        self.assertEquals(stats['idle'], 1)
+        self.assertEquals(stats['in_use'], 0)
+
+    def test_foreign_keys_on(self):
+        '''
+        Check that pooled connections have the foreign keys activated.
+        '''
+        print '('+self.test_foreign_keys_on.__name__+')', \
+              self.test_foreign_keys_on.__doc__
+        connection = ENGINE.connect()
+        try:
+            self.assertTrue(connection.check_foreign_keys_status())
+        finally:
+            connection.close()
+
+    def test_pool_timeout(self):
+        '''
+        Check that connect() raises an error when all connections are in use
+        and that the wait is recorded in the metrics.
+        '''
+        print '('+self.test_pool_timeout.__name__+')', \
+              self.test_pool_timeout.__doc__
+        before = ENGINE.pool_stats()
+        connections = [ENGINE.connect(), ENGINE.connect()]
+        try:
+            with self.assertRaises(sqlite3.OperationalError):
+                ENGINE.connect()
+        finally:
+            for connection in connections:
+                connection.close()
+        stats = ENGINE.pool_stats()
+        self.assertEquals(stats['open'], 2)
+        self.assertEquals(stats['waits'], before['waits'] + 1)
+        self.assertEquals(stats['timeouts'], before['timeouts'] + 1)
+        self.assertEquals(stats['checkouts'], before['checkouts'] + 2)
+
+    def test_idle_eviction(self):
+        '''
+        Check that connections idle for longer than the idle timeout are
+        closed.
+        '''
+        print '('+self.test_idle_eviction.__name__+')', \
+              self.test_idle_eviction.__doc__
+        #Seconds returned by the clock of the Engine
+        now = [1000.0]
+        engine = database.Engine(DB_PATH, pool_idle_timeout=10,
+                                 clock=lambda: now[0])
+        connection = engine.connect()
+        con = connection.con
+        connection.close()
+        now[0] += 10
+        connection = engine.connect()
+        self.assertIs(connection.con, con)
+        connection.close()
+        now[0] += 11
+        connection = engine.connect()
+        self.assertIsNot(connection.con, con)
+        connection.close()
+        self.assertEquals(engine.pool_stats()['evictions'], 1)
+        self.assertEquals(engine.pool_stats()['open'], 1)
+        engine.dispose()
+
+    def test_health_check(self):
+        '''
+        Check that a broken connection is replaced when it is checked out.
+        '''
+        print '('+self.test_health_check.__name__+')', \
+              self.test_health_check.__doc__
+        connection = ENGINE.connect()
+        con = connection.con
+        connection.close()
+        #Break the pooled connection behind the pool's back
+        con.close()
+        connection = ENGINE.connect()
+        self.assertIsNot(connection.con, con)
+        self.assertIsNotNone(connection.get_order('order-1'))
+        connection.close()
+        self.assertEquals(ENGINE.pool_stats()['health_failures'], 1)
+        self.assertEquals(ENGINE.pool_stats()['open'], 1)
+
+    def test_dirty_connection_discarded(self):
+        '''
+        Check that a connection with foreign keys deactivated is not reused.
+        '''
+        print '('+self.test_dirty_connection_discarded.__name__+')', \
+              self.test_dirty_connection_discarded.__doc__
+        connection = ENGINE.connect()
+        con = connection.con
+        connection.unset_foreign_keys_support()
+        connection.close()
+        self.assertEquals(ENGINE.pool_stats()['open'], 0)
+        connection = ENGINE.connect()
+        self.assertIsNot(connection.con, con)
+        connection.close()
+
+    def test_pragma_profile_wal(self):
+        '''
+        Check that the default profile puts the database in WAL mode and
+        reports the configured values.
+        '''
+        print '('+self.test_pragma_profile_wal.__name__+')', \
+              self.test_pragma_profile_wal.__doc__
+        settings = ENGINE.get_pragma_settings()
+        self.assertEquals(ENGINE.profile, 'wal')
+        self.assertEquals(settings['profile'], 'wal')
+        self.assertEquals(settings['foreign_keys'], 1)
+        self.assertEquals(settings['journal_mode'], 'wal')
+        #synchronous NORMAL is 1 and temp_store MEMORY is 2
+        self.assertEquals(settings['synchronous'], 1)
+        self.assertEquals(settings['temp_store'], 2)
+        self.assertEquals(settings['cache_size'], -8192)
+
+    def test_pragma_profile_legacy(self):
+        '''
+        Check that the legacy profile only activates the foreign keys.
+        '''
+        print '('+self.test_pragma_profile_legacy.__name__+')', \
+              self.test_pragma_profile_legacy.__doc__
+        engine = database.Engine(DB_PATH, profile='legacy')
+        settings = engine.get_pragma_settings()
+        engine.dispose()
+        self.assertEquals(settings['profile'], 'legacy')
+        self.assertEquals(settings['foreign_keys'], 1)
+        #synchronous FULL is 2 and temp_store DEFAULT is 0
+        self.assertEquals(settings['synchronous'], 2)
+        self.assertEquals(settings['temp_store'], 0)
+
+    def test_unknown_profile(self):
+        '''
+        Check that an Engine cannot be created with an unknown profile.
+        '''
+        print '('+self.test_unknown_profile.__name__+')', \
+              self.test_unknown_profile.__doc__
+        with self.assertRaises(ValueError):
+            database.Engine(DB_PATH, profile='fastest')
+
+    def test_retention_sweep(self):
+        '''
+        Check that the sweeper removes the expired orders in chunks and
+        records its metrics.
+        '''
+        print '('+self.test_retention_sweep.__name__+')', \
+              self.test_retention_sweep.__doc__
+        engine = database.Engine(DB_PATH, retention_chunk_size=2)
+        connection = engine.connect()
+        con = connection.con
+        #Three more expired orders and one recent order
+        con.executemany('INSERT INTO orders(nickname, sportname, timestamp) \
+                         VALUES("libo", "jog", ?)',
+                        [(1000,), (2000,), (3000,), (time.time(),)])
+        con.commit()
+        connection.close()
+        self.assertEquals(engine.retention.sweep(), 5)
+        stats = engine.retention.stats()
+        self.assertEquals(stats['sweeps'], 1)
+        self.assertEquals(stats['rows_purged'], 5)
+        self.assertFalse(stats['running'])
+        #The oldest order, timestamp 123, was due long ago
+        self.assertGreater(stats['lag'], 0)
+        connection = engine.connect()
+        self.assertEquals(len(connection.get_orders()), 1)
+        connection.close()
+        #Nothing left to remove
+        self.assertEquals(engine.retention.sweep(), 0)
+        self.assertEquals(engine.retention.stats()['lag'], 0)
+        engine.dispose()
+
+    def test_retention_start_stop(self):
+        '''
+        Check that the sweeper runs in the background and that create_order
+        does not remove orders while it is running.
+        '''
+        print '('+self.test_retention_start_stop.__name__+')', \
+              self.test_retention_start_stop.__doc__
+        engine = database.Engine(DB_PATH, retention_interval=60)
+        #Set by the first sweep of the background thread
+        swept = threading.Event()
+        sweep = engine.retention.sweep
+
+        def sweep_once():
+            purged = sweep()
+            swept.set()
+            return purged
+        engine.retention.sweep = sweep_once
+        self.assertTrue(engine.retention.start())
+        self.assertFalse(engine.retention.start())
+        try:
+            self.assertTrue(swept.wait(5))
+            connection = engine.connect()
+            connection.con.execute('INSERT INTO orders(nickname, sportname, \
+                                    timestamp) VALUES("libo", "jog", 10)')
+            connection.con.commit()
+            self.assertIsNotNone(connection.create_order("doudou", "jog"))
+            self.assertEquals(len(connection.get_orders()), 2)
+            connection.close()
+        finally:
+            self.assertTrue(engine.retention.stop())
+        self.assertFalse(engine.retention.stats()['running'])
+        self.assertEquals(engine.retention.stats()['rows_purged'], 2)
+        engine.dispose()
+
+    def test_retention_stop_timeout(self):
+        '''
+        Check that a sweeper that did not stop in time is not started twice.
+        '''
+        print '('+self.test_retention_stop_timeout.__name__+')', \
+              self.test_retention_stop_timeout.__doc__
+        engine = database.Engine(DB_PATH, retention_interval=60)
+        sweeping = threading.Event()
+        release = threading.Event()
+
+        def slow_sweep():
+            sweeping.set()
+            release.wait(5)
+            return 0
+        engine.retention.sweep = slow_sweep
+        self.assertTrue(engine.retention.start())
+        try:
+            self.assertTrue(sweeping.wait(5))
+            self.assertFalse(engine.retention.stop(timeout=0.01))
+            self.assertTrue(engine.retention.is_running())
+            self.assertFalse(engine.retention.start())
+        finally:
+            release.set()
+        self.assertTrue(engine.retention.stop(timeout=5))
+        self.assertFalse(engine.retention.is_running())
+        engine.dispose()
+
+    def test_sync_caches(self):
+        '''
+        Check that the caches of an Engine are dropped when another Engine,
+        as in another process, changes the tables.
+        '''
+        print '('+self.test_sync_caches.__name__+')', \
+              self.test_sync_caches.__doc__
+        other = database.Engine(DB_PATH)
+        writer = other.connect()
+        connection = ENGINE.connect()
+        try:
+            self.assertEquals(connection.sync_caches(),
+                              set(database.VERSIONED_TABLES))
+            self.assertEquals(connection.sync_caches(), set())
+            sports = len(connection.get_sports())
+            self.assertIsNotNone(connection.get_user('chen'))
+            writer.append_sport('diving', {'note': 'deep'})
+            writer.delete_user('chen', '123')
+            #Not seen until the caches are synchronized
+            self.assertEquals(len(connection.get_sports()), sports)
+            self.assertIsNotNone(connection.get_user('chen'))
+            changed = connection.sync_caches()
+            self.assertEquals(changed, set(['sports', 'users', 'users_profile',
+                                            'orders']))
+            self.assertEquals(len(connection.get_sports()), sports + 1)
+            self.assertIsNone(connection.get_user('chen'))
+            self.assertEquals(connection.sync_caches(), set())
+        finally:
+            connection.close()
+            writer.close()
+            other.dispose()
+
+    def test_sync_caches_not_migrated(self):
+        '''
+        Check that the caches are dropped once, and the result cache is not
+        used, while the database does not track the versions of the tables.
+        '''
+        print '('+self.test_sync_caches_not_migrated.__name__+')', \
+              self.test_sync_caches_not_migrated.__doc__
+        connection = ENGINE.connect()
+        try:
+            connection.sync_caches()
+            connection.con.execute('DROP TABLE table_versions')
+            connection.con.commit()
+            sports = connection.get_sports()
+            self.assertEquals(connection.sync_caches(),
+                              set(database.VERSIONED_TABLES))
+            self.assertFalse(ENGINE.versions.tracked)
+            self.assertIsNot(connection.get_sports()[0], sports[0])
+            #Not dropped again on every sync
+            self.assertEquals(connection.sync_caches(), set())
+            #The writes do not fail and the results are not cached
+            self.assertTrue(connection.append_sport('diving', {}))
+            misses = ENGINE.result_cache.stats()['misses']
+            connection.get_orders('chen')
+            connection.get_orders('chen')
+            self.assertEquals(ENGINE.result_cache.stats()['misses'], misses)
+            #The versions start again from 0
+            self.assertTrue(ENGINE.migrate())
+            self.assertEquals(connection.sync_caches(),
+                              set(database.VERSIONED_TABLES))
+            self.assertTrue(ENGINE.versions.tracked)
+            self.assertEquals(connection.sync_caches(), set())
+        finally:
+            connection.close()
+
+    def test_bump_versions_per_statement(self):
+        '''
+        Check that a write increments the versions of the tables it
+        modifies once, whatever the number of rows.
+        '''
+        print '('+self.test_bump_versions_per_statement.__name__+')', \
+              self.test_bump_versions_per_statement.__doc__
+        connection = ENGINE.connect()
+        try:
+            connection.sync_caches()
+            versions = ENGINE.versions.versions()
+            connection.create_orders_bulk([('chen', 'swim')] * 10)
+            connection.delete_sport('swim')
+            connection.sync_caches()
+            changed = ENGINE.versions.versions()
+            self.assertEquals(changed['orders'], versions['orders'] + 2)
+            self.assertEquals(changed['sports'], versions['sports'] + 1)
+            self.assertEquals(changed['users'], versions['users'])
+        finally:
+            connection.close()
+
+    def test_create_table_versions(self):
+        '''
+        Check that the methods creating the tables one by one create the
+        table_versions table too.
+        '''
+        print '('+self.test_create_table_versions.__name__+')', \
+              self.test_create_table_versions.__doc__
+        engine = database.Engine('db/forum_test_tables.db')
+        try:
+            self.assertTrue(engine.create_sports_table())
+            self.assertTrue(engine.create_users_table())
+            self.assertTrue(engine.create_users_profile_table())
+            self.assertTrue(engine.create_order_table())
+            connection = engine.connect()
+            try:
+                self.assertEquals(connection.sync_caches(),
+                                  set(database.VERSIONED_TABLES))
+                self.assertTrue(engine.versions.tracked)
+                connection.append_sport('swim', {})
+                self.assertEquals(connection.sync_caches(), set(['sports']))
+            finally:
+                connection.close()
+        finally:
+            engine.remove_database()
+
+    def test_catalog_snapshot(self):
+        '''
+        Check that the catalog snapshot is written by one Engine and mapped
+        by the others, as in other processes, and that all of them swap to
+        a new snapshot when the tables change.
+        '''
+        print '('+self.test_catalog_snapshot.__name__+')', \
+              self.test_catalog_snapshot.__doc__
+        first = database.Engine(DB_PATH, snapshot_path=SNAPSHOT_PATH)
+        second = database.Engine(DB_PATH, snapshot_path=SNAPSHOT_PATH)
+        writer = first.connect()
+        reader = second.connect()
+        try:
+            sports = writer.get_sports()
+            self.assertEquals(len(sports), reader.con.execute(
+                'SELECT COUNT(*) FROM sports').fetchone()[0])
+            self.assertEquals(reader.get_sports(), sports)
+            self.assertEquals(reader.get_users(), writer.get_users())
+            self.assertEquals(reader.get_sport('swim')['sport name'], 'swim')
+            self.assertIsNone(reader.get_sport('diving'))
+            self.assertEquals(first.snapshot.stats()['builds'], 1)
+            self.assertEquals(second.snapshot.stats()['builds'], 0)
+            self.assertEquals(second.snapshot.stats()['loads'], 1)
+            #An iterator keeps reading the snapshot it was created from
+            listing = reader.iter_users()
+            writer.append_sport('diving', {'note': 'deep'})
+            self.assertEquals(len(writer.get_sports()), len(sports) + 1)
+            self.assertEquals(first.snapshot.stats()['builds'], 2)
+            #Not seen until the reader synchronizes its caches
+            self.assertIsNone(reader.get_sport('diving'))
+            reader.sync_caches()
+            self.assertEquals(reader.get_sport('diving')['note'], 'deep')
+            self.assertEquals(second.snapshot.stats()['loads'], 2)
+            self.assertEquals(len(list(listing)), len(writer.get_users()))
+            #Only the file of the current versions is left
+            self.assertEquals(first.snapshot._files(), [
+                first.snapshot._file(first.read_versions(
+                    database.SNAPSHOT_TABLES))])
+        finally:
+            writer.close()
+            reader.close()
+            second.snapshot.remove()
+            first.snapshot.remove()
+            first.dispose()
+            second.dispose()
+        self.assertEquals(first.snapshot._files(), [])
+
+    def test_result_cache_concurrent_load(self):
+        '''
+        Check that a result loaded at the same time by two threads is
+        counted once in the memory of the result cache.
+        '''
+        print '('+self.test_result_cache_concurrent_load.__name__+')', \
+              self.test_result_cache_concurrent_load.__doc__
+        cache = database.ResultCache(100000)
+        loading = threading.Semaphore(0)
+        release = threading.Event()
+
+        def load():
+            #Both threads miss before any of them stores the result
+            loading.release()
+            release.wait(5)
+            return range(20)
+        threads = [threading.Thread(target=cache.get,
+                                    args=('key', ('orders',), load))
+                   for i in xrange(2)]
+        for thread in threads:
+            thread.start()
+        loading.acquire()
+        loading.acquire()
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        stats = cache.stats()
+        self.assertEquals(stats['misses'], 2)
+        self.assertEquals(stats['size'], 1)
+        self.assertEquals(stats['bytes'], sum(
+            entry[1] for entry in cache._entries.itervalues()))
+        cache.invalidate('orders')
+        self.assertEquals(cache.stats()['bytes'], 0)
+
+
+if __name__ == '__main__':
+    print 'Start running engine tests'
+    unittest.main()
@@ -6,7 +6,7 @@ Database interface testing for all orders related methods.
 @author: chenhaoyu
 '''
 
-import sqlite3, unittest
+import sqlite3, unittest, time, json
 
 from forum import database
 
@@ -102,6 +102,41 @@ class OrderDBAPITestCase(unittest.TestCase):
             #Assert
             self.assertEquals(len(users), INITIAL_SIZE)
 
+    def test_orders_indexes(self):
+        '''
+        Check that the orders lookups by user and by time are served by an
+        index instead of a full scan plus a sort.
+        '''
+        print '('+self.test_orders_indexes.__name__+')', \
+              self.test_orders_indexes.__doc__
+        con = self.connection.con
+        cur = con.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'index' \
+                     AND tbl_name = 'orders'")
+        indexes = [row[0] for row in cur.fetchall()]
+        for index in ('orders_nickname_timestamp', 'orders_timestamp',
+                      'orders_sportname'):
+            self.assertIn(index, indexes)
+        cur.execute('EXPLAIN QUERY PLAN SELECT * FROM orders \
+                     WHERE nickname = ? ORDER BY timestamp DESC', ('chen',))
+        plan = ' '.join(str(row[-1]) for row in cur.fetchall())
+        self.assertIn('orders_nickname_timestamp', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_migrate(self):
+        '''
+        Check that Engine.migrate adds the indexes to an existing database.
+        '''
+        print '('+self.test_migrate.__name__+')', self.test_migrate.__doc__
+        con = self.connection.con
+        con.execute('DROP INDEX orders_timestamp')
+        con.commit()
+        self.assertTrue(ENGINE.migrate())
+        cur = con.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'index' \
+                     AND name = 'orders_timestamp'")
+        self.assertIsNotNone(cur.fetchone())
+
     def test_create_order_object(self):
         '''
         Check that the method _create_order_object works return adequate
@@ -141,6 +176,35 @@ class OrderDBAPITestCase(unittest.TestCase):
         order = self.connection.get_order(ORDER2_ID)
         self.assertDictContainsSubset(order, ORDER2)
 		
+    def test_order_record(self):
+        '''
+        Check that get_order returns a read-only Order record that can be
+        used as a dictionary
+        '''
+        print '('+self.test_order_record.__name__+')', \
+              self.test_order_record.__doc__
+        order = self.connection.get_order(ORDER1_ID)
+        self.assertIsInstance(order, database.Order)
+        self.assertEquals(order, ORDER1)
+        self.assertEquals(order.as_dict(), ORDER1)
+        self.assertEquals(dict(order), ORDER1)
+        self.assertEquals(sorted(order.keys()), sorted(ORDER1.keys()))
+        self.assertIn('nickname', order)
+        self.assertNotIn('chen', order)
+        self.assertEquals(order.get('nickname'), 'chen')
+        self.assertIsNone(order.get('sport_id'))
+        with self.assertRaises(KeyError):
+            order['sport_id']
+        with self.assertRaises(TypeError):
+            order['nickname'] = 'zhoujj'
+        with self.assertRaises(AttributeError):
+            order.nickname = 'zhoujj'
+        self.assertNotEqual(order, ORDER2)
+        self.assertNotEqual(order, self.connection.get_order(ORDER2_ID))
+        #Serialized as an object, not as the array of a tuple
+        self.assertEquals(json.loads(json.dumps(order._asdict())), ORDER1)
+        self.assertEquals(order._asdict().keys(), list(order._keys))
+
     def test_get_order_malformedid(self):
         '''
         Test get_order with id 1 (malformed)
@@ -206,6 +270,137 @@ class OrderDBAPITestCase(unittest.TestCase):
         orders = self.connection.get_orders()
         self.assertEquals(len(orders), 2)
 		
+    def test_get_orders_cursor(self):
+        '''
+        Check that get_orders returns consecutive pages with a cursor
+        '''
+        print '('+self.test_get_orders_cursor.__name__+')',\
+              self.test_get_orders_cursor.__doc__
+        #Two more orders with the same timestamp as order-2
+        con = self.connection.con
+        con.executemany('INSERT INTO orders(order_id, nickname, sportname, \
+                         timestamp) VALUES(?, "zhoujj", "jog", 355)',
+                        [(3,), (4,)])
+        con.commit()
+        orders = self.connection.get_orders(number_of_orders=2)
+        self.assertEquals([o['order_id'] for o in orders],
+                          ['order-4', 'order-3'])
+        last = orders[-1]
+        cursor = (last['timestamp'], last['order_id'])
+        orders = self.connection.get_orders(number_of_orders=2, cursor=cursor)
+        self.assertEquals([o['order_id'] for o in orders],
+                          ['order-2', 'order-1'])
+        #Cursor combined with the nickname filter
+        orders = self.connection.get_orders(nickname='zhoujj',
+                                            cursor=(355, 'order-3'))
+        self.assertEquals([o['order_id'] for o in orders], ['order-2'])
+        with self.assertRaises(ValueError):
+            self.connection.get_orders(cursor=(355, '3'))
+
+    def test_get_orders_parameterized(self):
+        '''
+        Check that the SQL text of get_orders does not depend on the values
+        of the filters and that they cannot inject SQL
+        '''
+        print '('+self.test_get_orders_parameterized.__name__+')',\
+              self.test_get_orders_parameterized.__doc__
+        query1, pvalue1 = database.OrdersQuery.build(nickname='chen',
+                                                     before=400)
+        query2, pvalue2 = database.OrdersQuery.build(nickname='zhoujj',
+                                                     before=100, limit=5)
+        self.assertIs(query1, query2)
+        self.assertEquals(pvalue1, ('chen', 400, -1))
+        self.assertEquals(pvalue2, ('zhoujj', 100, 5))
+        orders = self.connection.get_orders(nickname="chen' OR '1'='1")
+        self.assertEquals(orders, [])
+        orders = self.connection.get_orders(before=200, after=100)
+        self.assertEquals([o['order_id'] for o in orders], [ORDER1_ID])
+        with self.assertRaises(ValueError):
+            self.connection.get_orders(before='1; DELETE FROM orders')
+
+    def test_iter_orders(self):
+        '''
+        Check that iter_orders yields lazily the same orders as get_orders
+        '''
+        print '('+self.test_iter_orders.__name__+')',\
+              self.test_iter_orders.__doc__
+        orders = self.connection.iter_orders(batch=1)
+        self.assertNotIsInstance(orders, list)
+        self.assertEquals(list(orders), self.connection.get_orders())
+        orders = self.connection.iter_orders(nickname='chen')
+        self.assertEquals([o['order_id'] for o in orders], [ORDER1_ID])
+        #The arguments are checked when the method is called
+        with self.assertRaises(ValueError):
+            self.connection.iter_orders(cursor=(123, '1'))
+
+    def test_result_cache(self):
+        '''
+        Test that get_orders and get_order results are cached until the
+        orders table changes and that the cache keeps to its budget
+        '''
+        print '('+self.test_result_cache.__name__+')', \
+              self.test_result_cache.__doc__
+        cache = ENGINE.result_cache
+        self.connection.sync_caches()
+        before = cache.stats()
+        orders = self.connection.get_orders(nickname='chen')
+        orders.append(None)
+        self.assertEquals(self.connection.get_orders(nickname='chen'),
+                          [ORDER1])
+        self.assertEquals(self.connection.get_order(ORDER1_ID), ORDER1)
+        self.assertEquals(self.connection.get_order(ORDER1_ID), ORDER1)
+        #The same values passed in another form
+        self.connection.get_orders('chen')
+        self.connection.get_orders('chen', number_of_orders=-1)
+        stats = cache.stats()
+        self.assertEquals(stats['hits'], before['hits'] + 4)
+        self.assertEquals(stats['misses'], before['misses'] + 2)
+        self.assertGreater(stats['bytes'], 0)
+        #Writes done directly with SQL, which increment the version of the
+        #table, are seen after the caches are synced
+        con = self.connection.con
+        con.execute('INSERT INTO orders(nickname, sportname, timestamp) \
+                     VALUES("chen", "jog", 400)')
+        database._bump_versions(con.cursor(), ('orders',))
+        con.commit()
+        self.assertEquals(len(self.connection.get_orders(nickname='chen')),
+                          1)
+        self.connection.sync_caches()
+        self.assertEquals(len(self.connection.get_orders(nickname='chen')),
+                          2)
+        #Unhashable arguments are not cached
+        misses = cache.stats()['misses']
+        self.connection.get_orders(cursor=[400, 'order-3'])
+        self.assertEquals(cache.stats()['misses'], misses)
+        #Results beyond the budget are evicted, the oldest first
+        engine = database.Engine(DB_PATH, result_cache_bytes=500)
+        connection = engine.connect()
+        try:
+            #Nothing is cached until the versions are synced
+            connection.get_order(ORDER1_ID)
+            self.assertEquals(engine.result_cache.stats()['misses'], 0)
+            connection.sync_caches()
+            for order_id in (ORDER1_ID, ORDER2_ID, ORDER1_ID):
+                connection.get_order(order_id)
+            stats = engine.result_cache.stats()
+            self.assertLessEqual(stats['bytes'], 500)
+            self.assertGreater(stats['evictions'], 0)
+            self.assertEquals(stats['hits'], 0)
+            #Larger than the whole budget
+            connection.get_orders()
+            connection.get_orders()
+            self.assertEquals(engine.result_cache.stats()['oversized'], 2)
+            #A wrong call raises its error
+            self.assertRaises(TypeError, connection.get_orders, 'chen',
+                              nickname='chen')
+        finally:
+            connection.close()
+            engine.dispose()
+        #The write methods drop the results. The old orders expire.
+        self.assertIsNotNone(self.connection.create_order('chen', 'swim'))
+        self.assertEquals(len(self.connection.get_orders(nickname='chen')),
+                          1)
+
     def test_delete_order(self):
         '''
         Test that the order order-1 is deleted
@@ -238,6 +433,29 @@ class OrderDBAPITestCase(unittest.TestCase):
         resp = self.connection.delete_order(WRONG_ORDER_ID)
         self.assertFalse(resp)		
 
+    def test_create_orders_bulk(self):
+        '''
+        Test that several orders are created in one call and that the orders
+        of unknown sports or users are reported
+        '''
+        print '('+self.test_create_orders_bulk.__name__+')',\
+              self.test_create_orders_bulk.__doc__
+        results = self.connection.create_orders_bulk(
+            [("doudou", "jog"), ("libo", "sleeping"), ("unknown", "run"),
+             (None, "swim"), ("chen", "run")])
+        self.assertEquals(results[1:3], [False, False])
+        #The initial orders are older than the retention period
+        self.assertEquals(len(self.connection.get_orders()), 3)
+        for orderid, (nickname, sportname) in zip(
+                [results[0], results[3], results[4]],
+                [("doudou", "jog"), (None, "swim"), ("chen", "run")]):
+            order = self.connection.get_order(orderid)
+            self.assertEquals(order['nickname'], nickname)
+            self.assertEquals(order['sportname'], sportname)
+        self.assertEquals(self.connection.create_orders_bulk([]), [])
+        with self.assertRaises(ValueError):
+            self.connection.create_orders_bulk([("chen", "run", 1)])
+
     def test_create_order(self):
         '''
         Test that a new order can be created
@@ -264,6 +482,55 @@ class OrderDBAPITestCase(unittest.TestCase):
         resp2 = self.connection.get_order(orderid)
         self.assertDictContainsSubset(new_order, resp2)
 		
+    def test_create_order_expires_orders(self):
+        '''
+        Test that creating an order removes the orders older than the
+        retention period and keeps the recent ones
+        '''
+        print '('+self.test_create_order_expires_orders.__name__+')',\
+              self.test_create_order_expires_orders.__doc__
+        #order-1 and order-2 were created in 1970. Add an order of yesterday
+        con = self.connection.con
+        con.execute('INSERT INTO orders(order_id, nickname, sportname, \
+                     timestamp) VALUES(3, "libo", "jog", ?)',
+                    (time.time() - 24 * 3600,))
+        con.commit()
+        orderid = self.connection.create_order("doudou", "jog")
+        self.assertIsNotNone(orderid)
+        self.assertIsNone(self.connection.get_order(ORDER1_ID))
+        self.assertIsNone(self.connection.get_order(ORDER2_ID))
+        self.assertIsNotNone(self.connection.get_order('order-3'))
+        self.assertEquals(len(self.connection.get_orders()), 2)
+
+    def test_create_order_rollback(self):
+        '''
+        Test that the expired orders are not removed if the order cannot be
+        created
+        '''
+        print '('+self.test_create_order_rollback.__name__+')',\
+              self.test_create_order_rollback.__doc__
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.connection.create_order("unknown", "jog")
+        #Nothing was left pending in the transaction
+        self.connection.con.commit()
+        self.assertIsNotNone(self.connection.get_order(ORDER1_ID))
+        self.assertEquals(len(self.connection.get_orders()), INITIAL_SIZE)
+
+    def test_create_order_without_retention(self):
+        '''
+        Test that no order is removed if the Engine has no retention period
+        '''
+        print '('+self.test_create_order_without_retention.__name__+')',\
+              self.test_create_order_without_retention.__doc__
+        engine = database.Engine(DB_PATH, order_retention=None)
+        connection = engine.connect()
+        try:
+            self.assertIsNotNone(connection.create_order("doudou", "jog"))
+            self.assertEquals(len(connection.get_orders()), INITIAL_SIZE + 1)
+        finally:
+            connection.close()
+            engine.dispose()
+
     def test_not_contains_order(self):
         '''
         Check if the database does not contain orders with id order-200
@@ -179,6 +179,17 @@ class UserDBAPITestCase(unittest.TestCase):
             elif sport['sport_id'] == SPORT2_ID:
                 self.assertEquals(sport['sportname'], SPORTNAME2)
 				
+    def test_iter_sports(self):
+        '''
+        Test that iter_sports yields lazily the same sports as get_sports
+        '''
+        print '('+self.test_iter_sports.__name__+')', \
+              self.test_iter_sports.__doc__
+        sports = self.connection.iter_sports(batch=3)
+        self.assertNotIsInstance(sports, list)
+        self.assertEquals(list(sports), self.connection.get_sports())
+        self.assertEquals(len(self.connection.get_sports()), INITIAL_SIZE)
+
     def test_delete_sport(self):
         '''
         Test that the sport run is deleted
@@ -214,6 +225,84 @@ class UserDBAPITestCase(unittest.TestCase):
         resp2 = self.connection.get_sport(sportname)
         self.assertDictContainsSubset(NEW_SPORT,resp2)		
 			
+    def test_append_sports_bulk(self):
+        '''
+        Test that several sports are added in one call and that the
+        duplicated ones are reported
+        '''
+        print '('+self.test_append_sports_bulk.__name__+')', \
+              self.test_append_sports_bulk.__doc__
+        results = self.connection.append_sports_bulk(
+            [(NEW_SPORT_NAME, NEW_SPORT), (SPORTNAME1, NEW_SPORT),
+             ('diving', {'note': 'deep'}), (NEW_SPORT_NAME, {})])
+        self.assertEquals(results, [NEW_SPORT_NAME, False, 'diving', False])
+        self.assertEquals(len(self.connection.get_sports()), INITIAL_SIZE + 2)
+        self.assertDictContainsSubset(NEW_SPORT,
+                                      self.connection.get_sport(NEW_SPORT_NAME))
+        self.assertEquals(self.connection.get_sport('diving')['note'], 'deep')
+        with self.assertRaises(ValueError):
+            self.connection.append_sports_bulk([('skating', None)])
+
+    def test_sports_cache(self):
+        '''
+        Test that the sports are served from the cache of the Engine and that
+        the write methods invalidate it
+        '''
+        print '('+self.test_sports_cache.__name__+')', \
+              self.test_sports_cache.__doc__
+        before = ENGINE.sports_cache.stats()
+        self.assertEquals(len(self.connection.get_sports()), INITIAL_SIZE)
+        self.assertDictContainsSubset(self.connection.get_sport(SPORTNAME1),
+                                      SPORT1)
+        self.assertIsNone(self.connection.get_sport(WRONG_SPORT_NAME))
+        stats = ENGINE.sports_cache.stats()
+        self.assertEquals(stats['misses'], before['misses'] + 1)
+        self.assertEquals(stats['hits'], before['hits'] + 2)
+        self.assertEquals(stats['size'], INITIAL_SIZE)
+        #The write methods invalidate the catalog
+        self.connection.append_sport(NEW_SPORT_NAME, NEW_SPORT)
+        self.assertEquals(len(self.connection.get_sports()), INITIAL_SIZE + 1)
+        self.connection.delete_sport(NEW_SPORT_NAME)
+        self.assertIsNone(self.connection.get_sport(NEW_SPORT_NAME))
+        stats = ENGINE.sports_cache.stats()
+        self.assertEquals(stats['invalidations'], before['invalidations'] + 2)
+        self.assertEquals(stats['misses'], before['misses'] + 3)
+
+    def test_sports_cache_ttl(self):
+        '''
+        Test that writes done with SQL are seen once the cached catalog
+        expires
+        '''
+        print '('+self.test_sports_cache_ttl.__name__+')', \
+              self.test_sports_cache_ttl.__doc__
+        #Seconds returned by the clock of the Engine
+        now = [1000.0]
+        engine = database.Engine(DB_PATH, sports_cache_ttl=30,
+                                 clock=lambda: now[0])
+        connection = engine.connect()
+        try:
+            self.assertIsNotNone(connection.get_sport(SPORTNAME1))
+            connection.con.execute('DELETE FROM sports WHERE sportname = ?',
+                                   (SPORTNAME1,))
+            connection.con.commit()
+            now[0] += 29
+            self.assertIsNotNone(connection.get_sport(SPORTNAME1))
+            now[0] += 1
+            self.assertIsNone(connection.get_sport(SPORTNAME1))
+        finally:
+            connection.close()
+            engine.dispose()
+        #Without cache the database is always queried
+        engine = database.Engine(DB_PATH, sports_cache_ttl=0)
+        connection = engine.connect()
+        try:
+            self.assertIsNone(connection.get_sport(SPORTNAME1))
+            self.assertEquals(len(connection.get_sports()), INITIAL_SIZE - 1)
+            self.assertEquals(engine.sports_cache.stats()['misses'], 0)
+        finally:
+            connection.close()
+            engine.dispose()
+
 
 if __name__ == '__main__':
     print 'Start running sport tests'
@@ -5,7 +5,7 @@ Database interface testing for all users related methods.
 
 @author: chen haoyu
 '''
-import unittest, sqlite3
+import unittest, sqlite3, copy
 from forum import database
 
 #Path to the database file, different from the deployment db
@@ -179,6 +179,96 @@ class UserDBAPITestCase(unittest.TestCase):
         user = self.connection.get_user(USER2_NICKNAME)
         self.assertDictContainsSubset(user, USER2)
 		
+    def test_user_record(self):
+        '''
+        Check that get_user returns a UserProfile record whose profiles can
+        be compared with dictionaries and copied into dictionaries
+        '''
+        print '('+self.test_user_record.__name__+')', \
+              self.test_user_record.__doc__
+        user = self.connection.get_user(USER1_NICKNAME)
+        self.assertIsInstance(user, database.UserProfile)
+        self.assertEquals(user, USER1)
+        copy = user.as_dict()
+        self.assertIs(type(copy['public_profile']), dict)
+        self.assertEquals(copy, USER1)
+        self.assertEquals(user['public_profile']['nickname'], USER1_NICKNAME)
+
+    def test_user_cache(self):
+        '''
+        Test that get_user is served from the cache of the Engine and that
+        the write methods invalidate the cached users
+        '''
+        print '('+self.test_user_cache.__name__+')', \
+              self.test_user_cache.__doc__
+        before = ENGINE.user_cache.stats()
+        user = self.connection.get_user(USER1_NICKNAME)
+        self.assertIs(self.connection.get_user(USER1_NICKNAME), user)
+        self.assertIsNone(self.connection.get_user(NEW_USER_NICKNAME))
+        self.assertIsNone(self.connection.get_user(NEW_USER_NICKNAME))
+        stats = ENGINE.user_cache.stats()
+        self.assertEquals(stats['hits'], before['hits'] + 2)
+        self.assertEquals(stats['misses'], before['misses'] + 2)
+        #The write methods invalidate the users they change
+        self.connection.modify_user(USER1_NICKNAME, MODIFIED_USER1)
+        self.assertEquals(self.connection.get_user(USER1_NICKNAME)
+                          ['public_profile']['signature'], 'New signature')
+        self.connection.append_user(NEW_USER_NICKNAME, NEW_USER)
+        self.assertIsNotNone(self.connection.get_user(NEW_USER_NICKNAME))
+        self.connection.delete_user(NEW_USER_NICKNAME, '123')
+        self.assertIsNone(self.connection.get_user(NEW_USER_NICKNAME))
+        stats = ENGINE.user_cache.stats()
+        self.assertEquals(stats['invalidations'], before['invalidations'] + 3)
+        self.assertEquals(stats['hits'], before['hits'] + 2)
+
+    def test_user_cache_eviction(self):
+        '''
+        Test that the least recently used users are evicted and that the
+        cached users expire
+        '''
+        print '('+self.test_user_cache_eviction.__name__+')', \
+              self.test_user_cache_eviction.__doc__
+        #Seconds returned by the clock of the Engine
+        now = [1000.0]
+        engine = database.Engine(DB_PATH, user_cache_size=2,
+                                 user_cache_ttl=60, clock=lambda: now[0])
+        connection = engine.connect()
+        try:
+            connection.get_user(USER1_NICKNAME)
+            connection.get_user(USER2_NICKNAME)
+            #USER1 is now the most recently used, so USER2 is evicted
+            connection.get_user(USER1_NICKNAME)
+            connection.get_user('libo')
+            stats = engine.user_cache.stats()
+            self.assertEquals(stats['size'], 2)
+            self.assertEquals(stats['evictions'], 1)
+            connection.get_user(USER1_NICKNAME)
+            self.assertEquals(engine.user_cache.stats()['hits'], 2)
+            connection.get_user(USER2_NICKNAME)
+            self.assertEquals(engine.user_cache.stats()['misses'], 4)
+            #Expired users are loaded again
+            now[0] += 60
+            connection.get_user(USER2_NICKNAME)
+            stats = engine.user_cache.stats()
+            self.assertEquals(stats['expirations'], 1)
+            self.assertEquals(stats['misses'], 5)
+            self.assertAlmostEqual(stats['hit_rate'], 2 / 7.0)
+        finally:
+            connection.close()
+            engine.dispose()
+
+    def test_login(self):
+        '''
+        Test login with right and wrong credentials
+        '''
+        print '('+self.test_login.__name__+')', self.test_login.__doc__
+        row = self.connection.login(USER1_NICKNAME, USER1_PASSWORD)
+        self.assertEquals(row['nickname'], USER1_NICKNAME)
+        self.assertEquals(row['userType'], 'True')
+        self.assertFalse(self.connection.login(USER1_NICKNAME, 'wrong'))
+        self.assertFalse(self.connection.login(USER_WRONG_NICKNAME,
+                                               USER1_PASSWORD))
+
     def test_get_user_noexistingname(self):
         '''
         Test get_user with  msg-200 (no-existing)
@@ -207,6 +297,17 @@ class UserDBAPITestCase(unittest.TestCase):
             elif user['nickname'] == USER2_NICKNAME:
                 self.assertEquals(user['regDate'], USER2_regDate)
 		
+    def test_iter_users(self):
+        '''
+        Test that iter_users yields lazily the same users as get_users
+        '''
+        print '('+self.test_iter_users.__name__+')', \
+              self.test_iter_users.__doc__
+        users = self.connection.iter_users(batch=2)
+        self.assertNotIsInstance(users, list)
+        self.assertEquals(list(users), self.connection.get_users())
+        self.assertEquals(len(self.connection.get_users()), INITIAL_SIZE)
+
     def test_delete_user(self):
         '''
         Test that the user chen is deleted
@@ -277,6 +378,48 @@ class UserDBAPITestCase(unittest.TestCase):
         self.assertDictContainsSubset(NEW_USER['public_profile'],
                                       resp2['public_profile'])
 
+    def test_append_user_after_delete(self):
+        '''
+        Test that the profile of a new user belongs to it after another user
+        has been deleted
+        '''
+        print '('+self.test_append_user_after_delete.__name__+')', \
+              self.test_append_user_after_delete.__doc__
+        #The last user: the next rowid of users_profile is its user_id, not
+        #the next one of the users sequence
+        self.assertTrue(self.connection.delete_user(USER2_NICKNAME,
+                                                    '1394357686'))
+        nickname = self.connection.append_user(NEW_USER_NICKNAME, NEW_USER)
+        self.assertEquals(nickname, NEW_USER_NICKNAME)
+        resp = self.connection.get_user(nickname)
+        self.assertDictContainsSubset(NEW_USER['restricted_profile'],
+                                      resp['restricted_profile'])
+
+    def test_append_users_bulk(self):
+        '''
+        Test that several users are added in one call with their profiles
+        and that the duplicated ones are reported
+        '''
+        print '('+self.test_append_users_bulk.__name__+')', \
+              self.test_append_users_bulk.__doc__
+        other = copy.deepcopy(NEW_USER)
+        other['public_profile']['nickname'] = 'mystery'
+        other['restricted_profile']['email'] = 'mystery@imaginecompany.com'
+        results = self.connection.append_users_bulk(
+            [(NEW_USER_NICKNAME, NEW_USER), (USER1_NICKNAME, NEW_USER),
+             ('mystery', other), (NEW_USER_NICKNAME, other)])
+        self.assertEquals(results, [NEW_USER_NICKNAME, None, 'mystery', None])
+        self.assertEquals(len(self.connection.get_users()), INITIAL_SIZE + 2)
+        for nickname, user in ((NEW_USER_NICKNAME, NEW_USER),
+                               ('mystery', other)):
+            resp = self.connection.get_user(nickname)
+            self.assertDictContainsSubset(user['restricted_profile'],
+                                          resp['restricted_profile'])
+            self.assertDictContainsSubset(user['public_profile'],
+                                          resp['public_profile'])
+        with self.assertRaises(ValueError):
+            self.connection.append_users_bulk([('batty', {})])
+
     def test_get_user_id(self):
         '''
         Test that get_user_id returns the right value given a nickname
@@ -0,0 +1,150 @@
+'''
+Created on 17.10.2026
+Microbenchmarks of the rendering of the collections of the API. They are
+not unit tests: they print the time of each case.
+
+Run them from the root of the repository:
+    python -m test.resources_api_benchmarks
+
+@author: chenhaoyu
+'''
+import timeit, time, copy, zlib
+
+from forum import resources, database, utils
+
+#Number of orders of the listing
+LISTING_SIZE = 10000
+#Number of calls of the per call cases
+NUMBER = 5000
+
+
+def report(name, function, number=NUMBER):
+    '''
+    Runs ``function`` ``number`` times and prints the time per call.
+
+    :return: the time per call in microseconds.
+    '''
+    seconds = min(timeit.repeat(function, number=number, repeat=3))
+    per_call = seconds / number * 1e6
+    print "%-45s %9.2f us/call" % (name, per_call)
+    return per_call
+
+
+def report_listing(name, function, size=LISTING_SIZE):
+    '''
+    Runs ``function`` once and prints the time per item of a listing of
+    ``size`` items.
+    '''
+    start = time.time()
+    function()
+    per_item = (time.time() - start) / size * 1e6
+    print "%-45s %9.2f us/item" % (name, per_item)
+    return per_item
+
+
+def bench_envelopes():
+    '''
+    Envelope of the list of all orders built and rendered on every request
+    compared with the envelope rendered once.
+    '''
+    print bench_envelopes.__doc__
+
+    def build_envelope():
+        collection = copy.deepcopy(
+            resources.collection_parts('all_orders')[0])
+        collection['href'] = resources.api.url_for(resources.AllOrders)
+        collection['links'][0]['href'] = \
+            resources.api.url_for(resources.AllOrders)
+        return resources.envelope_parts({'collection': collection})
+
+    report('envelope (built per request)', build_envelope)
+    report('envelope',
+           lambda: resources.collection_parts('all_orders')[1])
+
+
+def bench_listing(orders):
+    '''
+    Items of a listing of orders with the href built by api.url_for
+    compared with the href formatted from the URL template. The fragment
+    cache is not used.
+    '''
+    print bench_listing.__doc__
+    fields = [('order_id', 'order_id'), ('user_nickname', 'nickname'),
+              ('sportname', 'sportname'), ('timestamp', 'timestamp')]
+    url_for = resources.ItemEncoder(
+        fields, members={'links': []},
+        href=lambda order: resources.api.url_for(resources.Order,
+                                                 orderid=order['order_id']))
+    template = resources.ItemEncoder(
+        fields, members={'links': []},
+        href=lambda order: resources.ORDER_URL.format(
+            orderid=order['order_id']))
+    report_listing('href (api.url_for)',
+                   lambda: [resources.api.url_for(resources.Order,
+                                                  orderid=order['order_id'])
+                            for order in orders])
+    report_listing('href (template)',
+                   lambda: [resources.ORDER_URL.format(
+                       orderid=order['order_id']) for order in orders])
+    report_listing('items (api.url_for)',
+                   lambda: list(url_for.iterencode(orders)))
+    report_listing('items (template)',
+                   lambda: list(template.iterencode(orders)))
+
+
+def bench_fragment_cache(orders):
+    '''
+    Items of a listing of orders rendered without the fragment cache
+    compared with the same listing with a cold and a warm cache, where
+    every item is a hit.
+    '''
+    print bench_fragment_cache.__doc__
+    fields = [('order_id', 'order_id'), ('user_nickname', 'nickname'),
+              ('sportname', 'sportname'), ('timestamp', 'timestamp')]
+    href = lambda order: resources.ORDER_URL.format(orderid=order['order_id'])
+    uncached = resources.ItemEncoder(fields, href=href,
+                                     members={'links': []})
+    cached = resources.ItemEncoder(fields, href=href, members={'links': []},
+                                   cache=resources.FragmentCache())
+    report_listing('items (no cache)',
+                   lambda: list(uncached.iterencode(orders)))
+    report_listing('items (cold cache)',
+                   lambda: list(cached.iterencode(orders)))
+    report_listing('items (warm cache)',
+                   lambda: list(cached.iterencode(orders)))
+
+
+def bench_compression(orders):
+    '''
+    Bytes and time of the listing of orders compressed by the
+    CompressionMiddleware at each level. A body cached by the ResponseCache
+    is compressed only once.
+    '''
+    print bench_compression.__doc__
+    body = ''.join(resources.stream_collection(
+        resources.collection_parts('all_orders')[1],
+        resources.ORDER_ITEM.iterencode(orders),
+        resources.COLLECTIONJSON).response)
+    print "%-45s %9d bytes" % ('identity', len(body))
+    for encoding, wbits in utils.CONTENT_CODINGS:
+        for level in (1, utils.DEFAULT_COMPRESSION_LEVEL, 9):
+            def compress():
+                compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+                return compressor.compress(body) + compressor.flush()
+            name = '%s level %d' % (encoding, level)
+            print "%-45s %9d bytes" % (name, len(compress()))
+            report(name, compress, number=10)
+
+
+def main():
+    orders = [database.Order(('order-%d' % index, u'chen', u'swim',
+                              1476700000.0 + index))
+              for index in xrange(LISTING_SIZE)]
+    with resources.app.test_request_context('/forum/api/orders/'):
+        bench_envelopes()
+        bench_listing(orders)
+        bench_fragment_cache(orders)
+        bench_compression(orders)
+
+if __name__ == '__main__':
+    main()
@@ -5,12 +5,17 @@ Modified on 24.06.2016
 @modified: chenhaoyu, zhoujunjie
 '''
 import unittest, copy
-import json
+import json, zlib
+from collections import OrderedDict
 
 import flask
 
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
 import forum.resources as resources
 import forum.database as database
+import forum.utils as utils
 import unittest
 
 DB_PATH = 'db/forum_test.db'
@@ -94,6 +99,119 @@ class AllOrdersTestCase (ResourcesAPITestCase):
 
 
 
+    def test_get_orders_streamed(self):
+        '''
+        Checks that GET Orders streams a valid document for big collections
+        and for empty ones
+        '''
+        print '('+self.test_get_orders_streamed.__name__+')', \
+              self.test_get_orders_streamed.__doc__
+        connection = ENGINE.connect()
+        connection.con.executemany('INSERT INTO orders(nickname, sportname, \
+                                    timestamp) VALUES("libo", "jog", ?)',
+                                   [(1000 + i,) for i in range(500)])
+        connection.close()
+        resp = self.client.get(self.url)
+        self.assertEquals(resp.status_code, 200)
+        self.assertNotIn('Content-Length', resp.headers)
+        data = json.loads(resp.data)
+        self.assertEquals(len(data['collection']['items']), 502)
+        self.assertEquals(data['collection']['version'], '1.0')
+        connection = ENGINE.connect()
+        connection.con.execute('DELETE FROM orders')
+        connection.close()
+        resp = self.client.get(self.url)
+        data = json.loads(resp.data)
+        self.assertEquals(data['collection']['items'], [])
+
+    def test_get_orders_pages(self):
+        '''
+        Checks that GET Orders with a limit returns pages linked with next
+        '''
+        print '('+self.test_get_orders_pages.__name__+')', \
+              self.test_get_orders_pages.__doc__
+        resp = self.client.get(self.url + '?limit=1')
+        self.assertEquals(resp.status_code, 200)
+        data = json.loads(resp.data)
+        items = data['collection']['items']
+        self.assertEquals(len(items), 1)
+        self.assertEquals(items[0]['data'][0]['value'], 'order-2')
+        links = [link for link in data['collection']['links']
+                 if link['rel'] == 'next']
+        self.assertEquals(len(links), 1)
+        resp = self.client.get(links[0]['href'])
+        self.assertEquals(resp.status_code, 200)
+        data = json.loads(resp.data)
+        items = data['collection']['items']
+        self.assertEquals(len(items), 1)
+        self.assertEquals(items[0]['data'][0]['value'], 'order-1')
+        #order-1 is the last order
+        links = [link for link in data['collection']['links']
+                 if link['rel'] == 'next']
+        self.assertEquals(links, [])
+
+    def test_get_orders_wrong_page(self):
+        '''
+        Checks that GET Orders with wrong pagination parameters returns 400
+        '''
+        print '('+self.test_get_orders_wrong_page.__name__+')', \
+              self.test_get_orders_wrong_page.__doc__
+        for query in ('?limit=0', '?limit=a', '?cursor=355',
+                      '?cursor=355,2'):
+            resp = self.client.get(self.url + query)
+            self.assertEquals(resp.status_code, 400)
+
+    def test_get_orders_etag(self):
+        '''
+        Checks that GET Orders returns 304 while the orders do not change
+        '''
+        print '('+self.test_get_orders_etag.__name__+')', \
+              self.test_get_orders_etag.__doc__
+        resp = self.client.get(self.url)
+        self.assertEquals(resp.status_code, 200)
+        etag = resp.headers['ETag']
+        resp = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEquals(resp.status_code, 304)
+        self.assertEquals(resp.data, '')
+        self.assertEquals(resp.headers['ETag'], etag)
+        #The ETag does not depend on the users
+        connection = ENGINE.connect()
+        connection.delete_user('libo', '123')
+        connection.close()
+        resp = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEquals(resp.status_code, 304)
+        connection = ENGINE.connect()
+        connection.delete_order('order-1')
+        connection.close()
+        resp = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEquals(resp.status_code, 200)
+        self.assertNotEquals(resp.headers['ETag'], etag)
+        self.assertEquals(len(json.loads(resp.data)['collection']['items']),
+                          1)
+        resp = self.client.get(self.url,
+                               headers={'If-None-Match': resp.headers['ETag']})
+        self.assertEquals(resp.status_code, 304)
+
+    def test_get_orders_etag_recreated(self):
+        '''
+        Checks that the ETag changes when the database is created again,
+        although the versions of the tables start from the same values
+        '''
+        print '('+self.test_get_orders_etag_recreated.__name__+')', \
+              self.test_get_orders_etag_recreated.__doc__
+        etag = self.client.get(self.url).headers['ETag']
+        ENGINE.remove_database()
+        ENGINE.create_tables()
+        ENGINE.populate_tables()
+        resp = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEquals(resp.status_code, 200)
+        etag = resp.headers['ETag']
+        #Also when a backup is restored
+        self.assertTrue(ENGINE.renew_epoch())
+        resp = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEquals(resp.status_code, 200)
+
+
 class OrderTestCase (ResourcesAPITestCase):
     
     #ATTENTION: json.loads return unicode
@@ -206,6 +324,71 @@ class BookSportTestCase(ResourcesAPITestCase):
         self.assertEquals(resp.status_code, 500)
 
 
+class BookSportBatchTestCase(ResourcesAPITestCase):
+
+    url = '/forum/api/booksport/batch/'
+
+    @staticmethod
+    def bookings(*pairs):
+        return {'collection': {'items': [
+            {'data': [{'name': 'nickname', 'value': nickname},
+                      {'name': 'sportname', 'value': sportname}]}
+            for nickname, sportname in pairs]}}
+
+    def test_url(self):
+        '''
+        Checks that the URL points to the right resource
+        '''
+        print '('+self.test_url.__name__+')', self.test_url.__doc__,
+        #The resource only accepts POST
+        with resources.app.test_request_context(self.url, method='POST'):
+            rule = flask.request.url_rule
+            view_point = resources.app.view_functions[rule.endpoint].view_class
+            self.assertEquals(view_point, resources.BookSportBatch)
+
+    def test_book_batch(self):
+        '''
+        Book several sports at once and check the result of each booking
+        '''
+        print '('+self.test_book_batch.__name__+')', \
+              self.test_book_batch.__doc__
+        body = self.bookings(('chen', 'run'), ('libo', 'sleeping'),
+                             ('doudou', 'swim'))
+        resp = self.client.post(self.url, data=json.dumps(body),
+                                headers={"Content-Type": COLLECTIONJSON})
+        self.assertEquals(resp.status_code, 200)
+        items = json.loads(resp.data)['collection']['items']
+        self.assertEquals(len(items), 3)
+        statuses = [dict((d['name'], d['value']) for d in item['data'])
+                    ['status'] for item in items]
+        self.assertEquals(statuses, [201, 404, 201])
+        self.assertNotIn('href', items[1])
+        #The orders are stored
+        for item in (items[0], items[2]):
+            self.assertEquals(self.client.get(item['href']).status_code, 200)
+
+    def test_book_batch_wrong(self):
+        '''
+        Send malformed batches and batches with a wrong media type
+        '''
+        print '('+self.test_book_batch_wrong.__name__+')', \
+              self.test_book_batch_wrong.__doc__
+        body = json.dumps(self.bookings(('chen', 'run')))
+        resp = self.client.post(self.url, data=body,
+                                headers={"Content-Type": "application/json"})
+        self.assertEquals(resp.status_code, 415)
+        for body in ('not json', json.dumps({'template': {}}),
+                     json.dumps(self.bookings(('chen', ['run'])))):
+            resp = self.client.post(self.url, data=body,
+                                    headers={"Content-Type": COLLECTIONJSON})
+            self.assertEquals(resp.status_code, 400)
+        too_many = self.bookings(
+            *[('chen', 'run')] * (resources.MAX_BATCH_BOOKINGS + 1))
+        resp = self.client.post(self.url, data=json.dumps(too_many),
+                                headers={"Content-Type": COLLECTIONJSON})
+        self.assertEquals(resp.status_code, 400)
+
+
 class SportsTestCase (ResourcesAPITestCase):
 
     url = '/forum/api/sports/'
@@ -242,6 +425,25 @@ class SportsTestCase (ResourcesAPITestCase):
             sport0 = sport[0]
             self.assertIn('name', sport0)
 
+    def test_get_sports_etag(self):
+        '''
+        Checks that GET Sports returns 304 until a sport is added
+        '''
+        print '('+self.test_get_sports_etag.__name__+')', \
+              self.test_get_sports_etag.__doc__
+        resp = self.client.get(self.url)
+        etag = resp.headers['ETag']
+        resp = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEquals(resp.status_code, 304)
+        resp = self.client.get(self.url, headers={'If-None-Match': '*'})
+        self.assertEquals(resp.status_code, 304)
+        connection = ENGINE.connect()
+        connection.append_sport('diving', {'note': 'deep'})
+        connection.close()
+        resp = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEquals(resp.status_code, 200)
+        self.assertIn('diving', resp.data)
+
 
 class SportTestCase (ResourcesAPITestCase):
     
@@ -384,6 +586,369 @@ class UserTestCase (ResourcesAPITestCase):
         self.assertIn('items', data['collection'])
 
 
+class ResponseCacheTestCase(ResourcesAPITestCase):
+    '''
+    Test cases for the ResponseCache middleware wrapped around the API.
+    '''
+    url = '/forum/api/sports/'
+
+    def setUp(self):
+        '''
+        Populates the database and creates a client of the cached API. The
+        responses must be buffered, since they are stored once they were
+        completely sent.
+        '''
+        super(ResponseCacheTestCase, self).setUp()
+        self.cache = utils.ResponseCache(
+            resources.app, versions=resources.response_versions)
+        self.client = Client(self.cache, BaseResponse)
+
+    def test_get_cached(self):
+        '''
+        Checks that a GET response is cached without the cache headers and
+        answered with 304 when the client has it
+        '''
+        print '('+self.test_get_cached.__name__+')', \
+              self.test_get_cached.__doc__
+        resp = self.client.get(self.url, buffered=True)
+        self.assertEquals(resp.status_code, 200)
+        self.assertNotIn(utils.CACHE_TAGS_HEADER, resp.headers)
+        cached = self.client.get(self.url, buffered=True)
+        self.assertEquals(cached.data, resp.data)
+        self.assertEquals(cached.headers['Content-Type'],
+                          resp.headers['Content-Type'])
+        self.assertEquals(self.cache.stats()['hits'], 1)
+        resp = self.client.get(self.url, buffered=True, headers={
+            'If-None-Match': resp.headers['ETag']})
+        self.assertEquals(resp.status_code, 304)
+        self.assertEquals(self.cache.stats()['not_modified'], 1)
+        #Keyed on the query string and the Accept header
+        self.client.get(self.url + '?page=1', buffered=True)
+        self.client.get(self.url, buffered=True,
+                        headers={'Accept': 'application/json'})
+        self.assertEquals(self.cache.stats()['size'], 3)
+        #Errors are not cached
+        self.client.get('/forum/api/sports/sleep/', buffered=True)
+        self.client.get('/forum/api/sports/sleep/', buffered=True)
+        self.assertEquals(self.cache.stats()['size'], 3)
+
+    def test_invalidate(self):
+        '''
+        Checks that deleting a sport drops the cached sports and orders
+        '''
+        print '('+self.test_invalidate.__name__+')', \
+              self.test_invalidate.__doc__
+        self.client.get(self.url, buffered=True)
+        self.client.get('/forum/api/orders/', buffered=True)
+        self.client.get('/forum/api/users/nonexisting/', buffered=True)
+        resp = self.client.delete('/forum/api/sports/swim/')
+        self.assertEquals(resp.status_code, 204)
+        self.assertNotIn(utils.CACHE_INVALIDATE_HEADER, resp.headers)
+        self.assertEquals(self.cache.stats()['size'], 0)
+        resp = self.client.get(self.url, buffered=True)
+        self.assertNotIn('"swim"', resp.data)
+        self.assertEquals(self.cache.stats()['hits'], 0)
+
+    def test_changed_by_other_process(self):
+        '''
+        Checks that a cached response is rendered again when another
+        process changes its tables, and only then
+        '''
+        print '('+self.test_changed_by_other_process.__name__+')', \
+              self.test_changed_by_other_process.__doc__
+        self.client.get(self.url, buffered=True)
+        self.client.get('/forum/api/orders/', buffered=True)
+        #Another Engine, as in another process
+        other = database.Engine(DB_PATH)
+        connection = other.connect()
+        try:
+            connection.append_sport('diving', {'note': 'deep'})
+        finally:
+            connection.close()
+            other.dispose()
+        resp = self.client.get(self.url, buffered=True)
+        self.assertIn('"diving"', resp.data)
+        self.client.get('/forum/api/orders/', buffered=True)
+        stats = self.cache.stats()
+        self.assertEquals(stats['stale'], 1)
+        self.assertEquals(stats['hits'], 1)
+        #Not cached if the versions cannot be read
+        cache = utils.ResponseCache(resources.app, versions=lambda: None)
+        client = Client(cache, BaseResponse)
+        client.get(self.url, buffered=True)
+        client.get(self.url, buffered=True)
+        self.assertEquals(cache.stats()['size'], 0)
+
+    def test_budget(self):
+        '''
+        Checks that bodies bigger than the budget are sent but not cached
+        '''
+        print '('+self.test_budget.__name__+')', self.test_budget.__doc__
+        cache = utils.ResponseCache(resources.app, budget=100)
+        resp = Client(cache, BaseResponse).get(self.url, buffered=True)
+        self.assertEquals(resp.status_code, 200)
+        self.assertIn('"swim"', resp.data)
+        self.assertEquals(cache.stats()['size'], 0)
+
+
+class CompressionMiddlewareTestCase(ResourcesAPITestCase):
+    '''
+    Test cases for the CompressionMiddleware wrapped around the API.
+    '''
+    url = '/forum/api/orders/'
+
+    def setUp(self):
+        '''
+        Populates the database and creates a client of the API compressing
+        the bodies of at least 100 bytes.
+        '''
+        super(CompressionMiddlewareTestCase, self).setUp()
+        self.app = utils.CompressionMiddleware(resources.app, threshold=100)
+        self.client = Client(self.app, BaseResponse)
+
+    def test_negotiate_encoding(self):
+        '''
+        Checks the content coding chosen for each Accept-Encoding header
+        '''
+        print '('+self.test_negotiate_encoding.__name__+')', \
+              self.test_negotiate_encoding.__doc__
+        for header, encoding in ((None, 'identity'), ('', 'identity'),
+                                 ('br', 'identity'), ('gzip;q=0', 'identity'),
+                                 ('gzip, deflate, br', 'gzip'),
+                                 ('gzip;q=0.5, deflate', 'deflate'),
+                                 ('gzip;q=0, *', 'deflate'), ('*', 'gzip')):
+            self.assertEquals(utils.negotiate_encoding(header), encoding)
+
+    def test_get_compressed(self):
+        '''
+        Checks that a streamed collection is compressed with the negotiated
+        content coding and its ETag still matches
+        '''
+        print '('+self.test_get_compressed.__name__+')', \
+              self.test_get_compressed.__doc__
+        identity = self.client.get(self.url)
+        self.assertNotIn('Content-Encoding', identity.headers)
+        self.assertEquals(identity.headers['Vary'], 'Accept-Encoding')
+        for encoding, wbits in (('gzip', 16 + zlib.MAX_WBITS),
+                                ('deflate', zlib.MAX_WBITS)):
+            resp = self.client.get(self.url,
+                                   headers={'Accept-Encoding': encoding})
+            self.assertEquals(resp.status_code, 200)
+            self.assertEquals(resp.headers['Content-Encoding'], encoding)
+            self.assertEquals(resp.headers['Vary'], 'Accept-Encoding')
+            self.assertEquals(zlib.decompress(resp.data, wbits),
+                              identity.data)
+        #The ETag is strong and specific to the coding
+        etag = identity.headers['ETag']
+        self.assertEquals(resp.headers['ETag'], etag[:-1] + '-deflate"')
+        resp = self.client.get(self.url, headers={
+            'Accept-Encoding': 'deflate',
+            'If-None-Match': resp.headers['ETag']})
+        self.assertEquals(resp.status_code, 304)
+        self.assertEquals(resp.headers['ETag'], etag[:-1] + '-deflate"')
+        #Other codings and weak ETags do not match
+        for encoding, if_none_match in (('gzip', etag[:-1] + '-deflate"'),
+                                        ('identity', etag[:-1] + '-gzip"'),
+                                        ('gzip', 'W/' + etag[:-1] + '-gzip"'),
+                                        ('identity', 'W/' + etag)):
+            resp = self.client.get(self.url, headers={
+                'Accept-Encoding': encoding, 'If-None-Match': if_none_match})
+            self.assertEquals(resp.status_code, 200)
+            resp.close()
+
+    def test_threshold(self):
+        '''
+        Checks that the bodies below the threshold and the errors are not
+        compressed
+        '''
+        print '('+self.test_threshold.__name__+')', \
+              self.test_threshold.__doc__
+        app = utils.CompressionMiddleware(resources.app, threshold=1000000)
+        resp = Client(app, BaseResponse).get(
+            self.url, headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn('"items"', resp.data)
+        resp = self.client.get('/forum/api/sports/sleep/',
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertEquals(resp.status_code, 404)
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_cached(self):
+        '''
+        Checks that the ResponseCache stores one compressed body per content
+        coding
+        '''
+        print '('+self.test_cached.__name__+')', self.test_cached.__doc__
+        cache = utils.ResponseCache(self.app)
+        client = Client(cache, BaseResponse)
+        first = client.get(self.url, buffered=True,
+                           headers={'Accept-Encoding': 'gzip'})
+        cached = client.get(self.url, buffered=True,
+                            headers={'Accept-Encoding': 'deflate;q=0.5, gzip'})
+        self.assertEquals(cache.stats()['hits'], 1)
+        self.assertEquals(cached.data, first.data)
+        self.assertEquals(cached.headers['Content-Encoding'], 'gzip')
+        self.assertEquals(cached.headers['Content-Length'],
+                          str(len(first.data)))
+        identity = client.get(self.url, buffered=True)
+        self.assertNotIn('Content-Encoding', identity.headers)
+        self.assertEquals(zlib.decompress(first.data, 16 + zlib.MAX_WBITS),
+                          identity.data)
+        self.assertEquals(cache.stats()['size'], 2)
+        resp = client.get(self.url, buffered=True, headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': first.headers['ETag']})
+        self.assertEquals(resp.status_code, 304)
+
+
+class ItemEncoderTestCase(unittest.TestCase):
+
+    order = database.Order(('order-1', u'ch\xe9n "the" \\ \n', None,
+                            1476700000.5))
+
+    def test_encode(self):
+        '''
+        Checks that the encoded item decodes to the item built with
+        dictionaries, with its members in a fixed order
+        '''
+        print '('+self.test_encode.__name__+')', self.test_encode.__doc__
+        with resources.app.test_request_context('/'):
+            text = resources.ORDER_ITEM.encode(self.order)
+            href = resources.api.url_for(resources.Order, orderid='order-1')
+        item = {'href': href,
+                'data': [{'name': 'order_id', 'value': 'order-1'},
+                         {'name': 'user_nickname',
+                          'value': self.order['nickname']},
+                         {'name': 'sportname', 'value': None},
+                         {'name': 'timestamp', 'value': 1476700000.5}],
+                'links': []}
+        self.assertEquals(json.loads(text), item)
+        members = json.loads(text, object_pairs_hook=OrderedDict)
+        self.assertEquals(members.keys(), ['href', 'data', 'links'])
+        self.assertEquals([data['name'] for data in members['data']],
+                          ['order_id', 'user_nickname', 'sportname',
+                           'timestamp'])
+
+    def test_encode_values(self):
+        '''
+        Checks that the values are encoded as json.dumps does
+        '''
+        print '('+self.test_encode_values.__name__+')', \
+              self.test_encode_values.__doc__
+        for value in ('chen', u'\xe9\t"', 'caf\xc3\xa9', 0, 12L, -1.5,
+                      float('inf'), True, False, None, [1]):
+            self.assertEquals(resources.encode_value(value),
+                              json.dumps(value))
+        encoder = resources.ItemEncoder([], members={'read-only': True})
+        self.assertEquals(json.loads(encoder.encode({})),
+                          {'data': [], 'read-only': True})
+
+    def test_jsonify_record(self):
+        '''
+        Checks that the records are serialized as JSON objects, not arrays
+        '''
+        print '('+self.test_jsonify_record.__name__+')', \
+              self.test_jsonify_record.__doc__
+        with resources.app.test_request_context('/'):
+            response = flask.jsonify(order=self.order, orders=[self.order])
+        data = json.loads(response.get_data())
+        self.assertEquals(data['order'], self.order.as_dict())
+        self.assertEquals(data['orders'], [self.order.as_dict()])
+
+    def test_fragment_cache(self):
+        '''
+        Checks that only the new and modified records are rendered again
+        and that the fragments not used recently are dropped
+        '''
+        print '('+self.test_fragment_cache.__name__+')', \
+              self.test_fragment_cache.__doc__
+        cache = resources.FragmentCache(capacity=4)
+        encoder = resources.ItemEncoder(
+            [('order_id', 'order_id'), ('user_nickname', 'nickname')],
+            cache=cache)
+        text = encoder.encode(self.order)
+        self.assertIs(encoder.encode(self.order), text)
+        #The same order with another nickname
+        modified = database.Order(('order-1', 'libo', None, 1476700000.5))
+        self.assertIn('"libo"', encoder.encode(modified))
+        self.assertEquals(cache.stats()['hits'], 1)
+        self.assertEquals(cache.stats()['misses'], 2)
+        #Dictionaries are not cached
+        encoder.encode({'order_id': 'order-2', 'nickname': 'chen'})
+        self.assertEquals(cache.stats()['size'], 2)
+        encoder.encode(database.Order(('order-2', 'chen', None, 1)))
+        self.assertEquals(cache.stats()['size'], 3)
+        #The modified order is used again, the first one is dropped
+        encoder.encode(modified)
+        self.assertEquals(cache.stats()['size'], 2)
+        self.assertEquals(cache.stats()['evictions'], 1)
+        misses = cache.stats()['misses']
+        self.assertEquals(list(encoder.iterencode([modified, self.order])),
+                          [encoder.encode(modified), text])
+        self.assertEquals(cache.stats()['misses'], misses + 1)
+
+    def test_fragment_cache_key(self):
+        '''
+        Checks that the URLs under different script roots are rendered apart
+        '''
+        print '('+self.test_fragment_cache_key.__name__+')', \
+              self.test_fragment_cache_key.__doc__
+        encoder = resources.ItemEncoder(
+            [('timestamp', 'timestamp')],
+            href=lambda order: resources.request.script_root + '/' +
+                               order['order_id'],
+            cache=resources.FragmentCache())
+        with resources.app.test_request_context('/'):
+            self.assertIn('"href": "/order-1"', encoder.encode(self.order))
+            self.assertEquals(list(encoder.iterencode([self.order])),
+                              [encoder.encode(self.order)])
+        with resources.app.test_request_context(
+                '/', base_url='http://localhost/forum'):
+            self.assertIn('"href": "/forum/order-1"',
+                          encoder.encode(self.order))
+            self.assertIn('"href": "/forum/order-1"',
+                          list(encoder.iterencode([self.order]))[0])
+
+
+class URLTemplateTestCase(unittest.TestCase):
+
+    def test_format(self):
+        '''
+        Checks that the URLs formatted from the templates are the ones built
+        by api.url_for
+        '''
+        print '('+self.test_format.__name__+')', self.test_format.__doc__
+        template = resources.URLTemplate(resources.Sport, 'sportname')
+        with resources.app.test_request_context('/'):
+            self.assertEquals(resources.ORDER_URL.format(orderid='order-12'),
+                              resources.api.url_for(resources.Order,
+                                                    orderid='order-12'))
+            for sportname in ('swim', 'table tennis', u'p\xe9tanque', '100%',
+                              'a/b', 'sports', 'forum'):
+                self.assertEquals(template.format(sportname=sportname),
+                                  resources.api.url_for(resources.Sport,
+                                                        sportname=sportname))
+
+    def test_format_script_root(self):
+        '''
+        Checks that the URLs and the collections are built under the script
+        root of the request, where the application is mounted
+        '''
+        print '('+self.test_format_script_root.__name__+')', \
+              self.test_format_script_root.__doc__
+        with resources.app.test_request_context(
+                '/', base_url='http://localhost/forum'):
+            self.assertEquals(resources.ORDER_URL.format(orderid='order-0'),
+                              '/forum/forum/api/orderid/order-0/')
+            collection, envelope = resources.collection_parts('all_orders')
+            self.assertEquals(collection['href'],
+                              '/forum/forum/api/orders/')
+            self.assertIn('"/forum/forum/api/orders/"', envelope[0])
+        with resources.app.test_request_context('/'):
+            self.assertEquals(resources.ORDER_URL.format(orderid='order-0'),
+                              '/forum/api/orderid/order-0/')
+            collection, envelope = resources.collection_parts('all_orders')
+            self.assertEquals(collection['href'], '/forum/api/orders/')
+
 
 if __name__ == '__main__':
     print 'Start running tests'